@@ -1,50 +1,20 @@
-from langchain import LLMChain, OpenAI, ConversationChain, LlamaCpp, SQLDatabase, SQLDatabaseChain
-from langchain.agents import initialize_agent, load_tools, AgentType, Tool, ZeroShotAgent
+from langchain import LLMChain, ConversationChain, SQLDatabase, SQLDatabaseChain
 from langchain.chat_models import ChatOpenAI
-from langchain.memory import ConversationBufferMemory, SQLiteEntityStore
+from langchain.memory import SQLiteEntityStore
 from langchain.prompts import PromptTemplate
-from langchain.callbacks.manager import CallbackManager
-from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
+from langchain.callbacks.base import BaseCallbackHandler
 
 import pandas as pd
 import ast
 import json
+import os
+import threading
 
-class Agent:
-    def __init__(self, assistant_details={"name": "Ava", "age": "27", "style": "funny, excited, disciplined", "traits": "methodical, disciplined, concise", "backstory": "Ava was raised in a small town."}):
-
-        self.assistant_details = assistant_details
-        
-        #self.llm_chain = LLMChain(llm=self.llm, prompt=self.prompt, memory=self.memory, verbose=True)
-        #self.db = SQLDatabase.from_uri("sqlite:///../simulation-app/simulation.db")
-        #self.db_chain = SQLDatabaseChain.from_llm(self.llm, self.db, verbose=True)
-    
-    # Prompt the LLM to generate a response
-    def generate_response(self, state_history, query):
-
-        callback_manager = CallbackManager([StreamingStdOutCallbackHandler()])
-        
-        llm = OpenAI(model="text-davinci-003", 
-                     temperature=0, 
-                     max_tokens=3000,
-                     callback_manager=callback_manager, 
-                     streaming=True)
-        """
-        llm = LlamaCpp(
-            model_path="/Users/user/Downloads/models/llama-2-7b.ggmlv3.q4_K_S.bin",
-            temperature=0,
-            n_gpu_layers=1,  # Change this value based on your model and your GPU VRAM pool.
-            n_batch=2048,  # Should be between 1 and n_ctx, consider the amount of VRAM in your GPU.
-            f16_kv=True,  # MUST set to True, otherwise you will run into problem after a couple of calls
-            callback_manager=callback_manager,
-            verbose=True,
-            streaming=True
-        )
-        """
+from memory import ConversationMemory
+import llm_backends
 
-        tools = load_tools(['llm-math','wikipedia'], llm=llm)
-
-        template = """
+# The persona is filled in once per agent; the state, chat history and question on every call
+TEMPLATE = """
         You are an assistant to the leader of the country. 
         Your name is {name}. 
         You are {age} years old. 
@@ -57,51 +27,135 @@ class Agent:
         {state}
         Chat history: {chat_history} 
         Leader: {input} 
-        {name}:""".format(name = self.assistant_details["name"],
-                          age = self.assistant_details["age"],
-                          style = self.assistant_details["style"],
-                          traits = self.assistant_details["traits"],
-                          backstory = self.assistant_details["backstory"],
-                          state = state_history,
-                          input="{input}",
-                          chat_history="{chat_history}")
-
-        prompt = PromptTemplate(template=template, input_variables=['chat_history','input'])
-        
-        memory = ConversationBufferMemory(memory_key="chat_history",
-                                          input_key="input",
-                                          ai_prefix=self.assistant_details["name"],
-                                          human_prefix="Leader")
+        {name}:"""
 
-        llm_chain = LLMChain(llm=llm, prompt=prompt, memory=memory, output_key="output")
+ERROR_PREFIX = "An error occurred while generating the response. "
 
-        """
-        tools.extend([
-            Tool(
-                name="simulation data",
-                func=self.get_state_dataframe(state_history),
-                description="Useful for when you need to answer questions about simulation state, history and data. It returns a dataframe."
-            )
-        ])
-        """
+class GenerationCancelled(Exception):
+    pass
 
-        # initialise the agents & make all the tools and llm available to it
-        """
-        agent = initialize_agent(tools=tools,
-                                llm=llm, 
-                                agent=AgentType.CONVERSATIONAL_REACT_DESCRIPTION, 
-                                verbose=True,
-                                prompt=prompt,
-                                memory=memory,
-                                handle_parsing_errors="Check your output and make sure it conforms!")
-        """
 
+class TokenQueueHandler(BaseCallbackHandler):
+    """Hands every streamed token to an asyncio queue owned by `loop`.
+
+    Runs on the LLM thread. Once cancel() is called, the next token aborts the generation.
+    """
+
+    raise_error = True  # let GenerationCancelled reach the chain instead of only being logged
+
+    def __init__(self, loop, queue):
+        self.loop = loop
+        self.queue = queue
+        self.cancelled = threading.Event()
+
+    def on_llm_new_token(self, token: str, **kwargs):
+        if self.cancelled.is_set():
+            raise GenerationCancelled("The client stopped listening")
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, token)
+
+    def cancel(self):
+        self.cancelled.set()
+
+
+def shared_llm():
+    # The model of the configured backend, built once and shared by every agent
+    return llm_backends.get_backend().llm()
+
+
+class Agent:
+    def __init__(self, assistant_details={"name": "Ava", "age": "27", "style": "funny, excited, disciplined", "traits": "methodical, disciplined, concise", "backstory": "Ava was raised in a small town."},
+                 llm=None, mode=None):
+
+        self.assistant_details = assistant_details
+        self.llm = llm  # None uses the shared model client, built on first use
+        # "chain" answers with the prompt alone; "agent" lets the model use tools
+        self.mode = mode or os.environ.get("SIMULATION_AGENT_MODE", "chain")
+        self._memory = None
+        self._chain = None
+        self._tools = None
+        self._agent = None
+        # One call at a time per assistant, so the chat history stays in order
+        self.lock = threading.RLock()
+        
+        #self.db = SQLDatabase.from_uri("sqlite:///../simulation-app/simulation.db")
+        #self.db_chain = SQLDatabaseChain.from_llm(self.llm, self.db, verbose=True)
+
+    def get_llm(self):
+        return self.llm if self.llm is not None else shared_llm()
+
+    def memory(self):
+        with self.lock:
+            if self._memory is None:
+                self.set_memory(ConversationMemory())
+            return self._memory
+
+    def set_memory(self, memory):
+        # Talk on from a conversation kept elsewhere, e.g. by the game session
+        with self.lock:
+            memory.ai_prefix = self.assistant_details["name"]
+            memory.human_prefix = "Leader"
+            self._memory = memory
+            # Built chains hold the memory they were built with
+            self._chain = None
+            self._agent = None
+
+    def remember(self, query, response):
+        # Record a turn answered without the model, e.g. from the response cache
+        with self.lock:
+            memory = self.memory()
+            memory.save_context({memory.input_key: query}, {memory.output_key: response})
+
+    def chain(self):
+        # Built on the first call and kept for the life of the assistant
+        with self.lock:
+            if self._chain is None:
+                prompt = PromptTemplate(template=TEMPLATE,
+                                        input_variables=["state", "chat_history", "input"],
+                                        partial_variables={key: str(self.assistant_details[key]) for key in ("name", "age", "style", "traits", "backstory")})
+                self._chain = LLMChain(llm=self.get_llm(), prompt=prompt, memory=self.memory(), output_key="output")
+            return self._chain
+
+    def tools(self):
+        # Only the agent mode uses tools, so they are loaded the first time it runs
+        with self.lock:
+            if self._tools is None:
+                from langchain.agents import load_tools
+                self._tools = load_tools(['llm-math','wikipedia'], llm=self.get_llm())
+                """
+                self._tools.extend([
+                    Tool(
+                        name="simulation data",
+                        func=self.get_state_dataframe(state_history),
+                        description="Useful for when you need to answer questions about simulation state, history and data. It returns a dataframe."
+                    )
+                ])
+                """
+            return self._tools
+
+    def react_agent(self):
+        # initialise the agent once & make all the tools and llm available to it
+        with self.lock:
+            if self._agent is None:
+                from langchain.agents import initialize_agent, AgentType
+                self._agent = initialize_agent(tools=self.tools(),
+                                               llm=self.get_llm(),
+                                               agent=AgentType.CONVERSATIONAL_REACT_DESCRIPTION,
+                                               verbose=True,
+                                               memory=self.memory(),
+                                               handle_parsing_errors="Check your output and make sure it conforms!")
+            return self._agent
+    
+    # Prompt the LLM to generate a response
+    def generate_response(self, state_history, query, callbacks=None):
+        # Failures come back as an answer starting with ERROR_PREFIX; callbacks see this call's tokens
         try:
-            #answer = agent({"input": query})["output"]
-            answer = llm_chain({'input': query})["output"]
-            return answer
+            with self.lock:
+                if self.mode == "agent":
+                    # The agent prompt has no state variable, so the state leads the question
+                    return self.react_agent()({"input": f"{state_history}\n{query}"}, callbacks=callbacks)["output"]
+                return self.chain()({"state": state_history, "input": query}, callbacks=callbacks)["output"]
         except Exception as e:
-            return "An error occurred while generating the response. "+str(e)
+            return ERROR_PREFIX+str(e)
     
     def get_state_dataframe(self, state_history):
 
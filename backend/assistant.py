@@ -1,5 +1,7 @@
 from agent import Agent
 
+NEWS_QUERY = "Fetch news"  # what the agent is asked for the news
+
 class Assistant:
     def __init__(self, name: str, age: int, style: str, traits: str, backstory: str):
         self.name = name
@@ -13,28 +15,38 @@ class Assistant:
                             "traits": self.traits,
                             "backstory": self.backstory})
 
-    def fetch_news(self):
+    def fetch_news(self, state_history=""):
         # Fetch news from the agent's memory
-        relevant_events = self.agent.generate_response("Fetch news")
+        relevant_events = self.agent.generate_response(state_history, NEWS_QUERY)
 
         return relevant_events
 
-    def generate_decision(self, news_event):
+    def generate_decision(self, news_event, state_history=""):
         # Generate a decision based on a news event
-        decision = self.agent.generate_response(news_event)
+        decision = self.agent.generate_response(state_history, news_event)
 
         return decision
 
-    def generate_response(self, state_history, query):
+    def generate_response(self, state_history, query, callbacks=None):
         # Generate a different response based on the current narrative
-        response = self.agent.generate_response(state_history, query)
+        response = self.agent.generate_response(state_history, query, callbacks=callbacks)
         return response
 
     def process_input(self, input_text: str):
         # Use the agent to process the input
-        response = self.agent.generate_response(input_text)
+        response = self.agent.generate_response("", input_text)
         print(response)
 
+    def use_memory(self, memory):
+        self.agent.set_memory(memory)
+
+    def remember(self, query, response):
+        self.agent.remember(query, response)
+
+    def persona(self):
+        # What the assistant is, without its agent; answers of the same persona are interchangeable
+        return {"name": self.name, "age": self.age, "style": self.style, "traits": self.traits, "backstory": self.backstory}
+
     def __repr__(self) -> str:
         #return str(self.agent.get_summary())
         return self.name
@@ -49,13 +61,5 @@ class Assistant:
     
     @classmethod
     def from_dict(cls, assistant_dict):
-        # create a new instance of the class
-        assistant = cls()
-
-        # populate the attributes of the assistant object from the dictionary
-        # this assumes that the keys in the dictionary match the attribute names of the Assistant object
-        for key, value in assistant_dict.items():
-            setattr(assistant, key, value)
-
-        return assistant
-
+        # The agent is not stored; the persona is enough to build a new one
+        return cls(assistant_dict["name"], assistant_dict["age"], assistant_dict["style"], assistant_dict["traits"], assistant_dict["backstory"])
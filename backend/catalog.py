@@ -0,0 +1,107 @@
+from types import MappingProxyType
+from typing import Callable
+import json
+import os
+import threading
+import time
+
+DATA_FILES = [
+    "data/assistants.json",
+    "data/narratives.json",
+    "data/countries.json",
+    "data/parameters.json",
+    "data/decisions.json",
+    "data/ministers.json",
+    "data/citizen_groups.json",
+    "data/economic_sectors.json",
+]
+
+
+def freeze(value):
+    """Recursively turn parsed JSON into read-only mappings and tuples."""
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+class Catalog:
+    """Process-wide cache of the read-only data/*.json files.
+
+    Each file is parsed once and handed out frozen, so callers can share it without
+    copying. A file is re-read when its mtime or size changes; the check runs at most
+    once per check_interval seconds per file. Serialized responses built from a file are
+    cached alongside it and dropped together with it.
+    """
+
+    def __init__(self, check_interval: float = 1.0):
+        self.check_interval = check_interval
+        self._entries = {}  # path -> (signature, frozen data)
+        self._responses = {}  # key -> (path, signature, bytes)
+        self._checked = {}  # path -> monotonic time of the last stat
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _signature(path: str):
+        stat = os.stat(path)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def preload(self, paths=None):
+        for path in paths or DATA_FILES:
+            self.read(path)
+        return self
+
+    def _entry(self, path: str):
+        # (signature, frozen data) of the current version of a file, from a single lookup
+        entry = self._entries.get(path)
+        now = time.monotonic()
+        if entry is not None and now - self._checked.get(path, 0) < self.check_interval:
+            return entry
+
+        signature = self._signature(path)
+        self._checked[path] = now
+        if entry is not None and entry[0] == signature:
+            return entry
+
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None or entry[0] != signature:
+                with open(path, 'r') as f:
+                    entry = (signature, freeze(json.load(f)))
+                self._entries[path] = entry
+        return entry
+
+    def read(self, path: str):
+        return self._entry(path)[1]
+
+    def signature(self, path: str):
+        # Identifies the version of a file currently served from the cache
+        return self._entry(path)[0]
+
+    def response_bytes(self, key: str, path: str, build: Callable) -> bytes:
+        # JSON bytes of build(data), rebuilt only when the file behind them changes
+        signature, data = self._entry(path)
+        cached = self._responses.get(key)
+        if cached is not None and cached[0] == path and cached[1] == signature:
+            return cached[2]
+
+        body = json.dumps(build(data), default=_thaw).encode("utf-8")
+        self._responses[key] = (path, signature, body)
+        return body
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self._responses.clear()
+            self._checked.clear()
+
+
+def _thaw(value):
+    # json.dumps fallback for the frozen mapping type
+    if isinstance(value, MappingProxyType):
+        return dict(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+catalog = Catalog()
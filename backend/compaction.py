@@ -0,0 +1,284 @@
+"""Retention for stored history; see Compactor.
+
+The server runs it in the background. It can also be run once, or used to convert a database
+created before incremental auto_vacuum, which rebuilds the whole file and so is done offline:
+
+    python backend/compaction.py --db simulation.db [--convert-vacuum]
+"""
+from typing import Callable, Dict, Iterable, Optional
+import argparse
+import copy
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+from simulation import State
+from history import diff_states
+from database import DatabaseManager, INSERT_STATE_SQL
+import serialization
+
+SELECT_ABANDONED_SQL = "SELECT id, updated_at, last_cycle FROM games WHERE updated_at < ? AND archive IS NULL ORDER BY updated_at"
+SELECT_DOWNSAMPLE_SQL = ("SELECT id, updated_at, last_cycle FROM games WHERE updated_at < ? AND archive IS NULL AND downsampled_every != ? "
+                         "ORDER BY updated_at")
+SELECT_UPDATED_AT_SQL = "SELECT updated_at FROM games WHERE id = ?"
+SELECT_ARCHIVE_SQL = "SELECT archive FROM games WHERE id = ?"
+DELETE_STATES_SQL = "DELETE FROM simulations WHERE id = ?"
+DELETE_SERIES_SQL = "DELETE FROM series WHERE simulation_id = ?"
+DELETE_SERIES_BETWEEN_SQL = "DELETE FROM series WHERE simulation_id = ? AND cycle % ? != 0 AND cycle != ?"
+MARK_ARCHIVED_SQL = "UPDATE games SET archive = ? WHERE id = ?"
+MARK_DOWNSAMPLED_SQL = "UPDATE games SET downsampled_every = ? WHERE id = ?"
+
+FULL_STATE_KEYS = ("cycle", "influence", "parameters", "metrics", "citizen_groups")
+SAFE_FILE_NAME = re.compile(r"^[A-Za-z0-9_.-]{1,128}$")
+
+
+class Compactor:
+    """Retention for stored history, run now and then next to a live server.
+
+    Games written to within keep_all_for seconds keep every cycle. Older games are downsampled
+    to every downsample_every-th cycle plus their last cycle, stored as a keyframe. Games not
+    written to for archive_after seconds, and not held by a live session, move to a gzipped NDJSON
+    file in archive_dir. Freed pages are then handed back with incremental VACUUM in short steps,
+    so cycles keep being written meanwhile. A game written to while it is compacted is skipped.
+    Databases without incremental auto_vacuum keep their freed pages for reuse until they are
+    converted offline with convert_to_incremental_vacuum.
+    """
+
+    def __init__(self, db_manager, keep_all_for: float = None, downsample_every: int = None, archive_after: float = None,
+                 archive_dir: str = None, active_ids: Callable[[], Iterable[str]] = None, vacuum_step_pages: int = 256):
+        self.db_manager = db_manager
+        # Zero switches downsampling or archiving off
+        self.keep_all_for = float(keep_all_for if keep_all_for is not None else float(os.environ.get("SIMULATION_RETENTION_FULL_HOURS", "24")) * 3600)
+        self.downsample_every = int(downsample_every if downsample_every is not None else os.environ.get("SIMULATION_RETENTION_DOWNSAMPLE_EVERY", "10"))
+        self.archive_after = float(archive_after if archive_after is not None else float(os.environ.get("SIMULATION_RETENTION_ARCHIVE_DAYS", "30")) * 86400)
+        self.archive_dir = archive_dir or os.environ.get("SIMULATION_ARCHIVE_DIR", "archives")
+        self.active_ids = active_ids if active_ids is not None else (lambda: ())
+        self.vacuum_step_pages = vacuum_step_pages
+        self.last_report = None
+        self.run_lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self, interval: float):
+        # Compact every interval seconds on a background thread
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._run_every, args=(interval,), name="simulation-compaction", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run_every(self, interval: float):
+        while not self.stopping.wait(interval):
+            try:
+                self.run()
+            except Exception:
+                logging.exception("History compaction failed")
+
+    def run(self, now: float = None) -> Dict:
+        """Apply the retention policy once and report what it did."""
+        with self.run_lock:
+            now = time.time() if now is None else now
+            begin = time.perf_counter()
+            self.db_manager.flush()
+            incremental = self.incremental_vacuum_enabled()
+            pages_before, page_size = self._page_count()
+            active = set(self.active_ids())
+            report = {"archived": 0, "archive_bytes": 0, "downsampled": 0, "rows_deleted": 0}
+
+            if self.archive_after > 0:
+                for simulation_id, updated_at, last_cycle in self._games(SELECT_ABANDONED_SQL, (now - self.archive_after,)):
+                    if simulation_id not in active:
+                        archived = self.archive(simulation_id, updated_at)
+                        if archived is not None:
+                            report["archived"] += 1
+                            report["archive_bytes"] += archived[0]
+                            report["rows_deleted"] += archived[1]
+
+            if self.downsample_every > 1:
+                for simulation_id, updated_at, last_cycle in self._games(SELECT_DOWNSAMPLE_SQL, (now - self.keep_all_for, self.downsample_every)):
+                    if simulation_id not in active:
+                        deleted = self.downsample(simulation_id, updated_at, last_cycle)
+                        if deleted is not None:
+                            report["downsampled"] += 1
+                            report["rows_deleted"] += deleted
+
+            if incremental:
+                self.incremental_vacuum()
+            else:
+                logging.warning("The simulation database does not use incremental auto_vacuum, so freed pages are only reused; "
+                                "convert it offline with: python backend/compaction.py --convert-vacuum")
+            report["incremental_vacuum"] = incremental
+            pages_after, _ = self._page_count()
+            report["bytes_reclaimed"] = max(0, pages_before - pages_after) * page_size
+            report["seconds"] = round(time.perf_counter() - begin, 3)
+            self.last_report = report
+            logging.info(f"History compaction: {report}")
+            return report
+
+    def archive(self, simulation_id: str, updated_at: float):
+        # Write the whole history to the archive file first; drop the rows only once it is complete
+        path = os.path.join(self.archive_dir, archive_file_name(simulation_id))
+        os.makedirs(self.archive_dir, exist_ok=True)
+        fd, temporary = tempfile.mkstemp(dir=self.archive_dir, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb") as f:
+                for cycle, state_dict, changes in self.db_manager.replay(simulation_id):
+                    f.write(json.dumps({"cycle": cycle, "state": state_dict, "changes": changes}).encode("utf-8") + b"\n")
+            os.replace(temporary, path)
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+
+        def drop(cursor):
+            cursor.execute(DELETE_STATES_SQL, (simulation_id,))
+            deleted = cursor.rowcount
+            cursor.execute(DELETE_SERIES_SQL, (simulation_id,))
+            deleted += cursor.rowcount
+            cursor.execute(MARK_ARCHIVED_SQL, (path, simulation_id))
+            return deleted
+
+        deleted = self._write_if_unchanged(simulation_id, updated_at, drop)
+        if deleted is None:
+            os.remove(path)
+            return None
+        self.db_manager.forget(simulation_id)
+        return os.path.getsize(path), deleted
+
+    def read_archive(self, simulation_id: str):
+        """Yield the {"cycle", "state", "changes"} records of an archived game."""
+        with self.db_manager.pool.reading() as cursor:
+            found = cursor.execute(SELECT_ARCHIVE_SQL, (simulation_id,)).fetchone()
+        if found is None or found[0] is None:
+            return
+        with gzip.open(found[0], "rb") as f:
+            for line in f:
+                yield json.loads(line)
+
+    def downsample(self, simulation_id: str, updated_at: float, last_cycle: int):
+        every = self.downsample_every
+        rows, previous = [], None
+        for cycle, state_dict, changes in self.db_manager.replay(simulation_id):
+            if cycle % every and cycle != last_cycle:
+                continue
+            # Keyframes as often as in live history, counted in kept cycles, and always for the last cycle
+            full = all(key in state_dict for key in FULL_STATE_KEYS)
+            if previous is None or not full or len(rows) % self.db_manager.keyframe_interval == 0 or cycle == last_cycle:
+                rows.append((simulation_id, cycle, self.encode_keyframe(state_dict, full), json.dumps(changes), "keyframe"))
+            else:
+                rows.append((simulation_id, cycle, json.dumps(diff_states(previous, state_dict)), json.dumps(changes), "delta"))
+            previous = copy.deepcopy(state_dict) if full else None
+
+        def rewrite(cursor):
+            cursor.execute(DELETE_STATES_SQL, (simulation_id,))
+            deleted = cursor.rowcount - len(rows)
+            cursor.executemany(INSERT_STATE_SQL, rows)
+            cursor.execute(DELETE_SERIES_BETWEEN_SQL, (simulation_id, every, last_cycle))
+            deleted += cursor.rowcount
+            cursor.execute(MARK_DOWNSAMPLED_SQL, (every, simulation_id))
+            return deleted
+
+        deleted = self._write_if_unchanged(simulation_id, updated_at, rewrite)
+        if deleted is not None:
+            self.db_manager.forget(simulation_id)
+        return deleted
+
+    def encode_keyframe(self, state_dict: Dict, full: bool):
+        if full and self.db_manager.history_format == "binary":
+            try:
+                return serialization.dumps(State.from_dict(state_dict))
+            except (KeyError, TypeError, ValueError):
+                logging.warning(f"Keeping cycle {state_dict.get('cycle')} as JSON, it does not load as a State")
+        return json.dumps(state_dict)
+
+    def incremental_vacuum_enabled(self) -> bool:
+        # Asked of the writer: readers opened before a conversion still report the old mode
+        with self.db_manager.pool.writing() as cursor:
+            return cursor.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+
+    def incremental_vacuum(self):
+        # A few pages per step, each step a short write of its own, so the writer never waits long
+        free = None
+        while True:
+            with self.db_manager.pool.writing() as cursor:
+                remaining = cursor.execute("PRAGMA freelist_count").fetchone()[0]
+                if not remaining or remaining == free:
+                    break
+                free = remaining
+                cursor.execute(f"PRAGMA incremental_vacuum({int(self.vacuum_step_pages)})").fetchall()
+        with self.db_manager.pool.writing() as cursor:
+            cursor.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchall()
+
+    def _games(self, sql: str, parameters):
+        with self.db_manager.pool.reading() as cursor:
+            return cursor.execute(sql, parameters).fetchall()
+
+    def _page_count(self):
+        with self.db_manager.pool.writing() as cursor:
+            return cursor.execute("PRAGMA page_count").fetchone()[0], cursor.execute("PRAGMA page_size").fetchone()[0]
+
+    def _write_if_unchanged(self, simulation_id: str, updated_at: float, write) -> Optional[int]:
+        # Runs write(cursor) in one transaction, unless the game was written to since it was read
+        with self.db_manager.pool.writing() as cursor:
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                current = cursor.execute(SELECT_UPDATED_AT_SQL, (simulation_id,)).fetchone()
+                if current is None or current[0] != updated_at:
+                    cursor.execute("ROLLBACK")
+                    return None
+                result = write(cursor)
+                cursor.execute("COMMIT")
+                return result
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+
+
+def convert_to_incremental_vacuum(db_manager) -> bool:
+    """Switch a database created before auto_vacuum was set; returns whether it had to.
+
+    This is a full VACUUM, which rebuilds the file and holds the writer all along, so run it
+    while no server uses the database.
+    """
+    with db_manager.pool.writing() as cursor:
+        if cursor.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return False
+        logging.info("Switching the simulation database to incremental auto_vacuum with a full VACUUM")
+        cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        cursor.execute("VACUUM")
+        return True
+
+
+def archive_file_name(simulation_id: str) -> str:
+    # Game ids are uuids; anything that is not a safe file name is hashed
+    name = simulation_id if SAFE_FILE_NAME.match(simulation_id) else hashlib.sha256(simulation_id.encode("utf-8")).hexdigest()
+    return f"{name}.ndjson.gz"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Apply the history retention policy once, or convert the database to incremental vacuum")
+    parser.add_argument("--db", default=os.environ.get("SIMULATION_DB", "simulation.db"))
+    parser.add_argument("--convert-vacuum", action="store_true", help="run the one-off full VACUUM; stop the server first")
+    args = parser.parse_args(argv)
+    db_manager = DatabaseManager(args.db, write_behind=False)
+    try:
+        if args.convert_vacuum:
+            print("converted" if convert_to_incremental_vacuum(db_manager) else "already incremental")
+        else:
+            print(json.dumps(Compactor(db_manager).run(), indent=1))
+    finally:
+        db_manager.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+from contextlib import contextmanager
+import queue
+import sqlite3
+import threading
+
+
+class ConnectionPool:
+    """One writer connection and up to `readers` read-only connections to a SQLite database.
+
+    writing() hands out the writer's cursor to one thread at a time. reading() checks a read-only
+    connection out for the calling thread, opening it on first use; with WAL, readers run next to
+    the writer and only wait on each other once all of them are busy. Private databases such as
+    ":memory:" cannot be opened twice, so there every read goes through the writer.
+    """
+
+    def __init__(self, path: str, readers: int = 4, busy_timeout_ms: int = 5000, pragmas=()):
+        self.path = path
+        self.busy_timeout_ms = busy_timeout_ms
+        self.pragmas = list(pragmas)  # run on every connection
+        self.readers = 0 if path in ("", ":memory:") else max(0, readers)
+        self.write_lock = threading.Lock()
+        self.writer = self._connect()
+        self.idle = queue.LifoQueue()
+        self.opened = 0  # reader connections opened so far
+        self.open_lock = threading.Lock()
+        self.local = threading.local()  # the reader a thread has checked out, for nested reads
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, cached_statements=256)
+        # Wait for a lock held by another connection instead of failing with "database is locked"
+        conn.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout_ms)}")
+        for pragma in self.pragmas:
+            conn.execute(pragma)
+        return conn
+
+    @contextmanager
+    def writing(self):
+        with self.write_lock:
+            yield self.writer.cursor()
+
+    @contextmanager
+    def reading(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            yield conn.cursor()
+            return
+        if not self.readers:
+            with self.writing() as cursor:
+                yield cursor
+            return
+
+        conn = self._checkout()
+        self.local.conn = conn
+        try:
+            yield conn.cursor()
+        finally:
+            self.local.conn = None
+            self.idle.put(conn)
+
+    def _checkout(self) -> sqlite3.Connection:
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.open_lock:
+            open_new = self.opened < self.readers
+            if open_new:
+                self.opened += 1
+        if not open_new:
+            # Every reader is busy; wait for one to come back
+            return self.idle.get()
+        try:
+            conn = self._connect()
+            conn.execute("PRAGMA query_only = ON")
+            return conn
+        except Exception:
+            with self.open_lock:
+                self.opened -= 1
+            raise
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+        with self.write_lock:
+            self.writer.close()
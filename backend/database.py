@@ -3,11 +3,20 @@ from sqlalchemy.orm import sessionmaker, Session
 from sqlalchemy.ext.declarative import declarative_base
 from typing import Dict
 import sqlite3
+import threading
 import logging
+import copy
+import itertools
 import csv
 import json
+import os
+import time
 
 from simulation import State
+from connection_pool import ConnectionPool
+from history import HistoryTracker, apply_delta
+from write_behind import WriteBehind
+import serialization
 
 Base = declarative_base()
 
@@ -20,34 +29,381 @@ SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base.metadata.create_all(engine)
 
+def migrate_history_kinds(cursor):
+    # Version 1: the original history table, with the kind of each row; old rows are full states
+    cursor.execute("CREATE TABLE IF NOT EXISTS simulations (id TEXT, cycle INTEGER, state TEXT, changes TEXT)")
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(simulations)")]
+    if "kind" not in columns:
+        cursor.execute("ALTER TABLE simulations ADD COLUMN kind TEXT NOT NULL DEFAULT 'keyframe'")
+
+
+def migrate_history_primary_key(cursor):
+    # Version 2: one row per (id, cycle), found through the primary key instead of a full scan.
+    # When old data holds a cycle twice, the row written last wins.
+    cursor.execute("""
+        CREATE TABLE simulations_keyed (
+            id TEXT NOT NULL,
+            cycle INTEGER NOT NULL,
+            state TEXT NOT NULL,
+            changes TEXT NOT NULL,
+            kind TEXT NOT NULL DEFAULT 'keyframe',
+            PRIMARY KEY (id, cycle)
+        )
+    """)
+    cursor.execute("""
+        INSERT OR REPLACE INTO simulations_keyed (id, cycle, state, changes, kind)
+        SELECT id, cycle, state, changes, kind FROM simulations WHERE id IS NOT NULL AND cycle IS NOT NULL ORDER BY rowid
+    """)
+    cursor.execute("DROP TABLE simulations")
+    cursor.execute("ALTER TABLE simulations_keyed RENAME TO simulations")
+    # Lets load_state find the nearest keyframe without reading the deltas
+    cursor.execute("CREATE INDEX simulations_keyframes ON simulations (id, cycle) WHERE kind = 'keyframe'")
+
+
+def migrate_series(cursor):
+    # Version 3: parameters and metrics as narrow (simulation, cycle, series, value) rows next to the
+    # state blobs, so charts read a few columns instead of whole states. Existing history is backfilled.
+    cursor.execute("CREATE TABLE series_names (series_id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)")
+    cursor.execute("""
+        CREATE TABLE series (
+            simulation_id TEXT NOT NULL,
+            cycle INTEGER NOT NULL,
+            series_id INTEGER NOT NULL,
+            value REAL,
+            PRIMARY KEY (simulation_id, series_id, cycle)
+        ) WITHOUT ROWID
+    """)
+    names = {}
+    simulation_ids = [simulation_id for simulation_id, in cursor.execute("SELECT DISTINCT id FROM simulations").fetchall()]
+    for simulation_id in simulation_ids:
+        rows = cursor.execute(SELECT_STATES_SQL, (simulation_id,)).fetchall()
+        for cycle, state_dict, _ in replay_states(rows):
+            values = {**{f"parameters.{name}": parameter["value"] for name, parameter in state_dict.get("parameters", {}).items()},
+                      **{f"metrics.{name}": value for name, value in state_dict.get("metrics", {}).items()}}
+            cursor.executemany(INSERT_SERIES_SQL, series_rows(cursor, names, simulation_id, cycle, values))
+
+
+def migrate_games(cursor):
+    # Version 4: when each game was created and last written, for retention. Existing games count as
+    # written at migration time, so they start their retention period now.
+    cursor.execute("""
+        CREATE TABLE games (
+            id TEXT PRIMARY KEY,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            last_cycle INTEGER NOT NULL,
+            downsampled_every INTEGER NOT NULL DEFAULT 0,
+            archive TEXT
+        )
+    """)
+    now = time.time()
+    cursor.execute("INSERT INTO games (id, created_at, updated_at, last_cycle) SELECT id, ?, ?, MAX(cycle) FROM simulations GROUP BY id", (now, now))
+    cursor.execute("CREATE INDEX games_updated_at ON games (updated_at)")
+
+
+def migrate_response_cache(cursor):
+    # Version 5: cached assistant answers (see response_cache.py), so they outlive a restart
+    cursor.execute("CREATE TABLE responses (key TEXT PRIMARY KEY, response TEXT NOT NULL, expires_at REAL NOT NULL) WITHOUT ROWID")
+    cursor.execute("CREATE INDEX responses_expires_at ON responses (expires_at)")
+
+
+# Applied in order; PRAGMA user_version records how many have run
+def migrate_game_timelines(cursor):
+    # Version 6: counts the rewinds of each game, so exports can tell a replayed history from the old one
+    cursor.execute("ALTER TABLE games ADD COLUMN timeline INTEGER NOT NULL DEFAULT 0")
+
+
+MIGRATIONS = [migrate_history_kinds, migrate_history_primary_key, migrate_series, migrate_games, migrate_response_cache,
+              migrate_game_timelines]
+
+# Constant SQL text, so sqlite3 reuses the prepared statements from its statement cache
+INSERT_STATE_SQL = "INSERT OR REPLACE INTO simulations (id, cycle, state, changes, kind) VALUES (?, ?, ?, ?, ?)"
+SELECT_STATES_SQL = "SELECT cycle, state, changes, kind FROM simulations WHERE id = ? ORDER BY cycle"
+SELECT_KEYFRAME_SQL = "SELECT MAX(cycle) FROM simulations WHERE id = ? AND cycle <= ? AND kind = 'keyframe'"
+SELECT_STATE_RANGE_SQL = "SELECT cycle, state, changes, kind FROM simulations WHERE id = ? AND cycle BETWEEN ? AND ? ORDER BY cycle"
+SELECT_STATE_PAGE_SQL = "SELECT cycle, state, changes, kind FROM simulations WHERE id = ? AND cycle > ? AND cycle <= ? ORDER BY cycle LIMIT ?"
+DELETE_STATES_AFTER_SQL = "DELETE FROM simulations WHERE id = ? AND cycle > ?"
+DELETE_SERIES_AFTER_SQL = "DELETE FROM series WHERE simulation_id = ? AND cycle > ?"
+INSERT_SERIES_SQL = "INSERT OR REPLACE INTO series (simulation_id, cycle, series_id, value) VALUES (?, ?, ?, ?)"
+INSERT_SERIES_NAME_SQL = "INSERT OR IGNORE INTO series_names (name) VALUES (?)"
+SELECT_SERIES_ID_SQL = "SELECT series_id FROM series_names WHERE name = ?"
+SELECT_SERIES_SQL = "SELECT series_id, cycle, value FROM series WHERE simulation_id = ? AND series_id = ? AND cycle BETWEEN ? AND ? ORDER BY cycle"
+# A game written to again is no longer downsampled or archived
+UPSERT_GAME_SQL = """
+    INSERT INTO games (id, created_at, updated_at, last_cycle) VALUES (?1, ?2, ?2, ?3)
+    ON CONFLICT (id) DO UPDATE SET updated_at = excluded.updated_at, last_cycle = MAX(last_cycle, excluded.last_cycle),
+                                   downsampled_every = 0, archive = NULL
+"""
+REWIND_GAME_SQL = "UPDATE games SET last_cycle = MIN(last_cycle, ?), updated_at = ?, timeline = timeline + 1 WHERE id = ?"
+SELECT_SERIES_NAMES_SQL = "SELECT DISTINCT series_names.name FROM series JOIN series_names USING (series_id) WHERE simulation_id = ?"
+
+
+# What a history record carries besides its cycle and changes
+HISTORY_FIELDS = ("state", "metrics", "parameters")
+LAST_CYCLE = 2 ** 62
+
+
+def series_rows(cursor, names, simulation_id, cycle, values):
+    # Rows for the series table, registering series names on first use; names caches name -> id
+    rows = []
+    for name, value in values.items():
+        series_id = names.get(name)
+        if series_id is None:
+            cursor.execute(INSERT_SERIES_NAME_SQL, (name,))
+            series_id = names[name] = cursor.execute(SELECT_SERIES_ID_SQL, (name,)).fetchone()[0]
+        rows.append((simulation_id, cycle, series_id, value))
+    return rows
+
+
+def migrate(conn):
+    """Bring the schema up to date, one transaction per migration."""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        logging.info(f"Migrating simulation database to schema version {number}")
+        cursor = conn.cursor()
+        cursor.execute("BEGIN")
+        try:
+            migration(cursor)
+            cursor.execute(f"PRAGMA user_version = {number}")
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+    return len(MIGRATIONS)
+
+
 class DatabaseManager:
-    def __init__(self, db_name):
-        self.conn = sqlite3.connect(db_name)
-        self.cursor = self.conn.cursor()
-        # create the table if it doesn't exist
-        self.cursor.execute("""
-            CREATE TABLE IF NOT EXISTS simulations (
-                id TEXT,
-                cycle INTEGER,
-                state TEXT,
-                changes TEXT
-            )
-        """)
+    def __init__(self, db_name, keyframe_interval=None, cache_size_kib=None, write_behind=None, max_pending=None, max_delay=None,
+                 history_format=None, readers=None, busy_timeout_ms=None):
+        # Every keyframe_interval cycles a full state is stored, the cycles in between as deltas
+        self.keyframe_interval = max(1, int(keyframe_interval or os.environ.get("SIMULATION_KEYFRAME_INTERVAL", "20")))
+        self.history = HistoryTracker()
+        self.history_lock = threading.Lock()
+        # Keyframes are stored in the binary state format unless "json" is asked for
+        self.history_format = history_format or os.environ.get("SIMULATION_HISTORY_FORMAT", "binary")
+        if self.history_format not in ("binary", "json"):
+            raise ValueError(f"Unknown history format '{self.history_format}'")
+        self.series_ids = {}  # series name -> series_id
+
+        # Requests reach the manager from worker threads: writes share one connection, history
+        # queries get read-only connections of their own
+        cache_size_kib = int(cache_size_kib or os.environ.get("SIMULATION_DB_CACHE_KIB", "16384"))
+        self.pool = ConnectionPool(db_name,
+                                   readers=int(readers if readers is not None else os.environ.get("SIMULATION_DB_READERS", "4")),
+                                   busy_timeout_ms=int(busy_timeout_ms if busy_timeout_ms is not None else os.environ.get("SIMULATION_DB_BUSY_TIMEOUT_MS", "5000")),
+                                   pragmas=[f"PRAGMA cache_size = {-cache_size_kib}"])
+        # WAL lets readers run next to the writer; with WAL, synchronous=NORMAL only syncs at checkpoints.
+        # New databases can give freed pages back in steps (see compaction.py); older ones are converted there.
+        with self.pool.writing() as cursor:
+            cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            cursor.execute("PRAGMA journal_mode = WAL")
+            cursor.execute("PRAGMA synchronous = NORMAL")
+            self.schema_version = migrate(cursor.connection)
+
+        # Cycles are committed in batches by a background writer unless write-behind is switched off.
+        # max_pending bounds the cycles a crash can lose; max_delay bounds how long a cycle waits.
+        if write_behind is None:
+            write_behind = os.environ.get("SIMULATION_WRITE_BEHIND", "1") != "0"
+        self.writer = None
+        if write_behind:
+            self.writer = WriteBehind(self.write_records,
+                                      max_pending=int(max_pending or os.environ.get("SIMULATION_WRITE_MAX_PENDING", "1000")),
+                                      max_delay=float(max_delay if max_delay is not None else os.environ.get("SIMULATION_WRITE_MAX_DELAY", "0.05")),
+                                      on_failure=self.forget_records)
 
     def save_state(self, state: State, changes: dict):
-        # Serialize the state and changes to a JSON string
-        state_json = json.dumps(state.to_dict())
+        # Serialize now, while the state is at this cycle; writing can happen later
+        with self.history_lock:
+            base_cycle = self.history.base_cycle(state.id)
+            if base_cycle is None or state.cycle - base_cycle >= self.keyframe_interval:
+                if self.history_format == "binary":
+                    kind, state_json = "keyframe", serialization.dumps(state)
+                else:
+                    kind, state_json = "keyframe", json.dumps(state.to_dict())
+                self.history.keyframe(state, state.cycle)
+            else:
+                kind, state_json = "delta", json.dumps(self.history.delta(state, changes))
         changes_json = json.dumps(changes)
-        self.cursor.execute("INSERT INTO simulations VALUES (?, ?, ?, ?)", (state.id, state.cycle, state_json, changes_json))
-        self.conn.commit()
+        values = {**{f"parameters.{name}": parameter.value for name, parameter in state.parameters.items()},
+                  **{f"metrics.{name}": value for name, value in state.metrics.items()}}
+        record = (state.id, state.cycle, state_json, changes_json, kind, values)
+
+        if self.writer is not None:
+            self.writer.submit(record)
+        else:
+            try:
+                self.write_records([record])
+            except Exception:
+                self.forget_records([record])
+                raise
+
+    def write_records(self, records):
+        # State blobs and their series rows, all in one transaction
+        with self.pool.writing() as cursor:
+            cursor.execute("BEGIN")
+            try:
+                now = time.time()
+                for simulation_id, cycle, state_json, changes_json, kind, values in records:
+                    cursor.execute(INSERT_STATE_SQL, (simulation_id, cycle, state_json, changes_json, kind))
+                    cursor.executemany(INSERT_SERIES_SQL, series_rows(cursor, self.series_ids, simulation_id, cycle, values))
+                    cursor.execute(UPSERT_GAME_SQL, (simulation_id, now, cycle))
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+
+    def forget_records(self, records):
+        # The keyframes in lost records never reached the database; later deltas must not build on them
+        for simulation_id in {record[0] for record in records}:
+            self.forget(simulation_id)
+
+    def flush(self):
+        # Wait until every cycle saved so far is committed; raises WriteFailed if some could not be
+        if self.writer is not None:
+            self.writer.flush()
+
+    def close(self):
+        try:
+            if self.writer is not None:
+                writer, self.writer = self.writer, None
+                writer.close()
+        finally:
+            self.pool.close()
+
+    def forget(self, simulation_id):
+        # The next save of this simulation starts with a keyframe
+        with self.history_lock:
+            self.history.forget(simulation_id)
+
+    def rewind(self, simulation_id, cycle):
+        # Drop the cycles stored after `cycle`, so a game restored to it goes on from there
+        self.flush()
+        with self.pool.writing() as cursor:
+            cursor.execute("BEGIN")
+            try:
+                cursor.execute(DELETE_STATES_AFTER_SQL, (simulation_id, cycle))
+                cursor.execute(DELETE_SERIES_AFTER_SQL, (simulation_id, cycle))
+                cursor.execute(REWIND_GAME_SQL, (cycle, time.time(), simulation_id))
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+        self.forget(simulation_id)
 
     def load_states(self, simulation_id):
-        self.cursor.execute("SELECT cycle, state, changes FROM simulations WHERE id = ? ORDER BY cycle", (simulation_id,))
-        rows = self.cursor.fetchall()
-        # Deserialize the state and changes from the JSON string
-        states = [{cycle: {"state": json.loads(state_json), "changes": json.loads(changes_json)}} for cycle, state_json, changes_json in rows]
-        return states
+        self.flush()
+        with self.pool.reading() as cursor:
+            rows = cursor.execute(SELECT_STATES_SQL, (simulation_id,)).fetchall()
+        # Rebuild every cycle from its keyframe and the deltas after it
+        return [{cycle: {"state": copy.deepcopy(state_dict), "changes": changes}} for cycle, state_dict, changes in replay_states(rows)]
+
+    def load_state(self, simulation_id, cycle):
+        # Rebuild a single cycle from the nearest keyframe at or before it
+        self.flush()
+        with self.pool.reading() as cursor:
+            keyframe_cycle = cursor.execute(SELECT_KEYFRAME_SQL, (simulation_id, cycle)).fetchone()[0]
+            if keyframe_cycle is None:
+                return None
+            rows = cursor.execute(SELECT_STATE_RANGE_SQL, (simulation_id, keyframe_cycle, cycle)).fetchall()
+        last = None
+        for last in replay_states(rows):
+            pass
+        if last is None or last[0] != cycle:
+            return None
+        return {"state": last[1], "changes": last[2]}
+
+    def load_series(self, simulation_id, names=None, from_cycle=None, to_cycle=None):
+        """Values of the named series over a cycle range, as one list per series aligned on `cycles`.
+
+        Names are "parameters.<name>" or "metrics.<name>"; without names every stored series is returned.
+        """
+        self.flush()
+        from_cycle = from_cycle if from_cycle is not None else 0
+        to_cycle = to_cycle if to_cycle is not None else LAST_CYCLE
+        with self.pool.reading() as cursor:
+            if not names:
+                names = sorted(name for name, in cursor.execute(SELECT_SERIES_NAMES_SQL, (simulation_id,)))
+            values = {}
+            for name in names:
+                series_id = cursor.execute(SELECT_SERIES_ID_SQL, (name,)).fetchone()
+                if series_id is None:
+                    raise ValueError(f"Unknown series '{name}'")
+                values[name] = {cycle: value for _, cycle, value in cursor.execute(SELECT_SERIES_SQL, (simulation_id, series_id[0], from_cycle, to_cycle))}
+        cycles = sorted(set().union(*values.values())) if values else []
+        return {"cycles": cycles, "series": {name: [series.get(cycle) for cycle in cycles] for name, series in values.items()}}
+
+    def iter_history(self, simulation_id, from_cycle=None, to_cycle=None, fields=None, batch_size=256):
+        """Stored cycles between from_cycle and to_cycle as {"cycle", <fields>, "changes"} records.
+
+        Rows are read batch_size at a time, each batch in its own short read, so a long campaign is
+        never held in memory and no reader stays checked out between batches. fields is "state"
+        (the default), "metrics" or "parameters".
+        """
+        fields = fields or "state"
+        if fields not in HISTORY_FIELDS:
+            raise ValueError(f"Unknown history fields '{fields}', expected one of {', '.join(HISTORY_FIELDS)}")
+        self.flush()
+        return self._iter_history(simulation_id, from_cycle if from_cycle is not None else 0,
+                                  to_cycle if to_cycle is not None else LAST_CYCLE, fields, max(1, batch_size))
+
+    def _iter_history(self, simulation_id, from_cycle, to_cycle, fields, batch_size):
+        for cycle, state_dict, changes in self.replay(simulation_id, from_cycle, to_cycle, batch_size):
+            if fields == "metrics":
+                yield {"cycle": cycle, "metrics": dict(state_dict.get("metrics", {})), "changes": changes}
+            elif fields == "parameters":
+                parameters = {name: parameter["value"] for name, parameter in state_dict.get("parameters", {}).items()}
+                yield {"cycle": cycle, "parameters": parameters, "changes": changes}
+            else:
+                yield {"cycle": cycle, "state": copy.deepcopy(state_dict), "changes": changes}
+
+    def replay(self, simulation_id, from_cycle=0, to_cycle=LAST_CYCLE, batch_size=256):
+        """Like replay_states, for the stored cycles of one game, read batch_size rows at a time."""
+        # Replay starts at the nearest keyframe; the cycles before from_cycle are rebuilt but not returned
+        with self.pool.reading() as cursor:
+            keyframe_cycle = cursor.execute(SELECT_KEYFRAME_SQL, (simulation_id, from_cycle)).fetchone()[0]
+        start = keyframe_cycle if keyframe_cycle is not None else from_cycle
+
+        def rows():
+            # Keyset pages: each batch continues after the last cycle of the one before
+            after = start - 1
+            while True:
+                with self.pool.reading() as cursor:
+                    batch = cursor.execute(SELECT_STATE_PAGE_SQL, (simulation_id, after, to_cycle, batch_size)).fetchall()
+                yield from batch
+                if len(batch) < batch_size:
+                    return
+                after = batch[-1][0]
+
+        for cycle, state_dict, changes in replay_states(rows()):
+            if cycle >= from_cycle:
+                yield cycle, state_dict, changes
+
+    def load_history_page(self, simulation_id, after_cycle=None, limit=100, from_cycle=None, to_cycle=None, fields=None):
+        """Up to limit records of iter_history; next_cursor is the after_cycle of the next page, or None at the end."""
+        if after_cycle is not None:
+            from_cycle = max(after_cycle + 1, from_cycle or 0)
+        records = self.iter_history(simulation_id, from_cycle, to_cycle, fields, batch_size=limit + 1)
+        items = list(itertools.islice(records, limit + 1))
+        records.close()
+        next_cursor = items[limit - 1]["cycle"] if len(items) > limit else None
+        return {"items": items[:limit], "next_cursor": next_cursor}
+
+
+def replay_states(rows):
+    """Yield (cycle, state dict, changes) for (cycle, state, changes, kind) rows in cycle order.
 
+    The state dict is updated in place by the deltas that follow; copy it to keep it.
+    """
+    current = None
+    for cycle, state_json, changes_json, kind in rows:
+        if kind == "keyframe":
+            current = serialization.loads_dict(state_json) if serialization.is_serialized(state_json) else json.loads(state_json)
+        elif current is None:
+            logging.warning(f"Skipping delta of cycle {cycle} without a keyframe before it")
+            continue
+        else:
+            apply_delta(current, json.loads(state_json))
+        yield cycle, current, json.loads(changes_json)
 
 
 class User(Base):
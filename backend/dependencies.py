@@ -0,0 +1,94 @@
+from collections import deque
+from typing import Dict, List
+
+import numpy as np
+
+
+class DependencyGraph:
+    """DAG of parameter dependencies, built from the `dependencies` field of the parameters.
+
+    A parameter changes by the average change of the parameters it depends on, so a change
+    to Economy reaches Employment Rate and, through it, Job Satisfaction. Unknown names and
+    cycles are rejected when the graph is built; the topological order is computed once.
+    """
+
+    def __init__(self, dependencies: Dict[str, List[str]]):
+        self.names = list(dependencies.keys())
+        self.index = {name: i for i, name in enumerate(self.names)}
+
+        self.dependencies = []
+        self.dependents = [[] for _ in self.names]
+        for name, dependency_names in dependencies.items():
+            node_dependencies = []
+            for dependency_name in dependency_names:
+                if dependency_name not in self.index:
+                    raise ValueError(f"Parameter '{name}' depends on unknown parameter '{dependency_name}'")
+                node_dependencies.append(self.index[dependency_name])
+                self.dependents[self.index[dependency_name]].append(self.index[name])
+            self.dependencies.append(node_dependencies)
+
+        self.order = self._topological_order()
+
+    @classmethod
+    def from_parameters(cls, parameters: Dict):
+        return cls({name: parameter.dependencies for name, parameter in parameters.items()})
+
+    def _topological_order(self) -> List[int]:
+        # Kahn's algorithm over the whole graph; leftover nodes sit on a cycle
+        indegree = [len(node_dependencies) for node_dependencies in self.dependencies]
+        queue = deque(node for node, degree in enumerate(indegree) if degree == 0)
+        order = []
+        while queue:
+            node = queue.popleft()
+            order.append(node)
+            for dependent in self.dependents[node]:
+                indegree[dependent] -= 1
+                if indegree[dependent] == 0:
+                    queue.append(dependent)
+
+        if len(order) != len(self.names):
+            cyclic = sorted(self.names[node] for node, degree in enumerate(indegree) if degree > 0)
+            raise ValueError(f"Parameter dependencies contain a cycle through: {', '.join(cyclic)}")
+        return order
+
+    def propagate(self, changes: Dict[str, float]) -> Dict[str, float]:
+        """Return the change induced on every downstream parameter by the given direct changes.
+
+        Only the subgraph reachable from the changed parameters is visited, so the cost is
+        linear in the number of affected edges.
+        """
+        seeds = [self.index[name] for name in changes if name in self.index]
+
+        # Collect the affected subgraph and the in-degree of each node within it
+        affected = set(seeds)
+        queue = deque(seeds)
+        indegree = {}
+        while queue:
+            node = queue.popleft()
+            for dependent in self.dependents[node]:
+                indegree[dependent] = indegree.get(dependent, 0) + 1
+                if dependent not in affected:
+                    affected.add(dependent)
+                    queue.append(dependent)
+
+        # Push total changes forward in topological order of the affected subgraph
+        induced = {}
+        queue = deque(node for node in affected if node not in indegree)
+        while queue:
+            node = queue.popleft()
+            total = changes.get(self.names[node], 0) + induced.get(node, 0)
+            for dependent in self.dependents[node]:
+                induced[dependent] = induced.get(dependent, 0) + total / len(self.dependencies[dependent])
+                indegree[dependent] -= 1
+                if indegree[dependent] == 0:
+                    queue.append(dependent)
+
+        return {self.names[node]: change for node, change in induced.items()}
+
+    def propagation_matrix(self) -> np.ndarray:
+        """Dense matrix mapping direct changes to total changes, for vectorized callers."""
+        matrix = np.eye(len(self.names))
+        for node in self.order:
+            if self.dependencies[node]:
+                matrix[node] += matrix[self.dependencies[node]].sum(axis=0) / len(self.dependencies[node])
+        return matrix
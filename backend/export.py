@@ -0,0 +1,193 @@
+"""Columnar export of every stored history, for analysis outside the server.
+
+Each row is one cycle of one game: simulation_id, timeline, cycle, and a float64 column per
+parameter and metric series. Games are read from the series table a chunk of cycles at a time, so memory stays
+flat however long the campaigns are. Files are partitioned by the day a game was created:
+
+    <out>/created=YYYY-MM-DD/part-<run>.parquet   (or .arrow)
+
+<out>/manifest.json keeps the last exported cycle of every game, and each run only exports the
+cycles after it. A game restored to an earlier snapshot starts a new timeline and is exported
+again from its first cycle; rows of its older timelines are superseded, so readers keep only
+the highest timeline of each game. pyarrow is needed to write files; it is imported on first use.
+
+    python backend/export.py --db simulation.db --out exports [--format parquet|arrow]
+"""
+from typing import Dict, Iterator, List, Tuple
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+from database import DatabaseManager, SELECT_SERIES_SQL
+
+FORMATS = {"parquet": "parquet", "arrow": "arrow"}  # format -> file extension
+MANIFEST = "manifest.json"
+MANIFEST_VERSION = 2
+
+SELECT_SERIES_IDS_SQL = "SELECT series_id, name FROM series_names ORDER BY name"
+SELECT_EXPORT_GAMES_SQL = "SELECT id, created_at, last_cycle, timeline FROM games WHERE archive IS NULL ORDER BY created_at, id"
+
+_export_lock = threading.Lock()
+
+
+def load_manifest(out_dir: str) -> Dict:
+    try:
+        with open(os.path.join(out_dir, MANIFEST)) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return {"version": MANIFEST_VERSION, "games": {}, "timelines": {}, "runs": []}
+    if manifest.get("version", 0) > MANIFEST_VERSION:
+        raise ValueError(f"Export manifest has version {manifest['version']}, newer than the supported {MANIFEST_VERSION}")
+    # Version 1 manifests predate timelines; everything they exported was the first timeline
+    manifest.setdefault("timelines", {})
+    manifest["version"] = MANIFEST_VERSION
+    return manifest
+
+
+def save_manifest(out_dir: str, manifest: Dict):
+    fd, temporary = tempfile.mkstemp(dir=out_dir, prefix=".tmp-")
+    with os.fdopen(fd, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(temporary, os.path.join(out_dir, MANIFEST))
+
+
+def export_series(db_manager: DatabaseManager) -> List[Tuple[int, str]]:
+    # (series_id, name) of every series, in column order
+    db_manager.flush()
+    with db_manager.pool.reading() as cursor:
+        return cursor.execute(SELECT_SERIES_IDS_SQL).fetchall()
+
+
+def iter_batches(db_manager: DatabaseManager, exported: Dict[str, int], series: List[Tuple[int, str]],
+                 chunk_cycles: int = 4096, timelines: Dict[str, int] = None) -> Iterator[Tuple[str, str, int, int, Dict[str, List]]]:
+    """Yield (partition, simulation id, timeline, last cycle read, columns) for the cycles after exported[id].
+
+    A game whose timeline is not timelines[id] was rewound since, and is read from its first cycle.
+    Every batch covers at most chunk_cycles cycles of one game and has a column for each of the
+    given series, with None where a game has no value.
+    """
+    timelines = timelines or {}
+    with db_manager.pool.reading() as cursor:
+        games = cursor.execute(SELECT_EXPORT_GAMES_SQL).fetchall()
+
+    for simulation_id, created_at, last_cycle, timeline in games:
+        partition = "created=" + time.strftime("%Y-%m-%d", time.gmtime(created_at))
+        after = exported.get(simulation_id, -1) if timelines.get(simulation_id, 0) == timeline else -1
+        while after < last_cycle:
+            to_cycle = min(after + chunk_cycles, last_cycle)
+            values = {}
+            # One range read per series follows the (simulation_id, series_id, cycle) key
+            with db_manager.pool.reading() as cursor:
+                for series_id, name in series:
+                    for _, cycle, value in cursor.execute(SELECT_SERIES_SQL, (simulation_id, series_id, after + 1, to_cycle)):
+                        values.setdefault(cycle, {})[name] = value
+            if values:
+                cycles = sorted(values)
+                columns = {"simulation_id": [simulation_id] * len(cycles), "timeline": [timeline] * len(cycles), "cycle": cycles}
+                for _, name in series:
+                    columns[name] = [values[cycle].get(name) for cycle in cycles]
+                yield partition, simulation_id, timeline, to_cycle, columns
+            after = to_cycle
+
+
+class PartitionWriters:
+    # One open file per partition for the length of a run; files appear under their final names on close
+    def __init__(self, out_dir: str, file_format: str, names: List[str], run_id: str):
+        try:
+            import pyarrow
+        except ImportError:
+            raise RuntimeError("Exporting histories needs the pyarrow package: pip install pyarrow")
+        self.pa = pyarrow
+        self.out_dir = out_dir
+        self.file_format = file_format
+        self.run_id = run_id
+        self.schema = pyarrow.schema([("simulation_id", pyarrow.string()), ("timeline", pyarrow.int64()), ("cycle", pyarrow.int64())] +
+                                     [(name, pyarrow.float64()) for name in names])
+        self.open = {}  # partition -> (writer, sink or None, temporary path, final path)
+
+    def write(self, partition: str, columns: Dict[str, List]):
+        if partition not in self.open:
+            directory = os.path.join(self.out_dir, partition)
+            os.makedirs(directory, exist_ok=True)
+            final = os.path.join(directory, f"part-{self.run_id}.{FORMATS[self.file_format]}")
+            temporary = os.path.join(directory, f".tmp-part-{self.run_id}")
+            if self.file_format == "parquet":
+                import pyarrow.parquet
+                self.open[partition] = (pyarrow.parquet.ParquetWriter(temporary, self.schema, compression="zstd"), None, temporary, final)
+            else:
+                sink = self.pa.OSFile(temporary, "wb")
+                self.open[partition] = (self.pa.ipc.new_file(sink, self.schema), sink, temporary, final)
+        self.open[partition][0].write_table(self.pa.Table.from_pydict(columns, schema=self.schema))
+
+    def close(self, keep: bool = True) -> List[str]:
+        files = []
+        for writer, sink, temporary, final in self.open.values():
+            writer.close()
+            if sink is not None:
+                sink.close()
+            if keep:
+                os.replace(temporary, final)
+                files.append(os.path.relpath(final, self.out_dir))
+            else:
+                os.remove(temporary)
+        self.open = {}
+        return files
+
+
+def export(db_manager: DatabaseManager, out_dir: str, file_format: str = "parquet", chunk_cycles: int = 4096) -> Dict:
+    """Export the cycles stored since the last run and report what was written."""
+    if file_format not in FORMATS:
+        raise ValueError(f"Unknown export format '{file_format}', expected one of {', '.join(FORMATS)}")
+    with _export_lock:
+        os.makedirs(out_dir, exist_ok=True)
+        manifest = load_manifest(out_dir)
+        exported = dict(manifest["games"])
+        timelines = dict(manifest["timelines"])
+        run_id = time.strftime("%Y%m%dT%H%M%S", time.gmtime()) + "-" + uuid.uuid4().hex[:8]
+        series = export_series(db_manager)
+        names = [name for _, name in series]
+        writers = PartitionWriters(out_dir, file_format, names, run_id)
+        rows = 0
+        try:
+            for partition, simulation_id, timeline, last_cycle, columns in iter_batches(db_manager, manifest["games"], series, chunk_cycles,
+                                                                                      manifest["timelines"]):
+                writers.write(partition, columns)
+                exported[simulation_id] = last_cycle
+                timelines[simulation_id] = timeline
+                rows += len(columns["cycle"])
+        except BaseException:
+            writers.close(keep=False)
+            raise
+        files = writers.close()
+
+        # The watermark moves only after the files are complete
+        games = sum(1 for simulation_id, cycle in exported.items() if manifest["games"].get(simulation_id) != cycle)
+        rewound = sum(1 for simulation_id, timeline in timelines.items() if manifest["timelines"].get(simulation_id, 0) != timeline)
+        run = {"run": run_id, "format": file_format, "finished_at": time.time(), "games": games, "rewound": rewound, "rows": rows,
+               "files": files}
+        manifest.update(games=exported, timelines=timelines, columns=names)
+        manifest["runs"].append(run)
+        save_manifest(out_dir, manifest)
+        return run
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export stored simulation histories to partitioned Parquet or Arrow files")
+    parser.add_argument("--db", default=os.environ.get("SIMULATION_DB", "simulation.db"))
+    parser.add_argument("--out", default=os.environ.get("SIMULATION_EXPORT_DIR", "exports"))
+    parser.add_argument("--format", choices=sorted(FORMATS), default="parquet")
+    parser.add_argument("--chunk-cycles", type=int, default=4096)
+    args = parser.parse_args(argv)
+    db_manager = DatabaseManager(args.db, write_behind=False)
+    try:
+        print(json.dumps(export(db_manager, args.out, args.format, args.chunk_cycles), indent=1))
+    finally:
+        db_manager.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+from typing import Dict
+
+
+class HistoryTracker:
+    """Remembers what was last stored for each simulation, so a cycle can be saved as a delta.
+
+    A delta holds only what a cycle can change: the cycle number, influence, the values of the
+    parameters in `changes`, the metrics that differ from the last stored cycle and the
+    sentiments that moved. Everything else only changes through a new keyframe.
+    """
+
+    def __init__(self):
+        self.last = {}  # simulation id -> (cycle of the last keyframe, metrics, sentiments)
+
+    def forget(self, simulation_id: str):
+        self.last.pop(simulation_id, None)
+
+    def keyframe(self, state, keyframe_cycle: int):
+        self.last[state.id] = (keyframe_cycle, dict(state.metrics), sentiments_of(state))
+
+    def base_cycle(self, simulation_id: str):
+        # Cycle of the keyframe the next delta builds on, or None when a keyframe is due
+        last = self.last.get(simulation_id)
+        return last[0] if last is not None else None
+
+    def delta(self, state, changes: Dict[str, float]) -> Dict:
+        keyframe_cycle, metrics, sentiments = self.last[state.id]
+        current_sentiments = sentiments_of(state)
+        delta = {
+            "cycle": state.cycle,
+            "influence": state.influence,
+            "parameters": {name: state.parameters[name].value for name in changes if name in state.parameters},
+            "metrics": {name: value for name, value in state.metrics.items() if metrics.get(name) != value},
+            "sentiments": {name: value for name, value in current_sentiments.items() if sentiments.get(name) != value},
+        }
+        self.last[state.id] = (keyframe_cycle, dict(state.metrics), current_sentiments)
+        return delta
+
+
+def sentiments_of(state) -> Dict[str, float]:
+    return {name: group.sentiment for name, group in state.citizen_groups.items()}
+
+
+def apply_delta(state_dict: Dict, delta: Dict) -> Dict:
+    """Apply one stored delta to a state dictionary in place and return it."""
+    state_dict["cycle"] = delta["cycle"]
+    state_dict["influence"] = delta["influence"]
+    for name, value in delta["parameters"].items():
+        state_dict["parameters"][name]["value"] = value
+    state_dict["metrics"].update(delta["metrics"])
+    for name, sentiment in delta["sentiments"].items():
+        state_dict["citizen_groups"][name]["sentiment"] = sentiment
+    return state_dict
+
+
+def diff_states(old: Dict, new: Dict) -> Dict:
+    """Delta that turns state dictionary old into new, also when cycles were skipped in between."""
+    return {
+        "cycle": new["cycle"],
+        "influence": new["influence"],
+        "parameters": {name: parameter["value"] for name, parameter in new["parameters"].items()
+                       if old["parameters"].get(name, {}).get("value") != parameter["value"]},
+        "metrics": {name: value for name, value in new["metrics"].items() if old["metrics"].get(name) != value},
+        "sentiments": {name: group["sentiment"] for name, group in new["citizen_groups"].items()
+                       if old["citizen_groups"].get(name, {}).get("sentiment") != group["sentiment"]},
+    }
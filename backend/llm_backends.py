@@ -0,0 +1,163 @@
+from typing import Any, Dict, List, Optional
+import hashlib
+import os
+import threading
+import time
+
+import requests
+from langchain.callbacks.manager import CallbackManager, CallbackManagerForLLMRun
+from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
+from langchain.llms.base import LLM
+
+FAKE_ANSWERS = [
+    "We should hold the course and watch the numbers closely. :thinking_face:",
+    "The people are restless; a careful reform would calm them. :worried:",
+    "Our economy can carry a bold move this cycle. :rocket:",
+    "Let us invest where it lasts: schools, hospitals and roads. :building_construction:",
+]
+
+
+class FakeLLM(LLM):
+    """A model that needs no network: the same prompt always gets the same answer.
+
+    Waits first_token_ms before the first token and token_ms before each one after it, and
+    streams the answer word by word to the callbacks, so it stands in for a real model in
+    load tests of the whole request path.
+    """
+
+    answers: List[str] = FAKE_ANSWERS
+    first_token_ms: float = 0.0
+    token_ms: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "simulation-fake"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {"first_token_ms": self.first_token_ms, "token_ms": self.token_ms}
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs) -> str:
+        digest = hashlib.sha256(prompt.encode("utf-8")).digest()
+        answer = self.answers[int.from_bytes(digest[:4], "big") % len(self.answers)]
+        time.sleep(self.first_token_ms / 1000)
+        for position, word in enumerate(answer.split(" ")):
+            if position:
+                time.sleep(self.token_ms / 1000)
+            if run_manager:
+                run_manager.on_llm_new_token(" " + word if position else word, verbose=self.verbose)
+        return answer
+
+
+def pooled_session(pool_size=None):
+    # Keeps connections to the model API open between calls, one per concurrent LLM call
+    pool_size = int(pool_size or os.environ.get("SIMULATION_LLM_THREADS", "8"))
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class LLMBackend:
+    """Where the assistants' model comes from. llm() builds it on first use and shares it.
+
+    Backends whose model is slow to load set preload, and the server calls load() on startup.
+    """
+
+    name = None
+    preload = False
+
+    def __init__(self):
+        self._llm = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self._llm is None:
+            with self._lock:
+                if self._llm is None:
+                    self._llm = self.build()
+        return self._llm
+
+    def llm(self):
+        return self.load()
+
+    def build(self):
+        raise NotImplementedError
+
+
+class OpenAIBackend(LLMBackend):
+    # The hosted model, reached through one pooled HTTP session
+    name = "openai"
+
+    def build(self):
+        from langchain import OpenAI
+        import openai
+        openai.requestssession = pooled_session()
+        return OpenAI(model=os.environ.get("SIMULATION_OPENAI_MODEL", "text-davinci-003"),
+                      temperature=0,
+                      max_tokens=3000,
+                      callback_manager=CallbackManager([StreamingStdOutCallbackHandler()]),
+                      streaming=True)
+
+
+class LlamaCppBackend(LLMBackend):
+    # A local model file, loaded once and shared by every session
+    name = "llamacpp"
+    preload = True
+
+    def build(self):
+        model_path = os.environ.get("SIMULATION_LLAMA_MODEL_PATH")
+        if not model_path:
+            raise RuntimeError("The llamacpp backend needs SIMULATION_LLAMA_MODEL_PATH set to a model file")
+        try:
+            import llama_cpp  # noqa: F401
+        except ImportError:
+            raise RuntimeError("The llamacpp backend needs the llama-cpp-python package: pip install llama-cpp-python")
+        from langchain import LlamaCpp
+        return LlamaCpp(model_path=model_path,
+                        temperature=0,
+                        n_ctx=int(os.environ.get("SIMULATION_LLAMA_CONTEXT", "2048")),
+                        n_gpu_layers=int(os.environ.get("SIMULATION_LLAMA_GPU_LAYERS", "1")),  # depends on the model and the GPU memory
+                        n_batch=int(os.environ.get("SIMULATION_LLAMA_BATCH", "512")),  # between 1 and n_ctx
+                        f16_kv=True,
+                        streaming=True)
+
+
+class FakeBackend(LLMBackend):
+    # Deterministic answers with configurable latency, for offline runs and load tests
+    name = "fake"
+
+    def __init__(self, first_token_ms: float = None, token_ms: float = None):
+        super().__init__()
+        self.first_token_ms = float(first_token_ms if first_token_ms is not None else os.environ.get("SIMULATION_FAKE_LLM_FIRST_TOKEN_MS", "0"))
+        self.token_ms = float(token_ms if token_ms is not None else os.environ.get("SIMULATION_FAKE_LLM_TOKEN_MS", "0"))
+
+    def build(self):
+        return FakeLLM(first_token_ms=self.first_token_ms, token_ms=self.token_ms)
+
+
+BACKENDS = {backend.name: backend for backend in (OpenAIBackend, LlamaCppBackend, FakeBackend)}
+
+# The backend of this process, chosen by SIMULATION_LLM_BACKEND
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend() -> LLMBackend:
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                name = os.environ.get("SIMULATION_LLM_BACKEND", "openai")
+                if name not in BACKENDS:
+                    raise ValueError(f"Unknown LLM backend '{name}', expected one of {', '.join(BACKENDS)}")
+                _backend = BACKENDS[name]()
+    return _backend
+
+
+def set_backend(backend: Optional[LLMBackend]):
+    # Swap the process-wide backend, e.g. in tests; None picks it from the environment again
+    global _backend
+    with _backend_lock:
+        _backend = backend
@@ -1,20 +1,71 @@
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, HTTPException, Query, Response, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from jose import JWTError, jwt
 from datetime import timedelta
 from sqlalchemy.orm import Session
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, confloat
+from typing import Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
+import itertools
+import json
 import uvicorn
 import logging
 import os
 
 from simulation_logic import SimulationController
-from database import Session, User, engine, SessionLocal, Base
+from sessions import SessionRegistry
+import rollouts
+from compaction import Compactor
+from snapshots import snapshot_store
+from agent import TokenQueueHandler
+import llm_backends
+import export
+from catalog import catalog
+from database import Session, User, engine, SessionLocal, Base, DatabaseManager
 from auth import create_access_token, get_password_hash, verify_password, Token, TokenData, ACCESS_TOKEN_EXPIRE_MINUTES, ALGORITHM, SECRET_KEY
 
 app = FastAPI()
 
+# Blocking work runs on bounded thread pools so the event loop keeps serving fast requests.
+# Database and CPU work, LLM calls and rollouts get separate pools, so slow completions or
+# long rollouts cannot starve cycles.
+worker_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("SIMULATION_WORKER_THREADS", "4")), thread_name_prefix="simulation-worker")
+llm_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("SIMULATION_LLM_THREADS", "8")), thread_name_prefix="simulation-llm")
+rollout_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("SIMULATION_ROLLOUT_THREADS", "2")), thread_name_prefix="simulation-rollout")
+
+async def run_blocking(executor, func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+@app.on_event("startup")
+def load_catalog():
+    # Parse every data file once before serving requests
+    catalog.preload()
+    # Start the rollout worker processes once instead of per request
+    rollouts.start_pool()
+    # Load a local model once, before the first question, and share it across sessions
+    backend = llm_backends.get_backend()
+    if backend.preload:
+        backend.load()
+    # Apply the history retention policy in the background; zero switches it off
+    interval = float(os.environ.get("SIMULATION_COMPACTION_INTERVAL", "3600"))
+    if interval > 0:
+        compactor.start(interval)
+
+@app.on_event("shutdown")
+def shutdown_executors():
+    worker_executor.shutdown(wait=True)
+    llm_executor.shutdown(wait=True)
+    rollout_executor.shutdown(wait=True)
+    rollouts.shutdown_pool()
+    compactor.stop()
+    # Commit the cycles still queued for the database
+    db_manager.close()
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # Allows all origins
@@ -23,7 +74,26 @@ app.add_middleware(
     allow_headers=["*"],  # Allows all headers
 )
 
-simulation_controller = SimulationController()
+db_manager = DatabaseManager(os.environ.get("SIMULATION_DB", "simulation.db"))
+
+# The lobby controller serves the catalogs and validates choices; it never holds a game
+simulation_controller = SimulationController(db_manager=db_manager)
+
+# Every started game gets its own controller, keyed by its state id
+sessions = SessionRegistry(max_sessions=int(os.environ.get("SIMULATION_MAX_SESSIONS", "256")))
+
+# Downsamples and archives old history; games with a live session are left alone
+compactor = Compactor(db_manager, active_ids=sessions.session_ids)
+
+def get_session(session_id: str) -> SimulationController:
+    try:
+        return sessions.get(session_id)
+    except KeyError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"No simulation session '{session_id}'")
+
+def validate_choice(filename: str, choice: int, kind: str):
+    if choice < 1 or choice > len(catalog.read(filename)):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid {kind} number")
 
 # Define a Pydantic model for Decision
 class DecisionModel(BaseModel):
@@ -32,6 +102,19 @@ class DecisionModel(BaseModel):
 class QueryModel(BaseModel):
     query: str
 
+class RolloutPolicyModel(BaseModel):
+    type: str = "uniform"  # "sequence", "uniform" or "weighted"
+    decisions: Optional[List[str]] = None
+    weights: Optional[Dict[str, float]] = None
+
+class RolloutModel(BaseModel):
+    policy: RolloutPolicyModel = RolloutPolicyModel()
+    cycles: int = Field(10, ge=1, le=1000)
+    trials: int = Field(1000, ge=1, le=100000)
+    seed: int = Field(0, ge=0)
+    metrics: Optional[List[str]] = None
+    percentiles: Optional[List[confloat(ge=0, le=100)]] = Field(None, min_items=1, max_items=101)
+
 """
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
@@ -123,100 +206,301 @@ async def index():
     return {"status": "ok"}
 
 @app.get("/simulation/start")
-async def start_simulation():
-    simulation_controller.start_simulation()
-    return {"status": "Simulation started"}
-
-@app.post("/simulation/stop")
-async def stop_simulation():
-    simulation_controller.stop_simulation()
-    return {"status": "Simulation stopped"}
+async def start_simulation(assistant_choice: Optional[int] = None, country_choice: Optional[int] = None, narrative_choice: Optional[int] = None):
+    # Each game is started from the choices passed with the request
+    def start():
+        controller = SimulationController(db_manager=db_manager)
+        if assistant_choice is not None:
+            controller.set_assistant(assistant_choice)
+        if country_choice is not None:
+            controller.set_country(country_choice)
+        if narrative_choice is not None:
+            controller.set_narrative(narrative_choice)
+        controller.start_simulation()
+        # Registering may evict and stop another session, which waits for its cycle to finish
+        return sessions.add(controller)
 
+    try:
+        session_id = await run_blocking(worker_executor, start)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    return {"status": "Simulation started", "session_id": session_id}
+
+# Routes to run the history compaction now, or to see what its last run did
+@app.post("/simulation/compaction")
+async def run_compaction():
+    report = await run_blocking(worker_executor, compactor.run)
+    return {"report": report}
+
+@app.get("/simulation/compaction")
+async def compaction_report():
+    return {"report": compactor.last_report}
+
+# Route to export the history added since the last export as partitioned Parquet or Arrow files
+@app.post("/simulation/export")
+async def export_histories(format: str = "parquet"):
+    out_dir = os.environ.get("SIMULATION_EXPORT_DIR", "exports")
+    try:
+        run = await run_blocking(worker_executor, export.export, db_manager, out_dir, format)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=status.HTTP_501_NOT_IMPLEMENTED, detail=str(e))
+    return {"export": run}
+
+# Route to see how often assistant answers come from the response cache
+@app.get("/simulation/response_cache")
+async def response_cache_stats():
+    cache = simulation_controller.responses
+    return {"response_cache": cache.stats() if cache is not None else None}
+
+@app.get("/simulation/sessions")
+async def list_sessions():
+    return {"sessions": sessions.session_ids(), "max_sessions": sessions.max_sessions, "evictions": sessions.evictions}
+
+# The catalog routes send bytes serialized once per version of the data file
 @app.get("/load_assistants")
 async def load_assistants():
-    assistants = simulation_controller.load_assistants()
-    # Convert the assistants to a form that can be sent as JSON
-    assistant_dicts = [{"name": assistant.name, "age": assistant.age, "style": assistant.style, "traits": assistant.traits, "backstory": assistant.backstory} for assistant in assistants]
-    return {"assistants": assistant_dicts}
+    body = catalog.response_bytes("assistants", "data/assistants.json", lambda assistants: {
+        "assistants": [{"name": assistant["name"], "age": assistant["age"], "style": assistant["style"], "traits": assistant["traits"], "backstory": assistant["backstory"]} for assistant in assistants]
+    })
+    return Response(content=body, media_type="application/json")
 
 @app.get("/load_narratives")
 async def load_narratives():
-    narratives = simulation_controller.load_narratives()
-    # Convert the narratives to a form that can be sent as JSON
-    narrative_dicts = [{"name": narrative.name, "description": narrative.description, "effects": narrative.effects} for narrative in narratives]
-    return {"narratives": narrative_dicts}
+    body = catalog.response_bytes("narratives", "data/narratives.json", lambda narratives: {
+        "narratives": [{"name": narrative["name"], "description": narrative["description"], "effects": narrative["effects"]} for narrative in narratives]
+    })
+    return Response(content=body, media_type="application/json")
 
 @app.get("/load_countries")
 async def load_countries():
-    countries = simulation_controller.load_countries()
-    countries_dict = [{"name": country} for country in countries]
-    return {"countries": countries_dict}
+    body = catalog.response_bytes("countries", "data/countries.json", lambda countries: {
+        "countries": [{"name": country["name"]} for country in countries]
+    })
+    return Response(content=body, media_type="application/json")
 
+# The set_* routes only check a choice; pass it to /simulation/start to use it
 @app.get("/set_assistant/{assistant_choice}")
 async def set_assistant(assistant_choice: int):
-    simulation_controller.set_assistant(assistant_choice)
+    validate_choice("data/assistants.json", assistant_choice, "assistant")
     return {"message": "Assistant set"}
 
 @app.get("/set_narrative/{narrative_choice}")
 async def set_narrative(narrative_choice: int):
-    simulation_controller.set_narrative(narrative_choice)
+    validate_choice("data/narratives.json", narrative_choice, "narrative")
     return {"message": "Narrative set"}
 
 @app.get("/set_country/{country_choice}")
 async def set_country(country_choice: int):
-    simulation_controller.set_country(country_choice)
+    validate_choice("data/countries.json", country_choice, "country")
     return {"message": "Country set"}
 
-@app.get("/simulation/state")
-async def get_simulation_state():
-    state = simulation_controller.get_state()
+@app.get("/simulation/load/{state_id}")
+async def load_states(state_id: str):
+    state_history = await run_blocking(worker_executor, simulation_controller.load_states, state_id)
+    return {"status": state_history}
+
+@app.get("/simulation/load/{state_id}/{cycle}")
+async def load_state(state_id: str, cycle: int):
+    # Rebuilds one cycle from its nearest keyframe instead of the whole history
+    state = await run_blocking(worker_executor, simulation_controller.load_state, state_id, cycle)
+    if state is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"No cycle {cycle} stored for '{state_id}'")
+    return {"status": state}
+
+# Route to read a few parameter or metric series of a stored game as compact arrays
+@app.get("/simulation/{simulation_id}/series")
+async def load_series(simulation_id: str, names: Optional[str] = None, from_cycle: Optional[int] = Query(None, alias="from"), to_cycle: Optional[int] = Query(None, alias="to")):
+    # names is a comma separated list such as "metrics.Quality of Life,parameters.Economy"
+    series_names = [name.strip() for name in names.split(",") if name.strip()] if names else None
+    try:
+        series = await run_blocking(worker_executor, simulation_controller.load_series, simulation_id, series_names, from_cycle, to_cycle)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    return series
+
+HISTORY_STREAM_BATCH = 256
+
+def ndjson_chunk(records, count):
+    return "".join(json.dumps(record) + "\n" for record in itertools.islice(records, count))
+
+# Route to browse the stored history of a game a page at a time, or to stream it as NDJSON
+@app.get("/simulation/{simulation_id}/history")
+async def load_history(simulation_id: str, cursor: Optional[int] = None, limit: int = Query(100, ge=1, le=1000),
+                       from_cycle: Optional[int] = Query(None, alias="from"), to_cycle: Optional[int] = Query(None, alias="to"),
+                       fields: Optional[str] = None, format: str = "json"):
+    # fields is "metrics" or "parameters" to leave out the rest of each state
+    if format == "ndjson":
+        try:
+            records = await run_blocking(worker_executor, simulation_controller.iter_history, simulation_id, from_cycle, to_cycle, fields)
+        except ValueError as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+        async def lines():
+            # A batch of rows per hop to the worker pool; the rest of the history stays in SQLite
+            try:
+                while True:
+                    chunk = await run_blocking(worker_executor, ndjson_chunk, records, HISTORY_STREAM_BATCH)
+                    if not chunk:
+                        return
+                    yield chunk
+            finally:
+                records.close()
+
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+    if format != "json":
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unknown history format '{format}'")
+    try:
+        return await run_blocking(worker_executor, simulation_controller.load_history_page, simulation_id, cursor, limit, from_cycle, to_cycle, fields)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+@app.post("/simulation/{session_id}/stop")
+async def stop_simulation(session_id: str):
+    controller = get_session(session_id)
+    sessions.remove(session_id)
+    await run_blocking(worker_executor, controller.stop_simulation)
+    return {"status": "Simulation stopped"}
+
+@app.get("/simulation/{session_id}/state")
+async def get_simulation_state(session_id: str):
+    state = await run_blocking(worker_executor, get_session(session_id).get_state)
     return {"state": state}
 
-@app.post("/simulation/decision")
-async def make_decision(decision: DecisionModel):
+@app.post("/simulation/{session_id}/decision")
+async def make_decision(session_id: str, decision: DecisionModel):
     decision_name = decision.decision_name
-    simulation_controller.make_decision(decision_name)
+    try:
+        await run_blocking(worker_executor, get_session(session_id).make_decision, decision_name)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
     return {"message": f"Decision {decision_name} submitted"}
 
-@app.post("/simulation/save")
-async def save_state():
-    simulation_controller.save_game_state()
-    return {"status": "Simulation state saved"}
-
-@app.get("/simulation/load/{state_id}")
-async def load_states(state_id: str):
-    state_history = simulation_controller.load_states(state_id)
-    return {"status": state_history}
+@app.post("/simulation/{session_id}/save")
+async def save_state(session_id: str, ref: str = "saved"):
+    try:
+        snapshot = await run_blocking(worker_executor, get_session(session_id).save_game_state, ref)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    return {"status": "Simulation state saved", "snapshot": snapshot}
+
+# Route to continue a game from one of its snapshots, as a live session again
+@app.post("/simulation/{simulation_id}/restore")
+async def restore_state(simulation_id: str, ref: str = "saved"):
+    def restore():
+        if snapshot_store.latest(simulation_id, ref) is None:
+            return None
+        # A session still running under this id is stopped first, which waits for a cycle in progress;
+        # a cycle saved after the rewind would mix the old timeline into the restored game
+        previous = sessions.remove(simulation_id)
+        # The restored game talks on from the replaced session's conversation
+        controller = SimulationController(db_manager=db_manager, conversation=previous.conversation if previous is not None else None)
+        if previous is not None:
+            try:
+                previous.stop_simulation()
+            except Exception:
+                logging.exception(f"Failed to write out session {simulation_id} before restoring it")
+        if controller.restore_game_state(simulation_id, ref) is None:
+            return None
+        return sessions.add(controller)
 
-@app.get("/simulation/next_cycle")
-async def next_cycle():
-    simulation_controller.next_cycle()
+    try:
+        session_id = await run_blocking(worker_executor, restore)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    if session_id is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"No snapshot '{ref}' of '{simulation_id}'")
+    return {"status": "Simulation restored", "session_id": session_id}
+
+@app.get("/simulation/{session_id}/next_cycle")
+async def next_cycle(session_id: str):
+    try:
+        await run_blocking(worker_executor, get_session(session_id).next_cycle)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
     return {"status": "Next cycle started"}
 
-@app.get("/simulation/news")
-async def fetch_news():
-    news_event = simulation_controller.fetch_news()
+@app.get("/simulation/{session_id}/news")
+async def fetch_news(session_id: str):
+    try:
+        news_event = await run_blocking(llm_executor, get_session(session_id).fetch_news)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
     return {"news_event": news_event}
 
 # Route to generate a decision based on news
-@app.get("/simulation/generate_decision")
-async def generate_decision():
-    news_event = simulation_controller.fetch_news()
-    decision = simulation_controller.assistant.generate_decision(news_event)
+@app.get("/simulation/{session_id}/generate_decision")
+async def generate_decision(session_id: str):
+    controller = get_session(session_id)
+    try:
+        news_event = await run_blocking(llm_executor, controller.fetch_news)
+        decision = await run_blocking(llm_executor, controller.generate_decision, news_event)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
     return {"decision": decision}
 
 # Route to get calculated vote share
-@app.get("/simulation/get_vote_share")
-async def get_vote_share():
-    result = simulation_controller.get_vote_share()
+@app.get("/simulation/{session_id}/get_vote_share")
+async def get_vote_share(session_id: str):
+    try:
+        result = await run_blocking(worker_executor, get_session(session_id).get_vote_share)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    return {"result": result}
+
+# Route to simulate future cycles of a decision policy and summarize the outcomes
+@app.post("/simulation/{session_id}/rollouts")
+async def run_rollouts(session_id: str, rollout: RolloutModel):
+    controller = get_session(session_id)
+    try:
+        result = await run_blocking(rollout_executor, controller.run_rollouts, rollout.policy.dict(), cycles=rollout.cycles, trials=rollout.trials,
+                                    seed=rollout.seed, metrics=rollout.metrics, percentiles=rollout.percentiles)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
     return {"result": result}
 
 # Route to generate assistant's response
-@app.post("/simulation/generate_response")
-async def generate_response(query_model: QueryModel):
-    response = simulation_controller.generate_response(query_model.query)
+@app.post("/simulation/{session_id}/generate_response")
+async def generate_response(session_id: str, query_model: QueryModel):
+    try:
+        response = await run_blocking(llm_executor, get_session(session_id).generate_response, query_model.query)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
     return {"response": response}
 
+# Route to stream the assistant's answer as NDJSON: {"token": ...} lines while it is generated,
+# then one {"response": ...} line with the whole answer
+@app.post("/simulation/{session_id}/generate_response/stream")
+async def stream_response(session_id: str, query_model: QueryModel):
+    controller = get_session(session_id)
+    loop = asyncio.get_running_loop()
+    tokens = asyncio.Queue()
+    handler = TokenQueueHandler(loop, tokens)
+    answer = loop.run_in_executor(llm_executor, functools.partial(controller.generate_response, query_model.query, callbacks=[handler]))
+
+    async def lines():
+        try:
+            while not answer.done():
+                next_token = asyncio.ensure_future(tokens.get())
+                done, _ = await asyncio.wait({next_token, answer}, return_when=asyncio.FIRST_COMPLETED)
+                if next_token in done:
+                    yield json.dumps({"token": next_token.result()}) + "\n"
+                else:
+                    next_token.cancel()
+            # Tokens are queued before the answer completes, so whatever is left came first
+            while not tokens.empty():
+                yield json.dumps({"token": tokens.get_nowait()}) + "\n"
+            try:
+                yield json.dumps({"response": answer.result()}) + "\n"
+            except ValueError as e:
+                yield json.dumps({"error": str(e)}) + "\n"
+        finally:
+            # Also runs when the client disconnects: the generation stops at its next token
+            handler.cancel()
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
 if __name__ == "__main__":
     #Base.metadata.create_all(bind=engine)
     uvicorn.run(app, host="localhost", port=8000)
@@ -0,0 +1,101 @@
+from typing import Any, Callable, Dict, List, Tuple
+import os
+import re
+
+from langchain.schema import BaseMemory
+from pydantic import Field
+
+TOKEN = re.compile(r"\w+|[^\w\s]")
+SENTENCE_END = re.compile(r"(?<=[.!?])\s")
+
+
+def count_tokens(text: str) -> int:
+    # Words and punctuation marks; close enough to model tokens to budget with, and needs no tokenizer
+    return len(TOKEN.findall(text))
+
+
+def keep_last_tokens(text: str, max_tokens: int) -> str:
+    # Drop whole words from the start until the text fits
+    words = text.split()
+    while words and count_tokens(" ".join(words)) > max_tokens:
+        words = words[max(1, len(words) // 8):] if len(words) > 64 else words[1:]
+    return " ".join(words)
+
+
+def first_sentence(text: str) -> str:
+    return SENTENCE_END.split(" ".join(text.split()), 1)[0]
+
+
+def extractive_summary(summary: str, turns: List[Tuple[str, str]]) -> str:
+    """The default summarizer: the first sentence of each question and answer, after the old summary."""
+    folded = " ".join(f"Asked: {first_sentence(query)} Answered: {first_sentence(answer)}" for query, answer in turns)
+    return f"{summary} {folded}".strip()
+
+
+def llm_summarizer(llm) -> Callable[[str, List[Tuple[str, str]]], str]:
+    # A summarizer that asks a model; costs one more call each time turns are folded
+    def summarize(summary: str, turns: List[Tuple[str, str]]) -> str:
+        lines = "\n".join(f"Leader: {query}\nAssistant: {answer}" for query, answer in turns)
+        return llm(f"Summary so far: {summary}\n\nNew lines of conversation:\n{lines}\n\n"
+                   "Write a short summary of the whole conversation:").strip()
+    return summarize
+
+
+class ConversationMemory(BaseMemory):
+    """Chat history within a token budget, for one game session.
+
+    The most recent turns are kept as they were said. Once they need more than max_tokens
+    less summary_tokens, the oldest turns are handed to the summarizer and folded
+    into a running summary of at most summary_tokens, which leads the history. The summarizer
+    is any function of (summary so far, [(question, answer), ...]) returning the new summary.
+    """
+
+    memory_key: str = "chat_history"
+    input_key: str = "input"
+    output_key: str = "output"
+    human_prefix: str = "Leader"
+    ai_prefix: str = "Assistant"
+    max_tokens: int = Field(default_factory=lambda: int(os.environ.get("SIMULATION_MEMORY_TOKENS", "1000")))
+    summary_tokens: int = Field(default_factory=lambda: int(os.environ.get("SIMULATION_MEMORY_SUMMARY_TOKENS", "200")))
+    summarizer: Callable[[str, List[Tuple[str, str]]], str] = extractive_summary
+    token_counter: Callable[[str], int] = count_tokens
+    summary: str = ""
+    turns: List[Tuple[str, str, int]] = []  # (question, answer, tokens of both lines)
+    folded: int = 0  # turns folded into the summary so far
+
+    @property
+    def memory_variables(self) -> List[str]:
+        return [self.memory_key]
+
+    def load_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, str]:
+        lines = [f"Earlier in the conversation: {self.summary}"] if self.summary else []
+        for query, answer, _ in self.turns:
+            lines.append(f"{self.human_prefix}: {query}")
+            lines.append(f"{self.ai_prefix}: {answer}")
+        return {self.memory_key: "\n".join(lines)}
+
+    def save_context(self, inputs: Dict[str, Any], outputs: Dict[str, str]) -> None:
+        query, answer = str(inputs[self.input_key]), str(outputs[self.output_key])
+        tokens = self.token_counter(f"{self.human_prefix}: {query}\n{self.ai_prefix}: {answer}")
+        self.turns.append((query, answer, tokens))
+
+        # Fold the oldest turns until the rest fits next to a full summary; the newest turn always stays whole
+        budget = self.max_tokens - self.summary_tokens
+        window = sum(turn[2] for turn in self.turns)
+        fold = 0
+        while fold < len(self.turns) - 1 and window > budget:
+            window -= self.turns[fold][2]
+            fold += 1
+        if fold:
+            summary = self.summarizer(self.summary, [(query, answer) for query, answer, _ in self.turns[:fold]])
+            self.summary = keep_last_tokens(summary, self.summary_tokens)
+            self.turns = self.turns[fold:]
+            self.folded += fold
+
+    def clear(self) -> None:
+        self.summary = ""
+        self.turns = []
+        self.folded = 0
+
+    def tokens(self) -> int:
+        return self.token_counter(self.load_memory_variables({})[self.memory_key])
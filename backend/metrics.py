@@ -1,7 +1,16 @@
+from collections import defaultdict
+from functools import lru_cache
+from typing import Dict, Iterable, List, Tuple
+import logging
+import re
+
+import numpy as np
+
 class Metric:
-    def __init__(self, name: str, calculation_function):
+    def __init__(self, name: str, calculation_function, reads: List[str] = None):
         self.name = name
         self.calculation_function = calculation_function
+        self.reads = reads  # parameter names the metric depends on, inferred from the function when None
 
     def calculate(self, state):
         return self.calculation_function(state)
@@ -124,4 +133,209 @@ def update_metrics_values(state):
         calculation_function = metric_calculation_functions[metric_name]
         state.metrics[metric_name] = calculation_function(state)
 
+class _ProbeParameter:
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+class _ProbeState:
+    # Minimal stand-in for State exposing only parameters, used to probe metric functions
+    def __init__(self, parameter_names):
+        self.parameter_names = list(parameter_names)
+        self.parameters = {name: _ProbeParameter(0.0) for name in self.parameter_names}
+
+    def set_values(self, values):
+        for name, value in zip(self.parameter_names, values):
+            self.parameters[name].value = float(value)
+        return self
+
+class CompiledMetrics:
+    """Metrics compiled into a dense coefficient matrix and a bias vector.
+
+    Row i of coefficients holds the weights of metric_names[i] over parameter_names.
+    Metrics that are not linear in the parameters keep their calculation function in
+    fallback_functions and are evaluated per state.
+    """
+
+    def __init__(self, parameter_names: List[str], metric_names: List[str], coefficients: np.ndarray, bias: np.ndarray, fallback_functions: Dict):
+        self.parameter_names = list(parameter_names)
+        self.metric_names = list(metric_names)
+        self.coefficients = coefficients
+        self.bias = bias
+        self.fallback_functions = fallback_functions
+        self.fallback_columns = [self.metric_names.index(name) for name in fallback_functions]
+
+    def parameter_vector(self, state) -> np.ndarray:
+        # Use the engine's value vector directly when its layout matches
+        engine = getattr(state, "engine", None)
+        if engine is not None and engine.names == self.parameter_names:
+            return engine.values
+        return np.fromiter((state.parameters[name].value for name in self.parameter_names),
+                           dtype=float, count=len(self.parameter_names))
+
+    def evaluate(self, state) -> Dict[str, float]:
+        # All linear metrics of one state come from a single mat-vec product
+        values = self.coefficients @ self.parameter_vector(state) + self.bias
+        metrics = dict(zip(self.metric_names, values.tolist()))
+        for metric_name, calculate_func in self.fallback_functions.items():
+            metrics[metric_name] = calculate_func(state)
+        return metrics
+
+    def evaluate_batch(self, parameter_values: np.ndarray) -> np.ndarray:
+        # Evaluate an (N states x P parameters) array into an (N x M) metrics array
+        parameter_values = np.atleast_2d(np.asarray(parameter_values, dtype=float))
+        if parameter_values.shape[1] != len(self.parameter_names):
+            raise ValueError(f"Expected {len(self.parameter_names)} parameter columns, got {parameter_values.shape[1]}")
+
+        results = parameter_values @ self.coefficients.T + self.bias
+        if self.fallback_functions:
+            probe = _ProbeState(self.parameter_names)
+            for row, values in enumerate(parameter_values):
+                probe.set_values(values)
+                for column, calculate_func in zip(self.fallback_columns, self.fallback_functions.values()):
+                    results[row, column] = calculate_func(probe)
+        return results
+
+    def update(self, state):
+        # Same contract as update_metrics_values: refresh the metrics already in the state
+        metrics = self.evaluate(state)
+        for metric_name in state.metrics.keys():
+            state.metrics[metric_name] = metrics[metric_name]
+
+def _probe_linear(calculate_func, probe: _ProbeState, num_parameters: int, rng) -> Tuple[np.ndarray, float]:
+    # Read the bias at the origin and one coefficient per unit vector
+    unit = np.zeros(num_parameters)
+    bias = float(calculate_func(probe.set_values(unit)))
+    coefficients = np.empty(num_parameters)
+    for i in range(num_parameters):
+        unit[i] = 1.0
+        coefficients[i] = float(calculate_func(probe.set_values(unit))) - bias
+        unit[i] = 0.0
+
+    # Check the linear model against random points to catch non-linear metrics
+    for _ in range(3):
+        point = rng.uniform(-100, 100, num_parameters)
+        expected = float(calculate_func(probe.set_values(point)))
+        if not np.isclose(expected, coefficients @ point + bias, rtol=1e-9, atol=1e-6):
+            raise ValueError("metric is not linear in the parameters")
+    return coefficients, bias
+
+def compile_metrics(parameter_names: List[str], functions: Dict = None) -> CompiledMetrics:
+    """Compile metric functions into a CompiledMetrics, falling back for non-linear ones."""
+    functions = metric_calculation_functions if functions is None else functions
+    parameter_names = list(parameter_names)
+    probe = _ProbeState(parameter_names)
+    rng = np.random.default_rng(0)
+
+    coefficients = np.zeros((len(functions), len(parameter_names)))
+    bias = np.zeros(len(functions))
+    fallback_functions = {}
+    for row, (metric_name, calculate_func) in enumerate(functions.items()):
+        try:
+            coefficients[row], bias[row] = _probe_linear(calculate_func, probe, len(parameter_names), rng)
+        except Exception:
+            # Non-linear metrics and metrics reading more than parameters use the per-function path
+            fallback_functions[metric_name] = calculate_func
 
+    return CompiledMetrics(parameter_names, list(functions.keys()), coefficients, bias, fallback_functions)
+
+@lru_cache(maxsize=None)
+def get_compiled_metrics(parameter_names: Tuple[str, ...]) -> CompiledMetrics:
+    # The built-in metrics only need compiling once per parameter layout
+    return compile_metrics(parameter_names)
+
+class _RecordingParameters(dict):
+    # Records every parameter name a metric function looks up
+    def __init__(self):
+        super().__init__()
+        self.read = set()
+
+    def __getitem__(self, name):
+        self.read.add(name)
+        return _ProbeParameter(1.0)
+
+    def get(self, name, default=None):
+        return self[name]
+
+class _RecordingState:
+    def __init__(self):
+        self.parameters = _RecordingParameters()
+
+def infer_metric_reads(calculate_func):
+    """Return the parameter names a metric function reads, or None if they cannot be inferred."""
+    state = _RecordingState()
+    try:
+        calculate_func(state)
+    except Exception:
+        return None
+    return frozenset(state.parameters.read)
+
+class MetricDependencyIndex:
+    """Maps each parameter name to the metrics that read it.
+
+    Reads are taken from declared_reads when given and otherwise inferred by running the
+    function once against a recording state, which assumes the function does not branch
+    on parameter values. Metrics whose reads are unknown or empty, such as those reading
+    other parts of the state, are recomputed on every update.
+    """
+
+    def __init__(self, functions: Dict = None, declared_reads: Dict[str, Iterable[str]] = None):
+        self.functions = metric_calculation_functions if functions is None else functions
+        declared_reads = declared_reads or {}
+        self.by_parameter = defaultdict(set)
+        self.always = set()
+        for metric_name, calculate_func in self.functions.items():
+            reads = declared_reads.get(metric_name)
+            reads = infer_metric_reads(calculate_func) if reads is None else frozenset(reads)
+            if not reads:
+                self.always.add(metric_name)
+                continue
+            for parameter_name in reads:
+                self.by_parameter[parameter_name].add(metric_name)
+
+    def affected(self, changed_parameters: Iterable[str]) -> set:
+        affected = set(self.always)
+        for parameter_name in changed_parameters:
+            affected.update(self.by_parameter.get(parameter_name, ()))
+        return affected
+
+    def relevant(self, query: str, metric_names: Iterable[str], parameter_names: Iterable[str]) -> List[str]:
+        """The metrics a question is about, in the given order; all of them when it names none.
+
+        A metric is relevant when the question names it or names a parameter it reads.
+        """
+        metric_names = list(metric_names)
+        asked = word_stems(query)
+        mentioned = [name for name in parameter_names if word_stems(name) & asked]
+        relevant = {name for name in metric_names if word_stems(name) & asked}
+        if mentioned:
+            relevant |= self.affected(mentioned)
+        return [name for name in metric_names if name in relevant] or metric_names
+
+def word_stems(text: str) -> set:
+    # "economy" and "economic" share a stem; short words such as "is" or "the" carry none
+    return {word[:5] for word in re.findall(r"[a-z]+", text.casefold()) if len(word) > 3}
+
+metric_dependency_index = MetricDependencyIndex(
+    metric_calculation_functions,
+    {metric.name: metric.reads for metric in metric_objects if metric.reads is not None}
+)
+
+_unindexed_warned = set()  # metrics outside the index that were already warned about
+
+def update_changed_metrics(state, changed_parameters: Iterable[str], index: MetricDependencyIndex = None) -> int:
+    """Recompute only the metrics that read a changed parameter; return how many were skipped."""
+    index = metric_dependency_index if index is None else index
+    affected = index.affected(changed_parameters)
+    skipped = 0
+    for metric_name in state.metrics.keys():
+        if metric_name in affected:
+            state.metrics[metric_name] = index.functions[metric_name](state)
+        else:
+            if metric_name not in index.functions and metric_name not in _unindexed_warned:
+                # Nothing says when it goes stale, and there is no function to recompute it with
+                _unindexed_warned.add(metric_name)
+                logging.warning(f"Metric '{metric_name}' is not in the dependency index and is never updated")
+            skipped += 1
+    return skipped
@@ -0,0 +1,63 @@
+from typing import List, Tuple
+
+import numpy as np
+
+
+class ParameterEngine:
+    """Keeps every parameter value of a State in one NumPy vector.
+
+    The name-to-index map is fixed when the engine is built, so decision effects can be
+    compiled once into sparse (indices, amounts) pairs and a whole queue of decisions
+    becomes a single vector add.
+    """
+
+    def __init__(self, parameter_names: List[str]):
+        self.names = list(parameter_names)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.values = np.zeros(len(self.names), dtype=float)
+
+    def copy(self):
+        # Same layout, independent values
+        engine = ParameterEngine.__new__(ParameterEngine)
+        engine.names = self.names
+        engine.index = self.index
+        engine.values = self.values.copy()
+        return engine
+
+    def bind(self, state):
+        # Turn the Parameter objects of the state into views over the value vector
+        for name, parameter in state.parameters.items():
+            if name not in self.index:
+                raise ValueError(f"Parameter '{name}' is not known to the parameter engine")
+            parameter.bind(self.values, self.index[name])
+
+        for decision in state.decisions.values():
+            self.compile_decision(decision)
+
+        state.engine = self
+        return state
+
+    def compile_decision(self, decision):
+        # Precompile the effects of a decision into a sparse effect vector
+        indices = np.fromiter((self.index[parameter.name] for parameter in decision.effects),
+                              dtype=np.intp, count=len(decision.effects))
+        amounts = np.fromiter(decision.effects.values(), dtype=float, count=len(decision.effects))
+        decision.compiled_effects = (indices, amounts)
+        return decision.compiled_effects
+
+    def effects_delta(self, decisions) -> Tuple[np.ndarray, np.ndarray]:
+        # Sum the sparse effect vectors of the decisions into one dense delta
+        if not decisions:
+            return np.zeros(len(self.names)), np.empty(0, dtype=np.intp)
+
+        compiled = [decision.compiled_effects or self.compile_decision(decision) for decision in decisions]
+        indices = np.concatenate([indices for indices, _ in compiled])
+        amounts = np.concatenate([amounts for _, amounts in compiled])
+        delta = np.bincount(indices, weights=amounts, minlength=len(self.names))
+        return delta, np.unique(indices)
+
+    def apply(self, decisions) -> Tuple[np.ndarray, np.ndarray]:
+        # Apply all decisions with a single vector add, returning the delta and the touched indices
+        delta, touched = self.effects_delta(decisions)
+        self.values += delta
+        return delta, touched
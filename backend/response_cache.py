@@ -0,0 +1,121 @@
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import weakref
+
+SELECT_RESPONSE_SQL = "SELECT response, expires_at FROM responses WHERE key = ? AND expires_at > ?"
+INSERT_RESPONSE_SQL = "INSERT OR REPLACE INTO responses (key, response, expires_at) VALUES (?, ?, ?)"
+DELETE_EXPIRED_SQL = "DELETE FROM responses WHERE expires_at <= ?"
+
+NUMBER = re.compile(r"-?\d+\.\d+")
+PRUNE_EVERY = 100  # stores between two deletions of expired rows
+
+
+class ResponseCache:
+    """Assistant answers keyed by persona, state summary and question, kept for ttl seconds.
+
+    The most recent max_entries answers are held in memory, least recently used first out;
+    every answer is also written to the responses table, so a restarted server still has them.
+    State summaries are compared with numbers rounded to `precision` decimals and questions
+    without case, surrounding whitespace or trailing punctuation, so near-identical prompts
+    share an answer. The conversation so far is part of the key: a follow-up question only
+    shares an answer with one asked after the same conversation.
+    """
+
+    def __init__(self, db_manager, max_entries: int = None, ttl: float = None, precision: int = None, clock: Callable[[], float] = time.time):
+        self.db_manager = db_manager
+        self.max_entries = int(max_entries or os.environ.get("SIMULATION_RESPONSE_CACHE_SIZE", "1024"))
+        self.ttl = float(ttl or os.environ.get("SIMULATION_RESPONSE_CACHE_TTL", "3600"))
+        self.precision = int(precision if precision is not None else os.environ.get("SIMULATION_RESPONSE_CACHE_PRECISION", "1"))
+        self.clock = clock
+        self.entries = OrderedDict()  # key -> (response, expires at)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0  # hits found in the table, not in memory
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def key(self, persona: Dict, kind: str, state_summary: str, query: str, conversation: str = "") -> str:
+        state = NUMBER.sub(lambda number: f"{float(number.group()):.{self.precision}f}", " ".join(state_summary.split()))
+        question = " ".join(query.split()).casefold().rstrip("?!. ")
+        payload = json.dumps([persona, kind, hashlib.sha256(state.encode("utf-8")).hexdigest(), question,
+                              hashlib.sha256(conversation.encode("utf-8")).hexdigest()], sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        now = self.clock()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self.entries[key]
+
+        with self.db_manager.pool.reading() as cursor:
+            row = cursor.execute(SELECT_RESPONSE_SQL, (key, now)).fetchone()
+        with self.lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.disk_hits += 1
+            self._remember(key, row[0], row[1])
+            return row[0]
+
+    def put(self, key: str, response: str):
+        expires_at = self.clock() + self.ttl
+        with self.lock:
+            self._remember(key, response, expires_at)
+            self.stores += 1
+            prune = self.stores % PRUNE_EVERY == 0
+        with self.db_manager.pool.writing() as cursor:
+            cursor.execute(INSERT_RESPONSE_SQL, (key, response, expires_at))
+            if prune:
+                cursor.execute(DELETE_EXPIRED_SQL, (self.clock(),))
+
+    def get_or_call(self, persona: Dict, kind: str, state_summary: str, query: str, call: Callable[[], str],
+                    cacheable: Callable[[str], bool] = lambda response: True, conversation: str = "") -> str:
+        key = self.key(persona, kind, state_summary, query, conversation)
+        response = self.get(key)
+        if response is None:
+            response = call()
+            if cacheable(response):
+                self.put(key, response)
+        return response
+
+    def stats(self) -> Dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self.entries), "hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0, "stores": self.stores, "evictions": self.evictions}
+
+    def _remember(self, key: str, response: str, expires_at: float):
+        # Called with the lock held
+        self.entries[key] = (response, expires_at)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+
+# One cache per database, shared by every controller that writes to it
+_caches = weakref.WeakKeyDictionary()
+_caches_lock = threading.Lock()
+
+
+def for_database(db_manager) -> Optional[ResponseCache]:
+    if os.environ.get("SIMULATION_RESPONSE_CACHE", "1") == "0":
+        return None
+    with _caches_lock:
+        cache = _caches.get(db_manager)
+        if cache is None:
+            cache = _caches[db_manager] = ResponseCache(db_manager)
+        return cache
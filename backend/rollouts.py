@@ -0,0 +1,251 @@
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List
+import hashlib
+import multiprocessing
+import os
+import pickle
+import tempfile
+import threading
+
+import numpy as np
+
+from metrics import get_compiled_metrics
+
+DEFAULT_KEY_METRICS = ["Overall Country Health", "Economic Stability", "Public Welfare", "Quality of Life"]
+DEFAULT_PERCENTILES = [5, 25, 50, 75, 95]
+TOTAL_POPULATION = 40000000  # same constant as State.calculate_vote_share
+
+POLICY_TYPES = ("sequence", "uniform", "weighted")
+
+_pool = None  # long-lived worker processes shared by all rollouts
+_pool_lock = threading.Lock()
+
+# In each worker: the compact states it has loaded, by digest, most recently used last
+_worker_states = OrderedDict()
+WORKER_STATE_CACHE = 4
+
+
+def pool_context():
+    # Forking from a multi-threaded server copies held locks into the child; start clean workers instead
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+def default_workers() -> int:
+    return int(os.environ.get("SIMULATION_ROLLOUT_WORKERS", os.cpu_count() or 1))
+
+
+def start_pool(workers: int = None) -> ProcessPoolExecutor:
+    """Start the shared rollout worker processes once; later calls return the running pool."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=max(1, workers or default_workers()), mp_context=pool_context())
+        return _pool
+
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=True)
+
+
+def build_compact_state(state) -> Dict:
+    """Reduce a State to the NumPy arrays a rollout needs, so workers never see the object graph."""
+    parameter_names = list(state.parameters.keys())
+    index = {name: i for i, name in enumerate(parameter_names)}
+
+    # interested[p, g] is True when parameter p is one of group g's interests
+    interested = np.zeros((len(parameter_names), len(state.sentiments)), dtype=bool)
+    for name, groups in state.interest_index.items():
+        if name in index:
+            interested[index[name], groups] = True
+
+    decision_names = list(state.decisions.keys())
+    effects = []
+    effect_matrix = np.zeros((len(decision_names), len(parameter_names)))
+    for row, decision in enumerate(state.decisions.values()):
+        effects.append([(index[parameter.name], float(effect)) for parameter, effect in decision.effects.items()])
+        for parameter, effect in effects[-1]:
+            effect_matrix[row, parameter] += effect
+
+    return {
+        "parameter_names": parameter_names,
+        "values": np.array([parameter.value for parameter in state.parameters.values()], dtype=float),
+        "propagation": state.dependency_graph.propagation_matrix(),
+        "interested": interested,
+        "group_sizes": state.group_sizes.copy(),
+        "sentiments": state.sentiments.copy(),
+        "influence": float(state.influence),
+        "decision_names": decision_names,
+        "effects": effects,
+        "effect_matrix": effect_matrix,
+        "influence_costs": np.array([decision.influence_cost for decision in state.decisions.values()], dtype=float),
+    }
+
+
+def resolve_policy(compact: Dict, policy: Dict) -> Dict:
+    """Turn a policy description into decision indices and probabilities over the state's decisions."""
+    policy = dict(policy or {})
+    policy_type = policy.get("type", "uniform")
+    if policy_type not in POLICY_TYPES:
+        raise ValueError(f"Unknown policy type '{policy_type}', expected one of {', '.join(POLICY_TYPES)}")
+
+    decision_index = {name: i for i, name in enumerate(compact["decision_names"])}
+
+    def lookup(name):
+        if name not in decision_index:
+            raise ValueError(f"No decision named '{name}' exists.")
+        return decision_index[name]
+
+    if policy_type == "sequence":
+        if not policy.get("decisions"):
+            raise ValueError("A sequence policy needs a non-empty list of decisions")
+        return {"type": policy_type, "sequence": np.array([lookup(name) for name in policy["decisions"]], dtype=np.intp)}
+
+    if policy_type == "uniform":
+        names = policy.get("decisions") or compact["decision_names"]
+        choices = np.array([lookup(name) for name in names], dtype=np.intp)
+        return {"type": policy_type, "choices": choices, "probabilities": None}
+
+    weights = policy.get("weights") or {}
+    if not weights:
+        raise ValueError("A weighted policy needs decision weights")
+    choices = np.array([lookup(name) for name in weights], dtype=np.intp)
+    probabilities = np.array(list(weights.values()), dtype=float)
+    if (probabilities < 0).any() or probabilities.sum() <= 0:
+        raise ValueError("Decision weights must be non-negative and not all zero")
+    return {"type": policy_type, "choices": choices, "probabilities": probabilities / probabilities.sum()}
+
+
+def _draw_decisions(policy: Dict, seeds, cycles: int) -> np.ndarray:
+    # One independent generator per trial keeps results identical however trials are chunked
+    if policy["type"] == "sequence":
+        sequence = policy["sequence"]
+        return np.tile(sequence[np.arange(cycles) % len(sequence)], (len(seeds), 1))
+    return np.stack([
+        np.random.default_rng(seed).choice(policy["choices"], size=cycles, p=policy["probabilities"])
+        for seed in seeds
+    ])
+
+
+def simulate_trials(compact: Dict, policy: Dict, seeds, cycles: int, metric_names: List[str]):
+    """Simulate len(seeds) trials side by side, one decision per cycle, mirroring State.apply_decision."""
+    trials = len(seeds)
+    values = np.tile(compact["values"], (trials, 1))
+    sentiments = np.tile(compact["sentiments"], (trials, 1))
+    influence = np.full(trials, compact["influence"])
+    interested = compact["interested"]
+    public_weights = compact["group_sizes"] / 100
+
+    compiled = get_compiled_metrics(tuple(compact["parameter_names"]))
+    metric_columns = [compiled.metric_names.index(name) for name in metric_names]
+    stability_column = compiled.metric_names.index("Economic Stability")
+
+    decisions = _draw_decisions(policy, seeds, cycles)
+    vote_share = np.empty((trials, cycles))
+    metrics = np.empty((trials, cycles, len(metric_names)))
+
+    for cycle in range(cycles):
+        # Direct effects followed by dependency propagation are one product with the propagation matrix
+        values += compact["effect_matrix"][decisions[:, cycle]] @ compact["propagation"].T
+        influence -= compact["influence_costs"][decisions[:, cycle]]
+
+        for decision in np.unique(decisions[:, cycle]):
+            rows = np.flatnonzero(decisions[:, cycle] == decision)
+            for parameter, effect in compact["effects"][decision]:
+                # Interested groups move with the effect, the others against it, within 0..100
+                if effect > 0:
+                    change = np.where(interested[parameter], 10, -5)
+                else:
+                    change = np.where(interested[parameter], -10, 5)
+                sentiments[rows] = np.clip(sentiments[rows] + change, 0, 100)
+
+        all_metrics = compiled.evaluate_batch(values)
+        public_sentiment = sentiments @ public_weights
+        vote_share[:, cycle] = 0.5 * public_sentiment + 0.3 * influence / 10 + 0.2 * all_metrics[:, stability_column]
+        metrics[:, cycle, :] = all_metrics[:, metric_columns]
+
+    return vote_share, metrics
+
+
+def load_compact_state(digest: str, path: str) -> Dict:
+    # Read a pickled compact state once per worker; later chunks of the run find it in the cache
+    compact = _worker_states.get(digest)
+    if compact is None:
+        with open(path, "rb") as f:
+            compact = pickle.load(f)
+        _worker_states[digest] = compact
+        while len(_worker_states) > WORKER_STATE_CACHE:
+            _worker_states.popitem(last=False)
+    else:
+        _worker_states.move_to_end(digest)
+    return compact
+
+
+def simulate_cached_trials(digest: str, path: str, policy: Dict, seeds, cycles: int, metric_names: List[str]):
+    return simulate_trials(load_compact_state(digest, path), policy, seeds, cycles, metric_names)
+
+
+def _summarize(samples: np.ndarray, percentiles: List[float]) -> Dict[str, List[float]]:
+    # Percentiles across trials (axis 0) for every cycle
+    values = np.percentile(samples, percentiles, axis=0)
+    return {f"p{percentile:g}": row.tolist() for percentile, row in zip(percentiles, values)}
+
+
+def run_rollouts(state, policy: Dict, cycles: int = 10, trials: int = 1000, seed: int = 0,
+                 metric_names: List[str] = None, percentiles: List[float] = None, workers: int = None,
+                 chunk_size: int = 250) -> Dict:
+    """Run seeded Monte Carlo rollouts of a decision policy from the given state.
+
+    With more than one worker the chunks of trials go to the shared pool from start_pool.
+    """
+    if cycles < 1 or trials < 1:
+        raise ValueError("cycles and trials must be positive")
+    metric_names = list(metric_names or DEFAULT_KEY_METRICS)
+    percentiles = list(percentiles or DEFAULT_PERCENTILES)
+    if any(not 0 <= percentile <= 100 for percentile in percentiles):
+        raise ValueError("percentiles must be between 0 and 100")
+    unknown = [name for name in metric_names if name not in state.metrics]
+    if unknown:
+        raise ValueError(f"Unknown metrics: {', '.join(unknown)}")
+
+    compact = build_compact_state(state)
+    resolved = resolve_policy(compact, policy)
+    seeds = np.random.SeedSequence(seed).spawn(trials)
+    chunks = [seeds[i:i + chunk_size] for i in range(0, trials, chunk_size)]
+    if workers is None:
+        workers = default_workers()
+    workers = max(1, min(workers, len(chunks)))
+
+    if workers == 1:
+        results = [simulate_trials(compact, resolved, chunk, cycles, metric_names) for chunk in chunks]
+    else:
+        # The compact state is pickled once into a file; chunks only carry its digest and path,
+        # and each worker reads it the first time, or not at all when it still has that state
+        data = pickle.dumps(compact, protocol=pickle.HIGHEST_PROTOCOL)
+        digest = hashlib.sha256(data).hexdigest()
+        fd, path = tempfile.mkstemp(prefix="rollout-", suffix=".pickle")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            executor = start_pool(workers)
+            futures = [executor.submit(simulate_cached_trials, digest, path, resolved, chunk, cycles, metric_names) for chunk in chunks]
+            results = [future.result() for future in futures]
+        finally:
+            os.remove(path)
+
+    vote_share = np.concatenate([vote_share for vote_share, _ in results])
+    metrics = np.concatenate([metrics for _, metrics in results])
+    return {
+        "cycles": list(range(state.cycle + 1, state.cycle + cycles + 1)),
+        "trials": trials,
+        "seed": seed,
+        "percentiles": percentiles,
+        "vote_share": _summarize(vote_share, percentiles),
+        "vote_numbers": _summarize(vote_share * TOTAL_POPULATION / 100, percentiles),
+        "metrics": {name: _summarize(metrics[:, :, i], percentiles) for i, name in enumerate(metric_names)},
+    }
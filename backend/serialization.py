@@ -0,0 +1,215 @@
+"""Versioned binary format for State, used for save files and history keyframes.
+
+Layout: MAGIC, a format version byte and a flags byte, then two length-prefixed blocks
+compressed with the codec named in the flags, then the raw arrays:
+
+- definitions: everything a game does not change from cycle to cycle (parameter and citizen
+  group definitions, decisions, economic sectors, the narrative and the assistant persona);
+- values: the id, cycle, influence, ministers, queued decisions, changes and metric names;
+- the parameter values, sentiments and metric values as little-endian float64 arrays.
+
+Metadata is msgpack when it is installed and compact JSON otherwise. The assistant is stored
+as its persona only; its agent is rebuilt on load. Both directions keep the last few encoded
+definition blocks, so saving the same game cycle after cycle only encodes its values.
+"""
+from collections import OrderedDict
+from typing import Dict
+import json
+import struct
+import threading
+import zlib
+
+import numpy as np
+
+try:
+    import msgpack
+except ImportError:  # optional, JSON metadata is used without it
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:  # optional, zlib is used without it
+    zstandard = None
+
+MAGIC = b"SIMS"
+FORMAT_VERSION = 1
+
+# Flags byte: the low two bits name the compression codec, bit 2 marks msgpack metadata
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_ZSTD = 2
+COMPRESSION_MASK = 0b11
+FLAG_MSGPACK = 0b100
+
+COMPRESSION_NAMES = {"none": COMPRESSION_NONE, "zlib": COMPRESSION_ZLIB, "zstd": COMPRESSION_ZSTD}
+
+DEFINITION_CACHE_SIZE = 64
+
+_header = struct.Struct("<4sBB")
+_length = struct.Struct("<I")
+_float64 = np.dtype("<f8")
+
+_encoded_definitions = OrderedDict()  # (flags, object ids) -> (objects, block)
+_decoded_definitions = OrderedDict()  # (flags, block) -> definitions
+_cache_lock = threading.Lock()
+
+
+def default_compression() -> str:
+    return "zstd" if zstandard is not None else "zlib"
+
+
+def is_serialized(data) -> bool:
+    return isinstance(data, (bytes, bytearray, memoryview)) and bytes(data[:4]) == MAGIC
+
+
+def _encode(value, flags: int) -> bytes:
+    if flags & FLAG_MSGPACK:
+        encoded = msgpack.packb(value, use_bin_type=True)
+    else:
+        encoded = json.dumps(value, separators=(",", ":")).encode("utf-8")
+    codec = flags & COMPRESSION_MASK
+    if codec == COMPRESSION_ZLIB:
+        return zlib.compress(encoded, 1)
+    if codec == COMPRESSION_ZSTD:
+        return zstandard.ZstdCompressor(level=3).compress(encoded)
+    return encoded
+
+
+def _decompress(block, flags: int) -> bytes:
+    codec = flags & COMPRESSION_MASK
+    if codec == COMPRESSION_ZLIB:
+        return zlib.decompress(block)
+    if codec == COMPRESSION_ZSTD:
+        if zstandard is None:
+            raise ValueError("Serialized state is zstd compressed but the zstandard package is not installed")
+        return zstandard.ZstdDecompressor().decompress(block)
+    return bytes(block)
+
+
+def _decode(encoded: bytes, flags: int):
+    if flags & FLAG_MSGPACK:
+        if msgpack is None:
+            raise ValueError("Serialized state has msgpack metadata but the msgpack package is not installed")
+        return msgpack.unpackb(encoded, raw=False)
+    return json.loads(encoded)
+
+
+def _definitions_block(state, flags: int) -> bytes:
+    # The definitions are shared objects that games never mutate, so their identity is a safe cache key
+    objects = (state.decisions, state.economic_sectors, state.narrative, state.assistant, state.country,
+               *state.parameters.values(), *state.citizen_groups.values())
+    key = (flags,) + tuple(id(item) for item in objects)
+    with _cache_lock:
+        cached = _encoded_definitions.get(key)
+        if cached is not None and all(a is b for a, b in zip(cached[0], objects)):
+            _encoded_definitions.move_to_end(key)
+            return cached[1]
+
+    definitions = {
+        "country": state.country,
+        "parameters": [[parameter.name, parameter.parameter_type.value, parameter.dependencies] for parameter in state.parameters.values()],
+        "citizen_groups": [[group.name, group.size, group.political_view, group.interests] for group in state.citizen_groups.values()],
+        "decisions": [decision.to_dict() for decision in state.decisions.values()],
+        "economic_sectors": [sector.to_dict() for sector in state.economic_sectors.values()],
+        "assistant": state.assistant.to_dict() if state.assistant is not None else None,
+        "narrative": state.narrative.to_dict() if state.narrative is not None else None,
+    }
+    block = _encode(definitions, flags)
+    with _cache_lock:
+        _encoded_definitions[key] = (objects, block)
+        while len(_encoded_definitions) > DEFINITION_CACHE_SIZE:
+            _encoded_definitions.popitem(last=False)
+    return block
+
+
+def dumps(state, compression: str = None) -> bytes:
+    """Serialize a State without its agent."""
+    flags = COMPRESSION_NAMES[compression or default_compression()]
+    if flags == COMPRESSION_ZSTD and zstandard is None:
+        raise ValueError("zstd compression needs the zstandard package")
+    if msgpack is not None:
+        flags |= FLAG_MSGPACK
+
+    values = {
+        "id": state.id,
+        "cycle": state.cycle,
+        "influence": state.influence,
+        "ministers": [minister.to_dict() for minister in state.ministers.values()],
+        "decisions_to_apply": [decision.name for decision in state.decisions_to_apply],
+        "changes": state.changes,
+        "metrics": list(state.metrics.keys()),
+    }
+    arrays = b"".join([
+        np.fromiter((parameter.value for parameter in state.parameters.values()), dtype=_float64, count=len(state.parameters)).tobytes(),
+        np.fromiter((group.sentiment for group in state.citizen_groups.values()), dtype=_float64, count=len(state.citizen_groups)).tobytes(),
+        np.fromiter(state.metrics.values(), dtype=_float64, count=len(state.metrics)).tobytes(),
+    ])
+    definitions = _definitions_block(state, flags)
+    # The arrays are numbers that barely compress, so they follow the compressed values block as-is
+    values_block = _encode(values, flags)
+    return b"".join([_header.pack(MAGIC, FORMAT_VERSION, flags),
+                     _length.pack(len(definitions)), definitions,
+                     _length.pack(len(values_block)), values_block,
+                     arrays])
+
+
+def _read_definitions(block: bytes, flags: int) -> Dict:
+    key = (flags, block)
+    with _cache_lock:
+        definitions = _decoded_definitions.get(key)
+        if definitions is not None:
+            _decoded_definitions.move_to_end(key)
+            return definitions
+    definitions = _decode(_decompress(block, flags), flags)
+    with _cache_lock:
+        _decoded_definitions[key] = definitions
+        while len(_decoded_definitions) > DEFINITION_CACHE_SIZE:
+            _decoded_definitions.popitem(last=False)
+    return definitions
+
+
+def loads_dict(data) -> Dict:
+    """Decode serialized bytes into the same dictionary State.to_dict produces."""
+    data = memoryview(data)
+    if len(data) < _header.size:
+        raise ValueError("Not a serialized simulation state")
+    magic, version, flags = _header.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Not a serialized simulation state")
+    if version > FORMAT_VERSION:
+        raise ValueError(f"Serialized state has format version {version}, newer than the supported {FORMAT_VERSION}")
+
+    offset = _header.size
+    length, = _length.unpack_from(data, offset)
+    definitions = _read_definitions(bytes(data[offset + _length.size:offset + _length.size + length]), flags)
+    offset += _length.size + length
+    length, = _length.unpack_from(data, offset)
+    values = _decode(_decompress(data[offset + _length.size:offset + _length.size + length], flags), flags)
+    offset += _length.size + length
+
+    counts = (len(definitions["parameters"]), len(definitions["citizen_groups"]), len(values["metrics"]))
+    arrays = []
+    for count in counts:
+        arrays.append(np.frombuffer(data, dtype=_float64, count=count, offset=offset).tolist())
+        offset += count * _float64.itemsize
+    parameter_values, sentiments, metric_values = arrays
+
+    # Cached definitions are shared, so every mutable piece handed out is a fresh copy
+    return {
+        "id": values["id"],
+        "parameters": {name: {"name": name, "value": value, "parameter_type": parameter_type, "dependencies": list(dependencies)}
+                       for (name, parameter_type, dependencies), value in zip(definitions["parameters"], parameter_values)},
+        "decisions": {decision["name"]: {**decision, "effects": dict(decision["effects"])} for decision in definitions["decisions"]},
+        "ministers": {minister["title"]: minister for minister in values["ministers"]},
+        "citizen_groups": {name: {"name": name, "size": size, "political_view": political_view, "interests": list(interests), "sentiment": sentiment}
+                           for (name, size, political_view, interests), sentiment in zip(definitions["citizen_groups"], sentiments)},
+        "economic_sectors": {sector["name"]: dict(sector) for sector in definitions["economic_sectors"]},
+        "metrics": dict(zip(values["metrics"], metric_values)),
+        "influence": values["influence"],
+        "assistant": dict(definitions["assistant"]) if definitions["assistant"] is not None else None,
+        "narrative": {**definitions["narrative"], "effects": dict(definitions["narrative"]["effects"])} if definitions["narrative"] is not None else None,
+        "country": definitions["country"],
+        "cycle": values["cycle"],
+        "decisions_to_apply": values["decisions_to_apply"],
+        "changes": values["changes"],
+    }
@@ -0,0 +1,70 @@
+from collections import OrderedDict
+import logging
+import threading
+
+
+class SessionRegistry:
+    """Independent simulation controllers keyed by State.id, with least-recently-used eviction.
+
+    At most max_sessions controllers are held; adding one more evicts the session that was
+    used least recently and hands it to on_evict. The default hook only stops the game; its
+    per-cycle history is already in the database, pass another hook to persist more.
+    """
+
+    def __init__(self, max_sessions: int = 256, on_evict=None):
+        if max_sessions < 1:
+            raise ValueError("max_sessions must be at least 1")
+        self.max_sessions = max_sessions
+        self.on_evict = on_evict if on_evict is not None else self.stop_session
+        self.evictions = 0
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def stop_session(controller):
+        controller.stop_simulation()
+
+    def add(self, controller) -> str:
+        # Register a started controller under the id of its state
+        if controller.state is None:
+            raise ValueError("Only started simulations can be registered")
+        session_id = controller.state.id
+        with self._lock:
+            self._sessions[session_id] = controller
+            self._sessions.move_to_end(session_id)
+            evicted = []
+            while len(self._sessions) > self.max_sessions:
+                evicted.append(self._sessions.popitem(last=False))
+            self.evictions += len(evicted)
+
+        # Write evicted sessions out without holding the lock
+        for evicted_id, evicted_controller in evicted:
+            logging.info(f"Evicting least recently used session {evicted_id}")
+            try:
+                self.on_evict(evicted_controller)
+            except Exception:
+                logging.exception(f"Failed to write out evicted session {evicted_id}")
+        return session_id
+
+    def get(self, session_id: str):
+        # Look up a session and mark it as most recently used
+        with self._lock:
+            controller = self._sessions[session_id]
+            self._sessions.move_to_end(session_id)
+            return controller
+
+    def remove(self, session_id: str):
+        with self._lock:
+            return self._sessions.pop(session_id, None)
+
+    def session_ids(self):
+        with self._lock:
+            return list(self._sessions.keys())
+
+    def __contains__(self, session_id) -> bool:
+        with self._lock:
+            return session_id in self._sessions
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._sessions)
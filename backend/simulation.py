@@ -1,13 +1,18 @@
 from assistant import Assistant
-from metrics import Metric
+from dependencies import DependencyGraph
+from metrics import Metric, update_changed_metrics
+import serialization
 
 from enum import Enum
 from typing import Union, List, Dict
+import copy
 import json
 import logging
 import pickle
 import uuid
 
+import numpy as np
+
 class ParameterValueType(Enum):
     INTEGER = "integer"
     FLOAT = "float"
@@ -32,22 +37,36 @@ class ParameterType(Enum):
 class Parameter:
     def __init__(self, name: str, initial_value: float, parameter_type: ParameterType, dependencies: List = None):
         self.name = name
-        self.value = initial_value
+        self._values = None  # shared value vector when bound to a ParameterEngine
+        self._index = None
+        self._value = initial_value
         self.parameter_type = parameter_type
         self.dependencies = dependencies if dependencies else []
 
+    @property
+    def value(self):
+        if self._values is None:
+            return self._value
+        return self._values[self._index].item()
+
+    @value.setter
+    def value(self, value):
+        if self._values is None:
+            self._value = value
+        else:
+            self._values[self._index] = value
+
+    def bind(self, values, index: int):
+        """Turn the parameter into a view over values[index], keeping its current value."""
+        values[index] = self.value
+        self._values = values
+        self._index = index
+
     def update_value(self, decisions: List):
         """Update the value of the parameter based on the effects of all decisions."""
         for decision in decisions:
             self.value += decision.effect
 
-    def adjust_for_dependency(self, parameters):
-        """Adjust the value of the parameter based on the values of its dependencies."""
-        if self.dependencies:
-            total_dependency_value = sum(parameters[dep_name].value for dep_name in self.dependencies)
-            average_dependency_value = total_dependency_value / len(self.dependencies)
-            self.value += average_dependency_value
-        
     def to_dict(self):
         return {
             'name': self.name,
@@ -56,12 +75,17 @@ class Parameter:
             'dependencies': self.dependencies
         }
 
+    @classmethod
+    def from_dict(cls, parameter_dict):
+        return cls(parameter_dict['name'], parameter_dict['value'], ParameterType(parameter_dict['parameter_type']), list(parameter_dict['dependencies']))
+
 class Decision:
     def __init__(self, name: str, effects: Dict[Parameter, float], economic_cost: int, influence_cost: int):
         self.name = name
         self.effects = effects
         self.economic_cost = economic_cost
         self.influence_cost = influence_cost
+        self.compiled_effects = None  # (indices, amounts) set by ParameterEngine.compile_decision
     
     def to_dict(self):
         return {
@@ -71,6 +95,12 @@ class Decision:
             'influence_cost': self.influence_cost
         }
 
+    @classmethod
+    def from_dict(cls, decision_dict, parameters: Dict[str, Parameter]):
+        # Effects are stored by parameter name and point back to the state's Parameter objects
+        effects = {parameters[name]: effect for name, effect in decision_dict['effects'].items()}
+        return cls(decision_dict['name'], effects, decision_dict['economic_cost'], decision_dict['influence_cost'])
+
 class Minister:
     def __init__(self, title: str, personal_name: str, loyalty: float, influence: float, backstory: str):
         self.title = title
@@ -86,13 +116,38 @@ class Minister:
                 "influence": self.influence, 
                 "backstory": self.backstory}
 
+    @classmethod
+    def from_dict(cls, minister_dict):
+        return cls(**minister_dict)
+
 class CitizenGroup:
     def __init__(self, name: str, size: float, political_view: str, interests: List[str], sentiment: int):
         self.name = name
         self.size = size
         self.political_view = political_view
         self.interests = interests
-        self.sentiment = sentiment
+        self._sentiments = None  # shared sentiment array when the group belongs to a State
+        self._index = None
+        self._sentiment = sentiment
+
+    @property
+    def sentiment(self):
+        if self._sentiments is None:
+            return self._sentiment
+        return self._sentiments[self._index].item()
+
+    @sentiment.setter
+    def sentiment(self, sentiment):
+        if self._sentiments is None:
+            self._sentiment = sentiment
+        else:
+            self._sentiments[self._index] = sentiment
+
+    def bind(self, sentiments, index: int):
+        """Turn the group's sentiment into a view over sentiments[index], keeping its current value."""
+        sentiments[index] = self.sentiment
+        self._sentiments = sentiments
+        self._index = index
     
     def to_dict(self):
         return {
@@ -103,6 +158,10 @@ class CitizenGroup:
             "sentiment": self.sentiment
         }
 
+    @classmethod
+    def from_dict(cls, group_dict):
+        return cls(group_dict["name"], group_dict["size"], group_dict["political_view"], list(group_dict["interests"]), group_dict["sentiment"])
+
 class EconomicSector:
     def __init__(self, name: str, importance: float):
         self.name = name
@@ -111,6 +170,10 @@ class EconomicSector:
     def to_dict(self):
         return {"name": self.name, "importance": self.importance}
 
+    @classmethod
+    def from_dict(cls, sector_dict):
+        return cls(sector_dict["name"], sector_dict["importance"])
+
 class Narrative:
     def __init__(self, name: str, description: str, effects: dict):
         self.name = name
@@ -122,6 +185,10 @@ class Narrative:
                 "description": self.description,
                 "effects": self.effects.copy()}
 
+    @classmethod
+    def from_dict(cls, narrative_dict):
+        return cls(narrative_dict["name"], narrative_dict["description"], dict(narrative_dict["effects"]))
+
 """
 Narrative class will be changed to this definition later
 class Narrative2:
@@ -139,12 +206,16 @@ class Narrative2:
 """ 
 
 class State:
+    # Derived lookup structures and runtime counters that are rebuilt from the entities and never serialized
+    transient_attributes = ("engine", "dependency_graph", "sentiments", "group_sizes", "interest_index", "sentiment_changes",
+                            "metrics_skipped", "metrics_skipped_total")
+
     def __init__(self, parameters: Dict[str, Parameter] = None, decisions: Dict[str, Decision] = None, ministers: Dict[str, Minister] = None, citizen_groups: Dict[str, CitizenGroup] = None, economic_sectors: Dict[str, EconomicSector] = None, metrics: Dict[str, float] = None, country: str = None, assistant: Assistant = None, narrative: Narrative = None):
         self.id = str(uuid.uuid4())  # generate a unique ID for each simulation
-        self.parameters = parameters if parameters else {}
+        self.set_parameters(parameters if parameters else {})
         self.decisions = decisions if decisions else {}
         self.ministers = ministers if ministers else {}
-        self.citizen_groups = citizen_groups if citizen_groups else {}
+        self.set_citizen_groups(citizen_groups if citizen_groups else {})
         self.economic_sectors = economic_sectors if economic_sectors else {}
         self.metrics = metrics if metrics else {}
         self.influence = 1000  # Player's influence, to be increased by negotiating with ministers
@@ -154,11 +225,20 @@ class State:
         self.cycle = 0  # start at cycle 0
         self.decisions_to_apply = []
         self.changes = {}  # dictionary to keep track of policy changes
+        self.engine = None  # optional ParameterEngine holding parameter values in one vector
+        self.metrics_skipped = 0  # metrics left untouched by the last incremental update
+        self.metrics_skipped_total = 0
     
     def next_cycle(self):
         # Apply the decisions
-        for decision in self.decisions_to_apply:
-            self.apply_decision(decision)
+        if self.engine is not None:
+            self.apply_decisions_vectorized(self.decisions_to_apply)
+        else:
+            for decision in self.decisions_to_apply:
+                self.apply_decision(decision)
+
+        # Let the changes flow down to the parameters that depend on them
+        self.propagate_dependencies()
 
         # Increment the cycle number
         self.cycle += 1
@@ -185,7 +265,38 @@ class State:
         self.update_economic_state()
         """
 
+    def clone(self, assistant: Assistant = None):
+        """Start a new game from this state.
+
+        Everything a game mutates (parameter values, sentiments, minister and group objects,
+        metrics, influence) is copied, and so is the sentiment change memo; decision definitions,
+        economic sectors, the narrative and the derived lookup structures are shared with this
+        state and must not be mutated.
+        """
+        state = copy.copy(self)
+        state.id = str(uuid.uuid4())
+        state.assistant = assistant if assistant is not None else self.assistant
+        state.decisions_to_apply = []
+        state.changes = {}
+        state.metrics = dict(self.metrics)
+        state.ministers = {name: copy.copy(minister) for name, minister in self.ministers.items()}
+
+        state.parameters = {name: copy.copy(parameter) for name, parameter in self.parameters.items()}
+        if self.engine is not None:
+            state.engine = self.engine.copy()
+            for parameter in state.parameters.values():
+                parameter._values = state.engine.values
+
+        state.citizen_groups = {name: copy.copy(group) for name, group in self.citizen_groups.items()}
+        state.sentiments = self.sentiments.copy()
+        for group in state.citizen_groups.values():
+            group._sentiments = state.sentiments
+        state.sentiment_changes = dict(self.sentiment_changes)
+        return state
+
     def set_parameters(self, parameters: dict):
+        # Building the dependency graph rejects unknown dependencies and cycles up front
+        self.dependency_graph = DependencyGraph.from_parameters(parameters)
         self.parameters = parameters
 
     def set_decisions(self, decisions: dict):
@@ -193,6 +304,21 @@ class State:
     
     def set_citizen_groups(self, citizen_groups: dict):
         self.citizen_groups = citizen_groups
+
+        # Hold all sentiments in one array, with the groups as views over it
+        groups = list(citizen_groups.values())
+        self.sentiments = np.array([group.sentiment for group in groups], dtype=float)
+        self.group_sizes = np.array([group.size for group in groups], dtype=float)
+        for index, group in enumerate(groups):
+            group.bind(self.sentiments, index)
+
+        # Inverted index from parameter name to the groups interested in it
+        interest_index = {}
+        for index, group in enumerate(groups):
+            for interest in group.interests:
+                interest_index.setdefault(interest, []).append(index)
+        self.interest_index = {name: np.array(indices, dtype=np.intp) for name, indices in interest_index.items()}
+        self.sentiment_changes = {}
     
     def set_ministers(self, ministers: dict):
         self.ministers = ministers
@@ -212,6 +338,12 @@ class State:
     def get_metrics(self):
         return self.metrics
 
+    def update_metrics(self, changed_parameters):
+        # Recompute only the metrics that depend on the changed parameters
+        self.metrics_skipped = update_changed_metrics(self, changed_parameters)
+        self.metrics_skipped_total += self.metrics_skipped
+        return self.metrics_skipped
+
     def get_parameter(self, name: str):
         return self.parameters.get(name)
 
@@ -228,23 +360,9 @@ class State:
             old_value = self.parameters[parameter.name].value
             self.parameters[parameter.name].value += effect
             new_value = self.parameters[parameter.name].value
-            self.changes[parameter.name] = new_value - old_value
-
-            self.parameters[parameter.name].adjust_for_dependency(self.parameters)  # adjust for dependency immediately after the decision
-
-            # Adjust sentiment of citizen groups based on change in parameters
-            for citizen_group in self.citizen_groups.values():
-                if parameter.name in citizen_group.interests:
-                    # If parameter increased and it's in the group's interests, sentiment increases
-                    # If parameter decreased and it's in the group's interests, sentiment decreases
-                    sentiment_change = 10 if effect > 0 else -10
-                else:
-                    # If parameter increased and it's not in the group's interests, sentiment decreases
-                    # If parameter decreased and it's not in the group's interests, sentiment increases
-                    sentiment_change = -5 if effect > 0 else 5
+            self.changes[parameter.name] = self.changes.get(parameter.name, 0) + new_value - old_value
 
-                # Adjust sentiment within bounds of 0 and 100
-                citizen_group.sentiment = max(0, min(100, citizen_group.sentiment + sentiment_change))
+            self.adjust_sentiments(parameter.name, effect)
 
         """
         # It may also have effects on ministers, citizen groups, etc.
@@ -255,6 +373,45 @@ class State:
             self.citizen_groups[citizen_group].opinion += effect
         """
     
+    def apply_decisions_vectorized(self, decisions):
+        # Add the precompiled effects of all queued decisions to the value vector in one step
+        delta, touched = self.engine.apply(decisions)
+        for index in touched:
+            self.changes[self.engine.names[index]] = delta[index].item()
+
+        # Costs and sentiments are still applied per decision and effect
+        for decision in decisions:
+            self.influence -= decision.influence_cost
+            for parameter, effect in decision.effects.items():
+                self.adjust_sentiments(parameter.name, effect)
+
+    def propagate_dependencies(self):
+        # Move each dependent parameter by the average change of its dependencies, in topological order
+        induced = self.dependency_graph.propagate(self.changes)
+        for name, change in induced.items():
+            self.parameters[name].value += change
+            self.changes[name] = self.changes.get(name, 0) + change
+
+    def adjust_sentiments(self, parameter_name: str, effect: float):
+        # Adjust sentiment of all citizen groups at once based on change in parameters
+        key = (parameter_name, effect > 0)
+        sentiment_change = self.sentiment_changes.get(key)
+        if sentiment_change is None:
+            # If parameter increased and it's not in the group's interests, sentiment decreases
+            # If parameter decreased and it's not in the group's interests, sentiment increases
+            sentiment_change = np.full(len(self.sentiments), -5.0 if effect > 0 else 5.0)
+            # If parameter increased and it's in the group's interests, sentiment increases
+            # If parameter decreased and it's in the group's interests, sentiment decreases
+            interested = self.interest_index.get(parameter_name)
+            if interested is not None:
+                sentiment_change[interested] = 10 if effect > 0 else -10
+            sentiment_change.setflags(write=False)  # memoized vectors may be shared by cloned games
+            self.sentiment_changes[key] = sentiment_change
+
+        # Adjust sentiment within bounds of 0 and 100, in place so the group views stay valid
+        np.add(self.sentiments, sentiment_change, out=self.sentiments)
+        np.clip(self.sentiments, 0, 100, out=self.sentiments)
+
     def add_decision_to_apply(self, decision: Decision):
         self.decisions_to_apply.append(decision)
 
@@ -275,7 +432,7 @@ class State:
     def calculate_vote_share(self):
         # Compute Public Sentiment as a weighted average of the sentiment of each citizen group
         total_size = 40000000  # Total population is a known constant
-        public_sentiment = sum((group.sentiment * group.size / 100) for group in self.citizen_groups.values())
+        public_sentiment = float(self.sentiments @ self.group_sizes) / 100
 
         # Retrieve the relevant metrics and attributes
         influence = self.influence/10
@@ -293,13 +450,16 @@ class State:
     def ask_assistant(self):
         print(self.assistant.generate_response(self))
 
-    def save_game(self, file_path: str):
+    def save_game(self, file_path: str, compression: str = None):
+        # Compact versioned binary format; the assistant's agent is not saved
         with open(file_path, 'wb') as f:
-            pickle.dump(self, f)
+            f.write(serialization.dumps(self, compression))
     
     def get_state(self):
         # Create a dictionary with the same attributes as the State object
         state_dict = self.__dict__.copy()
+        for attr in self.transient_attributes:
+            state_dict.pop(attr, None)
         # Convert custom objects to dictionaries
         state_dict["parameters"] = {name: param.to_dict() for name, param in self.parameters.items()}
         state_dict["decisions"] = {name: decision.to_dict() for name, decision in self.decisions.items()}
@@ -315,11 +475,18 @@ class State:
     @staticmethod
     def load_game(file_path: str):
         with open(file_path, 'rb') as f:
-            return pickle.load(f)
+            data = f.read()
+        if not serialization.is_serialized(data):
+            # Save files written before the binary format were pickles
+            logging.warning(f"Loading legacy pickled save file {file_path}")
+            return pickle.loads(data)
+        return State.from_dict(serialization.loads_dict(data))
     
     def to_dict(self):
         # Create a dictionary with the same attributes as the State object
         state_dict = self.__dict__.copy()
+        for attr in self.transient_attributes:
+            state_dict.pop(attr, None)
 
         # If State object contains other custom objects, convert these to dictionaries as well
         for attr, value in state_dict.items():
@@ -331,35 +498,27 @@ class State:
                 # If the value is a custom object, convert it to a dictionary
                 state_dict[attr] = value.to_dict()
 
+        # Queued decisions are stored by name and resolved against the decisions on load
+        state_dict["decisions_to_apply"] = [decision.name for decision in self.decisions_to_apply]
         return state_dict
         
     @classmethod
     def from_dict(cls, state_dict):
-        # create a new instance of the class
-        state = cls()
-
-        # populate the attributes of the state object from the dictionary
-        for key, value in state_dict.items():
-            if key == 'assistant':
-                state.assistant = Assistant.from_dict(value)
-            if key == "parameters":
-                state.parameters = {name: Parameter.from_dict(param_dict) for name, param_dict in value.items()}
-            elif key == "decisions":
-                state.decisions = {name: Decision.from_dict(decision_dict) for name, decision_dict in value.items()}
-            if key == "ministers":
-                state.ministers = {name: Minister.from_dict(minister_dict) for name, minister_dict in value.items()}
-            if key == "citizen_groups":
-                state.citizen_groups = {name: CitizenGroup.from_dict(group_dict) for name, group_dict in value.items()}
-            if key == "economic_sectors":       
-                state.economic_sectors = {name: EconomicSector.from_dict(sector_dict) for name, sector_dict in value.items()}
-            if key == "narrative":         
-                state.narrative = Narrative.from_dict(value)
-            if key == "cycle": 
-                state.cycle = value
-            if key == "country":
-                state.country = value
-            else:
-                setattr(state, key, value)
-
+        """Rebuild a State from the output of to_dict. The assistant gets a fresh agent."""
+        parameters = {name: Parameter.from_dict(param_dict) for name, param_dict in state_dict["parameters"].items()}
+        decisions = {name: Decision.from_dict(decision_dict, parameters) for name, decision_dict in state_dict["decisions"].items()}
+        state = cls(parameters=parameters,
+                    decisions=decisions,
+                    ministers={name: Minister.from_dict(minister_dict) for name, minister_dict in state_dict["ministers"].items()},
+                    citizen_groups={name: CitizenGroup.from_dict(group_dict) for name, group_dict in state_dict["citizen_groups"].items()},
+                    economic_sectors={name: EconomicSector.from_dict(sector_dict) for name, sector_dict in state_dict["economic_sectors"].items()},
+                    metrics=dict(state_dict["metrics"]),
+                    country=state_dict.get("country"),
+                    assistant=Assistant.from_dict(state_dict["assistant"]) if state_dict.get("assistant") else None,
+                    narrative=Narrative.from_dict(state_dict["narrative"]) if state_dict.get("narrative") else None)
+        state.id = state_dict["id"]
+        state.influence = state_dict["influence"]
+        state.cycle = state_dict["cycle"]
+        state.changes = dict(state_dict.get("changes", {}))
+        state.decisions_to_apply = [decisions[name] for name in state_dict.get("decisions_to_apply", [])]
         return state
-    
\ No newline at end of file
@@ -30,60 +30,68 @@ async def load_countries():
         response = await client.get("http://localhost:8000/load_countries")
         return response.json()["countries"] if response.status_code == 200 else None
 
-async def set_assistant(choice):
-    async with httpx.AsyncClient() as client:
-        response = await client.get(f"http://localhost:8000/set_assistant/{choice}")
-        return response.status_code == 200
-
-async def set_narrative(choice):
-    async with httpx.AsyncClient() as client:
-        response = await client.get(f"http://localhost:8000/set_narrative/{choice}")
-        return response.status_code == 200
-
-async def set_country(choice):
-    async with httpx.AsyncClient() as client:
-        response = await client.get(f"http://localhost:8000/set_country/{choice}")
-        return response.status_code == 200
-
 async def get_simulation_status():
     async with httpx.AsyncClient() as client:
         return await client.get("http://localhost:8000/")
 
-async def start_simulation():
+async def start_simulation(assistant_choice, country_choice, narrative_choice=None):
+    # Every game carries its own choices; the server keeps no shared setup state
+    params = {"assistant_choice": assistant_choice, "country_choice": country_choice}
+    if narrative_choice:
+        params["narrative_choice"] = narrative_choice
     async with httpx.AsyncClient() as client:
-        return await client.get("http://localhost:8000/simulation/start")
+        response = await client.get("http://localhost:8000/simulation/start", params=params)
+        return response.json() if response.status_code == 200 else None
 
 async def stop_simulation():
     async with httpx.AsyncClient() as client:
-        return await client.post("http://localhost:8000/simulation/stop")
+        return await client.post(f"http://localhost:8000/simulation/{st.session_state.session_id}/stop")
 
 async def get_simulation_state():
     async with httpx.AsyncClient() as client:
-        resp = await client.get("http://localhost:8000/simulation/state")
+        resp = await client.get(f"http://localhost:8000/simulation/{st.session_state.session_id}/state")
         return resp.json() if resp.status_code == 200 else None
     
 async def get_vote_share():
     async with httpx.AsyncClient() as client:
-        resp = await client.get("http://localhost:8000/simulation/get_vote_share")
+        resp = await client.get(f"http://localhost:8000/simulation/{st.session_state.session_id}/get_vote_share")
         return resp.json() if resp.status_code == 200 else None
 
 async def submit_decision(decision):
     async with httpx.AsyncClient() as client:
-        response = await client.post("http://localhost:8000/simulation/decision", json={"decision_name": decision})
+        response = await client.post(f"http://localhost:8000/simulation/{st.session_state.session_id}/decision", json={"decision_name": decision})
         return response.json() if response.status_code == 200 else None
 
 async def generate_response(query):
     async with httpx.AsyncClient() as client:
-        response = await client.post("http://localhost:8000/simulation/generate_response", json={"query": query})
+        response = await client.post(f"http://localhost:8000/simulation/{st.session_state.session_id}/generate_response", json={"query": query})
         return response.json()["response"] if response.status_code == 200 else None
 
+async def stream_response(query, on_token):
+    # Show the answer as it is generated; the last line carries the whole answer
+    response = None
+    async with httpx.AsyncClient(timeout=None) as client:
+        async with client.stream("POST", f"http://localhost:8000/simulation/{st.session_state.session_id}/generate_response/stream", json={"query": query}) as resp:
+            if resp.status_code != 200:
+                return None
+            async for line in resp.aiter_lines():
+                if not line:
+                    continue
+                item = json.loads(line)
+                if "token" in item:
+                    on_token(item["token"])
+                else:
+                    response = item.get("response")
+    return response
+
 async def next_cycle():
     async with httpx.AsyncClient() as client:
-        return await client.get("http://localhost:8000/simulation/next_cycle")
+        return await client.get(f"http://localhost:8000/simulation/{st.session_state.session_id}/next_cycle")
 
-async def load_states():
+async def load_series(names):
+    # Only the plotted columns travel, as one array per series
     async with httpx.AsyncClient() as client:
-        resp = await client.get(f"http://localhost:8000/simulation/load/{simulation_state['id']}")
+        resp = await client.get(f"http://localhost:8000/simulation/{simulation_state['id']}/series", params={"names": ",".join(names)})
         return resp.json() if resp.status_code == 200 else None
 
 # Streamlit code
@@ -152,8 +160,10 @@ if not st.session_state.simulation_started:
             country_choice = country_names.index(chosen_country_name) + 1
             narrative_choice = narrative_names.index(chosen_narrative_name) if chosen_narrative_name else ""
             assistant_choice = assistant_names.index(chosen_assistant_name) + 1
-            if run_async(set_assistant(assistant_choice)) and run_async(set_country(country_choice)) and (narrative_choice == '' or run_async(set_narrative(narrative_choice))):
-                st.write(run_async(start_simulation()))
+            started = run_async(start_simulation(assistant_choice, country_choice, narrative_choice or None))
+            if started:
+                st.write(started)
+                st.session_state.session_id = started["session_id"]
                 st.session_state.simulation_started = True
             else:
                 st.write("Error starting simulation")
@@ -305,36 +315,15 @@ if st.session_state.simulation_started:
                     st.metric(label=metric_name, value=int(metric_value))
             
             # Show the graphs for metrics and parameters
-            state_history = run_async(load_states())
-            #st.json(state_history)
-            # Serializing json
-            #json_object = json.dumps(state_history, indent=4)
-            
-            # Writing to simulation.json
-            #with open("simulation.json", "w") as outfile:
-            #    outfile.write(json_object)
-
-            # Initialize the dictionary
-            data_metrics = {"Cycle": [], "Overall Country Health": [], "Quality of Life": []}
-            data_parameters = {"Cycle": [], "Economy": [], "Education": [], "Environment": [],"Healthcare": [], "Public Unrest": []}
-
-            # Iterate over cycles
-            for cycle in range(len(state_history['status'])):
-                # Add cycle number
-                data_metrics["Cycle"].append(cycle)
-                data_parameters["Cycle"].append(cycle)
-                # Extract metrics values for each cycle
-                metrics = state_history["status"][cycle][str(cycle+1)]["state"]["metrics"]
-                data_metrics["Overall Country Health"].append(metrics["Overall Country Health"])
-
-                # Extract parameter values for each cycle
-                parameters = state_history["status"][cycle][str(cycle+1)]["state"]['parameters']
-                data_parameters["Economy"].append(parameters["Economy"]["value"])
-                data_parameters["Education"].append(parameters["Education"]["value"])
-                data_parameters["Healthcare"].append(parameters["Healthcare"]["value"])
-                data_parameters["Environment"].append(parameters["Environment"]["value"])
-                data_metrics["Quality of Life"].append(parameters["Quality of Life"]["value"])
-                data_parameters["Public Unrest"].append(parameters["Public Unrest"]["value"])
+            metric_series = {"metrics.Overall Country Health": "Overall Country Health", "parameters.Quality of Life": "Quality of Life"}
+            parameter_series = {"parameters.Economy": "Economy", "parameters.Education": "Education", "parameters.Environment": "Environment",
+                                "parameters.Healthcare": "Healthcare", "parameters.Public Unrest": "Public Unrest"}
+            series = run_async(load_series(list(metric_series) + list(parameter_series))) or {"cycles": [], "series": {}}
+
+            data_metrics = {"Cycle": series["cycles"]}
+            data_metrics.update({label: series["series"].get(name, []) for name, label in metric_series.items()})
+            data_parameters = {"Cycle": series["cycles"]}
+            data_parameters.update({label: series["series"].get(name, []) for name, label in parameter_series.items()})
 
             # Convert the dictionary to a pandas DataFrame
             df_metrics = pd.DataFrame(data_metrics)
@@ -377,14 +366,16 @@ if st.session_state.simulation_started:
             # Generate a new response if last message is not from assistant
             if st.session_state.messages[-1]["role"] != "assistant":
                 with st.chat_message(name=simulation_state["assistant"]["name"], avatar="../data/img/"+simulation_state["assistant"]["name"]+".jpeg"):
-                    with st.spinner("Thinking..."):
-                        response = run_async(generate_response(prompt))
-                        placeholder = st.empty()
-                        full_response = ''
-                        for item in response:
-                            full_response += item
-                            placeholder.markdown(full_response)
-                        placeholder.markdown(full_response)
+                    placeholder = st.empty()
+                    placeholder.markdown("Thinking...")
+                    tokens = []
+
+                    def show_token(token):
+                        tokens.append(token)
+                        placeholder.markdown("".join(tokens))
+
+                    full_response = run_async(stream_response(prompt, show_token)) or "".join(tokens)
+                    placeholder.markdown(full_response)
                 message = {"role": "assistant", "content": full_response}
                 st.session_state.messages.append(message)
 
@@ -1,44 +1,106 @@
 from simulation import State, Parameter, ParameterType, Narrative, Decision, Minister, CitizenGroup, EconomicSector
-from metrics import set_metrics_values, update_metrics_values
+from metrics import set_metrics_values, update_metrics_values, get_compiled_metrics, metric_dependency_index
 from database import DatabaseManager
-from assistant import Assistant
+from assistant import Assistant, NEWS_QUERY
+from parameter_engine import ParameterEngine
+from rollouts import run_rollouts
+from catalog import catalog as default_catalog
+from snapshots import snapshot_store as default_snapshot_store
+from agent import ERROR_PREFIX
+from memory import ConversationMemory
+import response_cache
+import serialization
 import logging
 import json
+import os
+import threading
 
 
 class SimulationController:
-    def __init__(self):
+    def __init__(self, use_parameter_engine=False, db_name='simulation.db', db_manager=None, catalog=None, snapshots=None,
+                 snapshot_every_cycle=None, responses=None, conversation=None):
+        self.catalog = catalog if catalog is not None else default_catalog  # shared read-only data/*.json
+        self.snapshots = snapshots if snapshots is not None else default_snapshot_store
+        # Snapshot every cycle to the "latest" ref, so a crashed game can be restored where it stopped
+        if snapshot_every_cycle is None:
+            snapshot_every_cycle = os.environ.get("SIMULATION_SNAPSHOT_EVERY_CYCLE", "0") == "1"
+        self.snapshot_every_cycle = snapshot_every_cycle
         self.assistant = None
         self.state = None
         self.narrative = None
         self.country = None
-        self.db_manager = DatabaseManager('simulation.db')  # specify the name of database
+        self.use_parameter_engine = use_parameter_engine  # keep parameter values in one NumPy vector
+        self.lock = threading.Lock()  # guards self.state, which worker threads read and mutate concurrently
+        self.db_manager = db_manager if db_manager is not None else DatabaseManager(db_name)  # specify the name of database
+        # Answers to repeated questions about the same state, shared with every controller of this database
+        self.responses = responses if responses is not None else response_cache.for_database(self.db_manager)
+        # What the player and the assistant said, kept with the session; a restored game talks on from it
+        self.conversation = conversation if conversation is not None else ConversationMemory()
     
+    # Prebuilt prototype states shared by all controllers, keyed by their inputs
+    prototypes = {}
+    prototypes_lock = threading.Lock()
+    prototype_files = ["data/parameters.json", "data/ministers.json", "data/decisions.json",
+                       "data/citizen_groups.json", "data/economic_sectors.json", "data/narratives.json"]
+
     def start_simulation(self):
         # Check if an assistant has been set
         if self.assistant is None:
             raise ValueError("An assistant must be assigned before starting the game")
 
-        # start a new game, by initializing or resetting the state.
-        self.state = State(assistant=self.assistant)
-
-        # Load all default entities into the state
-        self.load_parameters("data/parameters.json")
-        self.load_ministers("data/ministers.json")
-        self.load_decisions("data/decisions.json")
-        self.load_citizen_groups("data/citizen_groups.json")
-        self.load_economic_sectors("data/economic_sectors.json")
-        self.load_metrics()
-
-        # If a narrative has been set, apply it to the state
-        if self.country is not None:
-            self.state.country=self.country
-        if self.narrative is not None:
-            self.state.set_narrative(self.narrative)
-            update_metrics_values(self.state)
+        # start a new game as a cheap clone of the prototype for this country and narrative
+        state = self.get_prototype().clone(assistant=self.assistant)
+        with self.lock:
+            self.state = state
+
+    def get_prototype(self):
+        # Rebuild the prototype when any data file it was built from has changed
+        signatures = tuple(self.catalog.signature(filename) for filename in self.prototype_files)
+        key = (self.country, self.narrative.name if self.narrative else None, self.use_parameter_engine, signatures)
+        prototype = self.prototypes.get(key)
+        if prototype is None:
+            with self.prototypes_lock:
+                prototype = self.prototypes.get(key)
+                if prototype is None:
+                    # Prototypes built from older versions of the data files can never be used again
+                    for stale in [stale for stale in self.prototypes if stale[3] != signatures]:
+                        del self.prototypes[stale]
+                    prototype = self.build_prototype()
+                    self.prototypes[key] = prototype
+        return prototype
+
+    def build_prototype(self):
+        # Build a fully initialized state without an assistant; games are cloned from it
+        state = self.state
+        try:
+            self.state = State()
+
+            # Load all default entities into the state
+            self.load_parameters("data/parameters.json")
+            self.load_ministers("data/ministers.json")
+            self.load_decisions("data/decisions.json")
+            self.load_citizen_groups("data/citizen_groups.json")
+            self.load_economic_sectors("data/economic_sectors.json")
+            if self.use_parameter_engine:
+                ParameterEngine(list(self.catalog.read("data/parameters.json").keys())).bind(self.state)
+            self.load_metrics()
+
+            # If a narrative has been set, apply it to the state
+            if self.country is not None:
+                self.state.country=self.country
+            if self.narrative is not None:
+                self.state.set_narrative(self.narrative)
+                update_metrics_values(self.state)
+            return self.state
+        finally:
+            self.state = state
 
     def get_state(self):
         # return a representation of the current state of the game
+        with self.lock:
+            return self._get_state()
+
+    def _get_state(self):
         # Check if the state is None
         if self.state is None:
             return None
@@ -53,7 +115,7 @@ class SimulationController:
                 "parameters": {name: param.value for name, param in self.state.parameters.items()},
                 "decisions": [decision.name for decision in self.state.decisions.values()],
                 "ministers": [vars(minister) for minister in self.state.ministers.values()],
-                "citizen_groups": [vars(group) for group in self.state.citizen_groups.values()],
+                "citizen_groups": [group.to_dict() for group in self.state.citizen_groups.values()],
                 "economic_sectors": [sector.name for sector in self.state.economic_sectors.values()],
                 "metrics": self.state.get_metrics(),
                 "country": self.state.country
@@ -63,9 +125,8 @@ class SimulationController:
             return None
     
     def load_countries(self, filename="data/countries.json"):
-        # Load countries from a file
-        with open(filename, 'r') as f:
-            countries_list = json.load(f)
+        # Load countries from the catalog
+        countries_list = self.catalog.read(filename)
         countries = [country["name"] for country in countries_list]
         return countries
     
@@ -81,45 +142,46 @@ class SimulationController:
         self.country = countries[choice-1]
 
     def load_assistants(self, filename="data/assistants.json"):
-        # Load assistant attributes from a file
-        with open(filename, 'r') as f:
-            assistant_list = json.load(f)
+        # Load assistant attributes from the catalog
+        assistant_list = self.catalog.read(filename)
         # Create Assistant objects for all assistants
         assistants = [Assistant(**assistant_attributes) for assistant_attributes in assistant_list]
         return assistants
     
     def set_assistant(self, choice):
-        # Load the list of assistants
-        assistants = self.load_assistants()
+        # Load the list of assistant attributes
+        assistants = self.catalog.read("data/assistants.json")
 
         # Check if the choice is valid
         if choice < 1 or choice > len(assistants):
             raise ValueError("Invalid assistant number")
 
-        # Set the chosen assistant
-        self.assistant = assistants[choice-1]
+        # Create only the chosen assistant
+        self.assistant = Assistant(**assistants[choice-1])
+        self.assistant.use_memory(self.conversation)
     
     def load_narratives(self, narratives_file="data/narratives.json"):
-        # Load narratives from a local file
-        with open(narratives_file, 'r') as f:
-            narratives_data = json.load(f)
+        # Load narratives from the catalog
+        narratives_data = self.catalog.read(narratives_file)
 
         # Create Narrative objects
-        narratives = [Narrative(narrative['name'], narrative['description'], narrative['effects']) for narrative in narratives_data]
+        narratives = [Narrative(narrative['name'], narrative['description'], dict(narrative['effects'])) for narrative in narratives_data]
         return narratives
     
     def set_narrative(self, narrative_choice):
         # Load the list of narratives
-        narratives = self.load_narratives()
+        narratives = self.catalog.read("data/narratives.json")
 
         # Set the narrative if a choice was made
         if narrative_choice is not None:
-            self.narrative = narratives[narrative_choice-1]
+            if narrative_choice < 1 or narrative_choice > len(narratives):
+                raise ValueError("Invalid narrative number")
+            narrative = narratives[narrative_choice-1]
+            self.narrative = Narrative(narrative['name'], narrative['description'], dict(narrative['effects']))
     
     def load_parameters(self, parameters_file):
-        # Load parameters from a local file into the state
-        with open(parameters_file, 'r') as f:
-            parameters_data = json.load(f)
+        # Load parameters from the catalog into the state
+        parameters_data = self.catalog.read(parameters_file)
 
         parameters_instances = {
             name: Parameter(
@@ -135,9 +197,8 @@ class SimulationController:
 
 
     def load_decisions(self, decisions_file):
-        # Load decisions from a local file into the state
-        with open(decisions_file, 'r') as f:
-            decisions_data = json.load(f)
+        # Load decisions from the catalog into the state
+        decisions_data = self.catalog.read(decisions_file)
 
         decisions_instances = {}
         for decision in decisions_data:
@@ -153,9 +214,8 @@ class SimulationController:
 
 
     def load_ministers(self, ministers_file):
-        # Load ministers from a local file into the state
-        with open(ministers_file, 'r') as f:
-            ministers_data = json.load(f)
+        # Load ministers from the catalog into the state
+        ministers_data = self.catalog.read(ministers_file)
         
         ministers_instances = {
             minister['title']: Minister(minister['title'], minister['personal_name'], minister['loyalty'], minister['influence'], minister['backstory'])
@@ -165,12 +225,11 @@ class SimulationController:
         self.state.set_ministers(ministers_instances)
 
     def load_citizen_groups(self, citizen_groups_file):
-        # Load citizen groups from a local file into the state
-        with open(citizen_groups_file, 'r') as f:
-            citizen_groups_data = json.load(f)
+        # Load citizen groups from the catalog into the state
+        citizen_groups_data = self.catalog.read(citizen_groups_file)
         
         citizen_groups_instances = {
-            group['name']: CitizenGroup(**group)
+            group['name']: CitizenGroup(**{**group, 'interests': list(group['interests'])})
             for group in citizen_groups_data
         }
 
@@ -178,9 +237,8 @@ class SimulationController:
 
     
     def load_economic_sectors(self, economic_sectors_file):
-        # Load economic sectors from a local file into the state
-        with open(economic_sectors_file, 'r') as f:
-            economic_sectors_data = json.load(f)
+        # Load economic sectors from the catalog into the state
+        economic_sectors_data = self.catalog.read(economic_sectors_file)
         
         economic_sectors_instances = {
             sector['name']: EconomicSector(sector['name'], sector['importance'])
@@ -192,60 +250,168 @@ class SimulationController:
     def load_metrics(self):
         set_metrics_values(self.state)
     
-    def generate_response(self, query):
-        state_history = "Country: " + str(self.state.country) + ", Current narrative: " + str(self.state.narrative.name) 
-        state_metrics = ", ".join([f"{k}: {v}" for k, v in self.state.get_metrics().items()])
-        state_history = state_history +", Current state of the country: " + str(state_metrics)
-        respone = self.state.assistant.generate_response(state_history, query)
-        return respone
+    def require_state(self):
+        # Called with the lock held; a stopped or evicted game has no state left
+        if self.state is None:
+            raise ValueError("No game in progress")
+        return self.state
+
+    def state_summary(self, query=""):
+        # The state as the assistant sees it, with only the metrics the query is about; call with the lock held
+        state = self.require_state()
+        state_history = "Country: " + str(state.country) + ", Current narrative: " + str(state.narrative.name) 
+        metrics = state.get_metrics()
+        relevant = metric_dependency_index.relevant(query, metrics.keys(), state.parameters.keys())
+        state_metrics = ", ".join([f"{k}: {metrics[k]}" for k in relevant])
+        return state_history +", Current state of the country: " + str(state_metrics)
+
+    def ask_assistant(self, kind, query, ask, asked=None):
+        # Build the prompt under the lock, but wait for the assistant without holding it
+        with self.lock:
+            state_history = self.state_summary(query)
+            assistant = self.state.assistant
+        if self.responses is None:
+            return ask(assistant, state_history)
+
+        called = []
+
+        def call():
+            called.append(True)
+            return ask(assistant, state_history)
+
+        conversation = self.conversation.load_memory_variables({})[self.conversation.memory_key]
+        response = self.responses.get_or_call(assistant.persona(), kind, state_history, query, call,
+                                              cacheable=lambda response: isinstance(response, str) and not response.startswith(ERROR_PREFIX),
+                                              conversation=conversation)
+        if not called:
+            # The assistant never saw this question; keep it in the conversation all the same
+            assistant.remember(asked if asked is not None else query, response)
+        return response
+
+    def generate_response(self, query, callbacks=None):
+        # callbacks receive the tokens as they stream in; a cached answer comes back without any
+        return self.ask_assistant("response", query, lambda assistant, state_history: assistant.generate_response(state_history, query, callbacks=callbacks))
 
     def fetch_news(self):
         # Fetch news and return it
-        news = self.assistant.fetch_news()
-        return news
+        return self.ask_assistant("news", "", lambda assistant, state_history: assistant.fetch_news(state_history), asked=NEWS_QUERY)
+
+    def generate_decision(self, news_event):
+        return self.ask_assistant("decision", news_event, lambda assistant, state_history: assistant.generate_decision(news_event, state_history))
     
     def make_decision(self, decision_name: str):
         # Here, you would apply the given decision and return the new state of the game.
-        decision = self.state.get_decision(decision_name)
-        if decision:
-            self.state.add_decision_to_apply(decision)
-        else:
-            raise ValueError(f"No decision named '{decision_name}' exists.")
+        with self.lock:
+            state = self.require_state()
+            decision = state.get_decision(decision_name)
+            if decision:
+                state.add_decision_to_apply(decision)
+            else:
+                raise ValueError(f"No decision named '{decision_name}' exists.")
     
     def next_cycle(self):
-        changes = self.state.next_cycle()
-        self.save_state(self.state, changes)
-        # Update the metrics in the state
-        update_metrics_values(self.state)
+        with self.lock:
+            self.require_state()
+            changes = self.state.next_cycle()
+            # Update the metrics in the state
+            if self.state.engine is not None:
+                get_compiled_metrics(tuple(self.state.engine.names)).update(self.state)
+            else:
+                skipped = self.state.update_metrics(changes)
+                logging.debug(f"Cycle {self.state.cycle}: skipped {skipped} of {len(self.state.metrics)} metrics")
+            # Store the cycle with the metrics it produced
+            self.save_state(self.state, changes)
+            if self.snapshot_every_cycle:
+                self.snapshots.save(self.state, ref="latest")
 
     def get_vote_share(self):
-        result = self.state.calculate_vote_share()
+        with self.lock:
+            result = self.require_state().calculate_vote_share()
         return result
+
+    def run_rollouts(self, policy, cycles=10, trials=1000, seed=0, metrics=None, percentiles=None):
+        # Simulate future cycles of a copy of the current state, so cycles can go on meanwhile
+        with self.lock:
+            state = self.require_state().clone()
+        return run_rollouts(state, policy, cycles=cycles, trials=trials, seed=seed,
+                            metric_names=metrics, percentiles=percentiles)
     
     def save_state(self, state, changes):
         self.db_manager.save_state(state, changes)
 
     def load_states(self, simulation_id):
         return self.db_manager.load_states(simulation_id)
+
+    def load_state(self, simulation_id, cycle):
+        return self.db_manager.load_state(simulation_id, cycle)
+
+    def load_series(self, simulation_id, names=None, from_cycle=None, to_cycle=None):
+        return self.db_manager.load_series(simulation_id, names, from_cycle, to_cycle)
+
+    def iter_history(self, simulation_id, from_cycle=None, to_cycle=None, fields=None):
+        return self.db_manager.iter_history(simulation_id, from_cycle, to_cycle, fields)
+
+    def load_history_page(self, simulation_id, after_cycle=None, limit=100, from_cycle=None, to_cycle=None, fields=None):
+        return self.db_manager.load_history_page(simulation_id, after_cycle, limit, from_cycle, to_cycle, fields)
     
+    def save_game_state(self, ref="saved"):
+        # Snapshot the game without its agent; the history is already in the database
+        with self.lock:
+            state = self.require_state()
+            return self.snapshots.save_bytes(state.id, state.cycle, serialization.dumps(state), ref)
+
+    def restore_game_state(self, simulation_id, ref="saved"):
+        # Go back to a snapshot; the cycles stored after it are dropped from the history
+        state = self.snapshots.restore(simulation_id, ref)
+        if state is None:
+            return None
+        state = self.prepare_loaded_state(state)
+        with self.lock:
+            self.db_manager.rewind(state.id, state.cycle)
+            self.state = state
+        return state
+
     def save_game_state_to_json(self, filename="data/game_state.json"):
-        if self.state is None:
-            raise ValueError("No game in progress")
+        with self.lock:
+            state_dict = self.require_state().to_dict()
         with open(filename, 'w') as f:
-            json.dump(self.state.to_dict(), f)
+            json.dump(state_dict, f)
 
     def load_game_state_from_json(self, filename="data/game_state.json"):
         with open(filename, 'r') as f:
             state_dict = json.load(f)
-        self.state = State.from_dict(state_dict)
+        state = self.prepare_loaded_state(State.from_dict(state_dict))
+        with self.lock:
+            self.state = state
     
     def load_game_from_file(self, filename):
         # Load game from saved file
-        self.state = State.load_game(filename)
+        state = self.prepare_loaded_state(State.load_game(filename))
+        with self.lock:
+            self.state = state
+
+    def prepare_loaded_state(self, state):
+        # A loaded state carries only entities; rebuild the runtime parts this controller uses
+        if self.use_parameter_engine:
+            ParameterEngine(list(state.parameters.keys())).bind(state)
+        self.assistant = state.assistant
+        if self.assistant is not None:
+            self.assistant.use_memory(self.conversation)
+        self.narrative = state.narrative
+        self.country = state.country
+        return state
     
     def stop_simulation(self):
-        # self.save_game_state() TypeError: Object of type Parameter is not JSON serializable
-        self.state = None
-        self.assistant = None
-        self.narrative = None
+        # Waits for a cycle in progress, so it never sees the state disappear halfway
+        with self.lock:
+            try:
+                if self.state is not None:
+                    # Make sure every cycle of the game is committed before it is dropped
+                    self.db_manager.flush()
+            finally:
+                if self.state is not None:
+                    self.db_manager.forget(self.state.id)
+                self.state = None
+                self.assistant = None
+                self.narrative = None
 
@@ -0,0 +1,119 @@
+from typing import Dict, Optional
+import hashlib
+import mmap
+import os
+import re
+import tempfile
+
+from simulation import State
+import serialization
+
+# Simulation ids are uuids and ref names are short words; anything else could escape the store
+NAME_PATTERN = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_.-]{0,127}$")
+
+
+class SnapshotStore:
+    """Content-addressed snapshots of running games, in the binary state format.
+
+    A snapshot is written once under objects/<first two hex digits>/<rest of its sha256>, and a
+    ref file refs/<simulation id>/<ref> names the snapshot a game was last saved to. Saving costs
+    the same at any cycle since history stays in the database. Moving a ref deletes the snapshot
+    it pointed to unless another ref of the same game still needs it, so saving every cycle keeps
+    one snapshot per ref. Restores read the snapshot through mmap and check its digest.
+    """
+
+    def __init__(self, root: str, fsync: bool = False):
+        self.root = root
+        self.fsync = fsync  # also survive an OS crash, at the cost of a sync per save
+
+    def save(self, state: State, ref: str = "saved") -> Dict:
+        return self.save_bytes(state.id, state.cycle, serialization.dumps(state), ref)
+
+    def save_bytes(self, simulation_id: str, cycle: int, data: bytes, ref: str = "saved") -> Dict:
+        ref_path = self._ref_path(simulation_id, ref)
+        digest = hashlib.sha256(data).hexdigest()
+        object_path = self._object_path(digest)
+        # Same bytes, same object: only write what the store does not have yet
+        if not os.path.exists(object_path):
+            self._write_atomically(object_path, data)
+
+        previous = self._read_ref(ref_path)
+        self._write_atomically(ref_path, f"{digest} {cycle}\n".encode("ascii"))
+        if previous is not None and previous[0] != digest and not self._referenced(simulation_id, previous[0]):
+            try:
+                os.remove(self._object_path(previous[0]))
+            except FileNotFoundError:
+                pass
+        return {"digest": digest, "cycle": cycle, "bytes": len(data)}
+
+    def latest(self, simulation_id: str, ref: str = "saved") -> Optional[Dict]:
+        found = self._read_ref(self._ref_path(simulation_id, ref))
+        return {"digest": found[0], "cycle": found[1]} if found is not None else None
+
+    def load_dict(self, simulation_id: str, ref: str = "saved") -> Optional[Dict]:
+        found = self._read_ref(self._ref_path(simulation_id, ref))
+        if found is None:
+            return None
+        digest = found[0]
+        with open(self._object_path(digest), "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            with memoryview(mapped) as data:
+                if hashlib.sha256(data).hexdigest() != digest:
+                    raise ValueError(f"Snapshot {digest} of '{simulation_id}' is corrupted")
+                return serialization.loads_dict(data)
+
+    def restore(self, simulation_id: str, ref: str = "saved") -> Optional[State]:
+        state_dict = self.load_dict(simulation_id, ref)
+        return State.from_dict(state_dict) if state_dict is not None else None
+
+    def refs(self, simulation_id: str) -> Dict[str, Dict]:
+        directory = os.path.join(self.root, "refs", self._checked(simulation_id))
+        if not os.path.isdir(directory):
+            return {}
+        return {ref: self.latest(simulation_id, ref) for ref in sorted(os.listdir(directory)) if NAME_PATTERN.match(ref)}
+
+    def _referenced(self, simulation_id: str, digest: str) -> bool:
+        return any(found["digest"] == digest for found in self.refs(simulation_id).values())
+
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self.root, "objects", digest[:2], digest[2:])
+
+    def _ref_path(self, simulation_id: str, ref: str) -> str:
+        return os.path.join(self.root, "refs", self._checked(simulation_id), self._checked(ref))
+
+    @staticmethod
+    def _checked(name: str) -> str:
+        if not NAME_PATTERN.match(name):
+            raise ValueError(f"Invalid snapshot name '{name}'")
+        return name
+
+    @staticmethod
+    def _read_ref(path: str):
+        try:
+            with open(path, "rb") as f:
+                digest, cycle = f.read().split()
+        except FileNotFoundError:
+            return None
+        return digest.decode("ascii"), int(cycle)
+
+    def _write_atomically(self, path: str, data: bytes):
+        # Write next to the target and rename over it, so a crash leaves the old file or the new one
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temporary = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+                if self.fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(temporary, path)
+        except BaseException:
+            try:
+                os.remove(temporary)
+            except FileNotFoundError:
+                pass
+            raise
+
+
+snapshot_store = SnapshotStore(os.environ.get("SIMULATION_SNAPSHOT_DIR", "snapshots"),
+                               fsync=os.environ.get("SIMULATION_SNAPSHOT_FSYNC", "0") == "1")
@@ -0,0 +1,119 @@
+from typing import Callable, List, Optional
+import logging
+import threading
+import time
+
+
+class WriteFailed(RuntimeError):
+    pass
+
+
+class WriteBehind:
+    """Queue of records written out in batches by one background thread.
+
+    submit() returns as soon as the record is queued. The writer hands everything queued
+    within max_delay seconds to write_batch at once, so many cycles of many sessions share
+    one transaction. At most max_pending records can be queued or in flight; submit() blocks
+    beyond that, which bounds how much a crash can lose. flush() waits until everything
+    submitted so far has been written. A batch that fails to write is handed to on_failure,
+    and the next flush() or close() raises WriteFailed.
+    """
+
+    def __init__(self, write_batch: Callable[[List], None], max_pending: int = 1000, max_delay: float = 0.05,
+                 on_failure: Optional[Callable[[List], None]] = None):
+        if max_pending < 1:
+            raise ValueError("max_pending must be at least 1")
+        self.write_batch = write_batch
+        self.max_pending = max_pending
+        self.max_delay = max_delay
+        self.pending = []
+        self.submitted = 0
+        self.written = 0
+        self.batches = 0
+        self.on_failure = on_failure
+        self.failed = 0  # records lost to failed batches
+        self.reported = 0  # failed records a flush or close has raised for
+        self.flush_waiters = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name="simulation-db-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, record):
+        with self.condition:
+            # Backpressure: wait while the loss bound is reached
+            while self.submitted - self.written >= self.max_pending and not self.closed:
+                self.condition.wait()
+            if self.closed:
+                raise RuntimeError("The write-behind queue is closed")
+            self.pending.append(record)
+            self.submitted += 1
+            # Wake the writer for the first record of a batch, and when the batch is full
+            if len(self.pending) == 1 or len(self.pending) >= self.max_pending:
+                self.condition.notify_all()
+
+    def flush(self):
+        with self.condition:
+            target = self.submitted
+            self.flush_waiters += 1
+            self.condition.notify_all()
+            try:
+                while self.written < target:
+                    self.condition.wait()
+            finally:
+                self.flush_waiters -= 1
+            self._raise_failures()
+
+    def close(self):
+        # Write out what is queued and stop the writer
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+        with self.condition:
+            self._raise_failures()
+
+    def _raise_failures(self):
+        # Called with the condition held; each lost record is reported once
+        if self.failed > self.reported:
+            lost, self.reported = self.failed - self.reported, self.failed
+            raise WriteFailed(f"{lost} records could not be written")
+
+    def _next_batch(self):
+        with self.condition:
+            while not self.pending and not self.closed:
+                self.condition.wait()
+            if not self.pending:
+                return None
+
+            # Give other cycles up to max_delay to join the batch, unless someone is waiting for it
+            deadline = time.monotonic() + self.max_delay
+            while len(self.pending) < self.max_pending and not self.closed and not self.flush_waiters:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+
+            batch, self.pending = self.pending, []
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                self.write_batch(batch)
+            except Exception:
+                logging.exception(f"Failed to write a batch of {len(batch)} records")
+                if self.on_failure is not None:
+                    try:
+                        self.on_failure(batch)
+                    except Exception:
+                        logging.exception("Failed to handle a batch that could not be written")
+                with self.condition:
+                    self.failed += len(batch)
+            with self.condition:
+                self.written += len(batch)
+                self.batches += 1
+                self.condition.notify_all()
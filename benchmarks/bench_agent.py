@@ -0,0 +1,68 @@
+# Per-request cost of answering with a chain rebuilt for every call, as Agent used to, against
+# the warm per-assistant chain. The model is a local stub, so only setup overhead is measured.
+# Run from the repository root: python benchmarks/bench_agent.py [calls]
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+# Building the OpenAI client checks for a key; no request is ever sent
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+
+from langchain import LLMChain, OpenAI
+from langchain.agents import load_tools
+from langchain.callbacks.manager import CallbackManager
+from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
+from langchain.llms.fake import FakeListLLM
+from langchain.memory import ConversationBufferMemory
+from langchain.prompts import PromptTemplate
+
+from agent import Agent, TEMPLATE
+
+DETAILS = {"name": "Ava", "age": 27, "style": "calm", "traits": "concise", "backstory": "Raised in a small town."}
+STATE = "Country: Freedonia, Current narrative: Recovery, Current state of the country: Quality of Life: 52.0"
+
+
+class StubLLM(FakeListLLM):
+    # Always the same answer; a long response list would be hashed into every call's cache key
+    def _call(self, prompt, stop=None, **kwargs):
+        return self.responses[0]
+
+
+def cold_call(stub, tools):
+    # What every call used to build before reaching the model
+    callback_manager = CallbackManager([StreamingStdOutCallbackHandler()])
+    llm = OpenAI(model="text-davinci-003", temperature=0, max_tokens=3000, callback_manager=callback_manager, streaming=True)
+    if tools:
+        load_tools(tools, llm=llm)
+    prompt = PromptTemplate(template=TEMPLATE.format(**DETAILS, state=STATE, input="{input}", chat_history="{chat_history}"),
+                            input_variables=["chat_history", "input"])
+    memory = ConversationBufferMemory(memory_key="chat_history", input_key="input", ai_prefix="Ava", human_prefix="Leader")
+    return LLMChain(llm=stub, prompt=prompt, memory=memory, output_key="output")({"input": "How are we doing?"})["output"]
+
+
+def per_call(function, calls, rounds=5):
+    # Best of a few rounds, to keep garbage collection and other noise out
+    best = float("inf")
+    for _ in range(rounds):
+        begin = time.perf_counter()
+        for _ in range(calls):
+            function()
+        best = min(best, (time.perf_counter() - begin) / calls)
+    return best
+
+
+if __name__ == "__main__":
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    stub = StubLLM(responses=["Things are fine."])
+    # wikipedia needs a package of its own; llm-math stands in for the tool loading
+    cold_with_tools = per_call(lambda: cold_call(stub, ["llm-math"]), calls)
+    cold = per_call(lambda: cold_call(stub, []), calls)
+    warm_agent = Agent(DETAILS, llm=stub)
+    # The warm chain keeps its chat history; clear it so prompts stay the same size as the cold ones
+    warm = per_call(lambda: (warm_agent.generate_response(STATE, "How are we doing?"), warm_agent.memory().clear()), calls)
+    print(f"{calls} calls against a stub model")
+    print(f"{'setup':>28} {'us/call':>9}")
+    print(f"{'rebuilt per call, tools':>28} {cold_with_tools * 1e6:>9.0f}")
+    print(f"{'rebuilt per call':>28} {cold * 1e6:>9.0f}")
+    print(f"{'warm chain':>28} {warm * 1e6:>9.0f}")
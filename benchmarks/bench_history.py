@@ -0,0 +1,54 @@
+# Bytes stored per cycle and cost of rebuilding states for different keyframe intervals.
+# Run from the repository root: python benchmarks/bench_history.py [cycles]
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+from database import DatabaseManager
+from simulation_logic import SimulationController
+
+DECISIONS = ["Lower Taxes", "Invest in Education", "Promote Tourism", "Introduce Universal Healthcare"]
+
+
+def run(keyframe_interval, cycles, directory):
+    db_manager = DatabaseManager(os.path.join(directory, f"history-{keyframe_interval}.db"), keyframe_interval=keyframe_interval)
+    controller = SimulationController(db_manager=db_manager)
+    controller.set_assistant(1)
+    controller.set_country(1)
+    controller.set_narrative(1)
+    controller.start_simulation()
+
+    begin = time.perf_counter()
+    for cycle in range(cycles):
+        controller.make_decision(DECISIONS[cycle % len(DECISIONS)])
+        controller.next_cycle()
+    save_seconds = time.perf_counter() - begin
+
+    db_manager.flush()
+    with db_manager.pool.reading() as cursor:
+        stored, = cursor.execute("SELECT SUM(LENGTH(state) + LENGTH(changes)) FROM simulations").fetchone()
+
+    simulation_id = controller.state.id
+    begin = time.perf_counter()
+    for cycle in range(1, cycles + 1):
+        db_manager.load_state(simulation_id, cycle)
+    rebuild_one = (time.perf_counter() - begin) / cycles
+
+    begin = time.perf_counter()
+    db_manager.load_states(simulation_id)
+    rebuild_all = time.perf_counter() - begin
+
+    return stored / cycles, save_seconds / cycles, rebuild_one, rebuild_all
+
+
+if __name__ == "__main__":
+    cycles = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    print(f"{cycles} cycles")
+    print(f"{'interval':>8} {'bytes/cycle':>12} {'save ms':>8} {'load_state ms':>14} {'load_states ms':>15}")
+    with tempfile.TemporaryDirectory() as directory:
+        for keyframe_interval in (1, 5, 20, 50, 100):
+            per_cycle, save, one, everything = run(keyframe_interval, cycles, directory)
+            print(f"{keyframe_interval:>8} {per_cycle:>12.0f} {save * 1000:>8.3f} {one * 1000:>14.3f} {everything * 1000:>15.1f}")
@@ -0,0 +1,52 @@
+# Peak memory and time to read a long campaign with load_states versus iter_history.
+# Run from the repository root: python benchmarks/bench_history_stream.py [cycles]
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+from database import DatabaseManager
+from simulation_logic import SimulationController
+
+DECISIONS = ["Lower Taxes", "Invest in Education", "Promote Tourism", "Introduce Universal Healthcare"]
+
+
+def measure(read):
+    tracemalloc.start()
+    begin = time.perf_counter()
+    count = read()
+    seconds = time.perf_counter() - begin
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return count, seconds, peak
+
+
+if __name__ == "__main__":
+    cycles = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    with tempfile.TemporaryDirectory() as directory:
+        db_manager = DatabaseManager(os.path.join(directory, "stream.db"))
+        controller = SimulationController(db_manager=db_manager)
+        controller.set_assistant(1)
+        controller.set_country(1)
+        controller.set_narrative(1)
+        controller.start_simulation()
+        for cycle in range(cycles):
+            controller.make_decision(DECISIONS[cycle % len(DECISIONS)])
+            controller.next_cycle()
+        db_manager.flush()
+        simulation_id = controller.state.id
+
+        readers = {
+            "load_states": lambda: len(db_manager.load_states(simulation_id)),
+            "iter_history": lambda: sum(1 for _ in db_manager.iter_history(simulation_id)),
+            "iter_history metrics": lambda: sum(1 for _ in db_manager.iter_history(simulation_id, fields="metrics")),
+        }
+        print(f"{cycles} cycles")
+        print(f"{'reader':>21} {'records':>8} {'seconds':>8} {'peak MiB':>9}")
+        for name, read in readers.items():
+            count, seconds, peak = measure(read)
+            print(f"{name:>21} {count:>8} {seconds:>8.2f} {peak / 2 ** 20:>9.1f}")
+        db_manager.close()
@@ -0,0 +1,62 @@
+# load_states latency as the history table grows, for the legacy unkeyed table and the
+# migrated (id, cycle) primary key. Run from the repository root:
+#     python benchmarks/bench_load_states.py [max_rows]
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+from database import DatabaseManager
+
+CYCLES_PER_GAME = 100
+STATE = json.dumps({"cycle": 0, "metrics": {"Economic Stability": 50.0}})
+QUERIES = 20
+
+
+def fill(conn, table, rows):
+    # Games of CYCLES_PER_GAME cycles, inserted game by game like a running server would
+    conn.execute("BEGIN")
+    conn.executemany(f"INSERT INTO {table} (id, cycle, state, changes, kind) VALUES (?, ?, ?, '{{}}', 'keyframe')",
+                     ((f"game-{row // CYCLES_PER_GAME}", row % CYCLES_PER_GAME, STATE) for row in range(rows)))
+    conn.execute("COMMIT")
+
+
+def time_queries(load, rows):
+    games = rows // CYCLES_PER_GAME
+    begin = time.perf_counter()
+    for query in range(QUERIES):
+        load(f"game-{(query * 7919) % games}")
+    return (time.perf_counter() - begin) / QUERIES
+
+
+def legacy_load(conn):
+    def load(simulation_id):
+        rows = conn.execute("SELECT cycle, state, changes FROM legacy WHERE id = ? ORDER BY cycle", (simulation_id,)).fetchall()
+        return [{cycle: {"state": json.loads(state), "changes": json.loads(changes)}} for cycle, state, changes in rows]
+    return load
+
+
+if __name__ == "__main__":
+    max_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10 ** 6
+    print(f"{'rows':>9} {'legacy ms':>10} {'keyed ms':>9}")
+    rows = 10 ** 3
+    while rows <= max_rows:
+        with tempfile.TemporaryDirectory() as directory:
+            db_manager = DatabaseManager(os.path.join(directory, "keyed.db"))
+            with db_manager.pool.writing() as cursor:
+                fill(cursor.connection, "simulations", rows)
+
+            legacy = sqlite3.connect(os.path.join(directory, "legacy.db"), isolation_level=None)
+            legacy.execute("CREATE TABLE legacy (id TEXT, cycle INTEGER, state TEXT, changes TEXT, kind TEXT)")
+            fill(legacy, "legacy", rows)
+
+            keyed_ms = time_queries(db_manager.load_states, rows) * 1000
+            legacy_ms = time_queries(legacy_load(legacy), rows) * 1000
+            print(f"{rows:>9} {legacy_ms:>10.3f} {keyed_ms:>9.3f}")
+            legacy.close()
+            db_manager.close()
+        rows *= 10
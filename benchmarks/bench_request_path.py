@@ -0,0 +1,65 @@
+# Capacity of the whole request path: concurrent players each start a game, then play rounds of
+# next_cycle plus a question to the assistant, answered by the fake backend with a set latency.
+# Nothing leaves the machine, so the numbers are the server's own cost plus the simulated model.
+# Run from the repository root:
+#   python benchmarks/bench_request_path.py [players] [rounds] [first_token_ms] [token_ms]
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+
+def percentile(values, share):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+
+async def play(client, rounds, latencies):
+    started = await client.get("/simulation/start", params={"assistant_choice": 1, "country_choice": 1, "narrative_choice": 1})
+    session_id = started.json()["session_id"]
+    for number in range(rounds):
+        begin = time.perf_counter()
+        await client.get(f"/simulation/{session_id}/next_cycle")
+        latencies["next_cycle"].append(time.perf_counter() - begin)
+        begin = time.perf_counter()
+        response = await client.post(f"/simulation/{session_id}/generate_response", json={"query": f"Question {number}: what now?"})
+        assert response.status_code == 200 and not response.json()["response"].startswith("An error occurred")
+        latencies["generate_response"].append(time.perf_counter() - begin)
+
+
+async def run(main, players, rounds):
+    import httpx
+    latencies = {"next_cycle": [], "generate_response": []}
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        begin = time.perf_counter()
+        await asyncio.gather(*(play(client, rounds, latencies) for _ in range(players)))
+        seconds = time.perf_counter() - begin
+    return seconds, latencies
+
+
+if __name__ == "__main__":
+    players = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    first_token_ms = sys.argv[3] if len(sys.argv) > 3 else "200"
+    token_ms = sys.argv[4] if len(sys.argv) > 4 else "10"
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ.update(SIMULATION_LLM_BACKEND="fake", SIMULATION_FAKE_LLM_FIRST_TOKEN_MS=first_token_ms,
+                          SIMULATION_FAKE_LLM_TOKEN_MS=token_ms, SIMULATION_RESPONSE_CACHE="0",
+                          SIMULATION_DB=os.path.join(directory, "bench.db"), SIMULATION_SNAPSHOT_DIR=os.path.join(directory, "snapshots"))
+        import main
+
+        seconds, latencies = asyncio.run(run(main, players, rounds))
+        main.db_manager.close()
+
+    requests = sum(len(values) for values in latencies.values())
+    print(f"{players} players x {rounds} rounds, fake model: {first_token_ms} ms to the first token, {token_ms} ms per token after it")
+    print(f"{requests} requests in {seconds:.2f} s, {requests / seconds:.0f} requests/s, "
+          f"{len(latencies['generate_response']) / seconds:.1f} answers/s")
+    print(f"{'route':>18} {'p50 ms':>8} {'p95 ms':>8} {'mean ms':>8}")
+    for route, values in latencies.items():
+        print(f"{route:>18} {percentile(values, 0.5) * 1e3:>8.1f} {percentile(values, 0.95) * 1e3:>8.1f} {statistics.mean(values) * 1e3:>8.1f}")
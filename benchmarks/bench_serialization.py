@@ -0,0 +1,50 @@
+# Size and encode/decode time of one game state in the JSON, pickle and binary formats.
+# Run from the repository root: python benchmarks/bench_serialization.py [repeats]
+import json
+import os
+import pickle
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+import serialization
+from simulation import State
+from simulation_logic import SimulationController
+
+
+def started_state():
+    controller = SimulationController(db_name=":memory:")
+    controller.set_assistant(1)
+    controller.set_country(1)
+    controller.set_narrative(1)
+    controller.start_simulation()
+    for decision in ("Lower Taxes", "Invest in Education", "Promote Tourism"):
+        controller.make_decision(decision)
+        controller.next_cycle()
+    return controller.state
+
+
+if __name__ == "__main__":
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    state = started_state()
+
+    # (encode, decode to a dictionary or None, decode to a State)
+    formats = {
+        "json": (lambda: json.dumps(state.to_dict()).encode("utf-8"), json.loads, lambda data: State.from_dict(json.loads(data))),
+        "pickle": (lambda: pickle.dumps(state), None, pickle.loads),
+    }
+    for compression in ("none", "zlib", "zstd"):
+        if compression == "zstd" and serialization.zstandard is None:
+            continue
+        formats[f"binary/{compression}"] = (lambda compression=compression: serialization.dumps(state, compression),
+                                            serialization.loads_dict,
+                                            lambda data: State.from_dict(serialization.loads_dict(data)))
+
+    print(f"{'format':>12} {'bytes':>7} {'encode us':>10} {'to dict us':>11} {'to State us':>12}")
+    for name, (encode, decode_dict, decode_state) in formats.items():
+        data = encode()
+        encode_us = timeit.timeit(encode, number=repeats) / repeats * 1e6
+        dict_us = timeit.timeit(lambda: decode_dict(data), number=repeats) / repeats * 1e6 if decode_dict else float("nan")
+        state_us = timeit.timeit(lambda: decode_state(data), number=repeats) / repeats * 1e6
+        print(f"{name:>12} {len(data):>7} {encode_us:>10.1f} {dict_us:>11.1f} {state_us:>12.1f}")
@@ -0,0 +1,45 @@
+# Cycles per second of several games played side by side, committing every cycle versus
+# batching cycles through the write-behind queue. Run from the repository root:
+#     python benchmarks/bench_write_behind.py [cycles_per_game] [games]
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+
+from database import DatabaseManager
+from simulation_logic import SimulationController
+
+
+def run(write_behind, cycles, games, directory):
+    db_manager = DatabaseManager(os.path.join(directory, f"write-behind-{write_behind}.db"), write_behind=write_behind)
+    controllers = []
+    for _ in range(games):
+        controller = SimulationController(use_parameter_engine=True, db_manager=db_manager)
+        controller.set_assistant(1)
+        controller.set_country(1)
+        controller.set_narrative(1)
+        controller.start_simulation()
+        controllers.append(controller)
+
+    writer = db_manager.writer
+    begin = time.perf_counter()
+    for cycle in range(cycles):
+        for controller in controllers:
+            controller.make_decision("Lower Taxes" if cycle % 2 else "Invest in Education")
+            controller.next_cycle()
+    db_manager.close()
+    elapsed = time.perf_counter() - begin
+    batches = writer.batches if writer is not None else cycles * games
+    return cycles * games / elapsed, batches
+
+
+if __name__ == "__main__":
+    cycles = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    games = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    with tempfile.TemporaryDirectory() as directory:
+        for write_behind in (False, True):
+            rate, transactions = run(write_behind, cycles, games, directory)
+            label = "write-behind" if write_behind else "commit per cycle"
+            print(f"{label:>17}: {rate:8.0f} cycles/s in {transactions} transactions")
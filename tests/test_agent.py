@@ -0,0 +1,62 @@
+import asyncio
+
+from langchain.llms.fake import FakeListLLM
+
+import llm_backends
+from agent import Agent, ERROR_PREFIX, TokenQueueHandler
+
+DETAILS = {"name": "Ava", "age": 27, "style": "calm", "traits": "concise", "backstory": "Raised in a small town."}
+
+
+class RecordingLLM(FakeListLLM):
+    prompts: list = []
+
+    def _call(self, prompt, stop=None, **kwargs):
+        self.prompts.append(prompt)
+        return super()._call(prompt, stop, **kwargs)
+
+
+class StreamingLLM(FakeListLLM):
+    # Hands its answer to the callbacks word by word, like a streaming model does
+    def _call(self, prompt, stop=None, run_manager=None, **kwargs):
+        response = super()._call(prompt, stop, **kwargs)
+        for word in response.split(" "):
+            if run_manager:
+                run_manager.on_llm_new_token(word + " ")
+        return response
+
+
+def test_chain_is_built_once_and_keeps_the_conversation():
+    llm = RecordingLLM(responses=["First answer", "Second answer"], prompts=[])
+    assistant = Agent(DETAILS, llm=llm)
+
+    assert assistant.generate_response("Cycle 1 state", "How are we doing?") == "First answer"
+    chain = assistant.chain()
+    assert assistant.generate_response("Cycle 2 state", "And now?") == "Second answer"
+    assert assistant.chain() is chain
+
+    # The state is a prompt input, the persona is filled in once, and the history carries over
+    assert "Cycle 1 state" in llm.prompts[0] and "Cycle 2 state" in llm.prompts[1]
+    assert "Your name is Ava." in llm.prompts[1]
+    assert "Leader: How are we doing?" in llm.prompts[1] and "Ava: First answer" in llm.prompts[1]
+    # Tools are only loaded for the agent mode
+    assert assistant._tools is None and assistant._agent is None
+    assert llm_backends._backend is None
+
+
+def test_tokens_reach_the_handler_and_cancel_stops_the_generation():
+    loop = asyncio.new_event_loop()
+    try:
+        tokens = asyncio.Queue()
+        handler = TokenQueueHandler(loop, tokens)
+        assistant = Agent(DETAILS, llm=StreamingLLM(responses=["Hold the course", "Never seen"]))
+        assert assistant.generate_response("Cycle 1 state", "What now?", callbacks=[handler]) == "Hold the course"
+        loop.run_until_complete(asyncio.sleep(0))
+        assert [tokens.get_nowait() for _ in range(tokens.qsize())] == ["Hold ", "the ", "course "]
+
+        handler.cancel()
+        assert assistant.generate_response("Cycle 2 state", "And now?", callbacks=[handler]).startswith(ERROR_PREFIX)
+        loop.run_until_complete(asyncio.sleep(0))
+        assert tokens.empty()
+    finally:
+        loop.close()
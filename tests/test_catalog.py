@@ -0,0 +1,36 @@
+import json
+import os
+
+import pytest
+
+from catalog import Catalog
+
+
+def test_files_are_frozen_and_reloaded_when_they_change(tmp_path):
+    path = tmp_path / "countries.json"
+    path.write_text(json.dumps([{"name": "Canada"}]))
+    catalog = Catalog(check_interval=0)
+
+    countries = catalog.read(str(path))
+    assert catalog.read(str(path)) is countries
+    with pytest.raises(TypeError):
+        countries[0]["name"] = "Mexico"
+
+    path.write_text(json.dumps([{"name": "Canada"}, {"name": "Mexico"}]))
+    os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 1_000_000))
+    assert [country["name"] for country in catalog.read(str(path))] == ["Canada", "Mexico"]
+
+
+def test_response_bytes_follow_the_file(tmp_path):
+    path = tmp_path / "countries.json"
+    path.write_text(json.dumps([{"name": "Canada", "size": 1}]))
+    catalog = Catalog(check_interval=0)
+    build = lambda countries: {"countries": [{"name": country["name"]} for country in countries]}
+
+    body = catalog.response_bytes("countries", str(path), build)
+    assert json.loads(body) == {"countries": [{"name": "Canada"}]}
+    assert catalog.response_bytes("countries", str(path), build) is body
+
+    path.write_text(json.dumps([{"name": "Peru", "size": 1}]))
+    os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 1_000_000))
+    assert json.loads(catalog.response_bytes("countries", str(path), build)) == {"countries": [{"name": "Peru"}]}
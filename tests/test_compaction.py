@@ -0,0 +1,91 @@
+import sqlite3
+import time
+
+from compaction import Compactor, convert_to_incremental_vacuum
+from database import DatabaseManager
+from simulation_logic import SimulationController
+
+DAY = 86400
+
+
+def play(db_manager, cycles):
+    controller = SimulationController(db_manager=db_manager)
+    controller.set_assistant(1)
+    controller.set_country(1)
+    controller.set_narrative(1)
+    controller.start_simulation()
+    expected = {}
+    for cycle in range(cycles):
+        controller.make_decision(["Lower Taxes", "Invest in Education", "Promote Tourism"][cycle % 3])
+        controller.next_cycle()
+        expected[controller.state.cycle] = controller.state.to_dict()
+    controller.stop_simulation()
+    return expected
+
+
+def stored(db_manager, simulation_id):
+    return {list(record)[0]: list(record.values())[0]["state"] for record in db_manager.load_states(simulation_id)}
+
+
+def test_old_games_are_downsampled_and_recent_ones_kept(tmp_path):
+    db_manager = DatabaseManager(str(tmp_path / "history.db"), keyframe_interval=4)
+    old = play(db_manager, 42)
+    old_id = old[1]["id"]
+    recent = play(db_manager, 12)
+    # Only the first game is older than the retention window
+    with db_manager.pool.writing() as cursor:
+        cursor.execute("UPDATE games SET updated_at = updated_at - ? WHERE id = ?", (2 * DAY, old_id))
+
+    compactor = Compactor(db_manager, keep_all_for=DAY, downsample_every=10, archive_after=0, archive_dir=str(tmp_path / "archives"))
+    report = compactor.run()
+
+    assert report["downsampled"] == 1 and report["archived"] == 0
+    assert report["rows_deleted"] > 0 and report["bytes_reclaimed"] > 0
+    assert stored(db_manager, old_id) == {cycle: old[cycle] for cycle in (10, 20, 30, 40, 42)}
+    assert stored(db_manager, recent[1]["id"]) == recent
+    assert db_manager.load_series(old_id, ["metrics.Quality of Life"])["cycles"] == [10, 20, 30, 40, 42]
+    with db_manager.pool.reading() as cursor:
+        kinds = [kind for kind, in cursor.execute("SELECT kind FROM simulations WHERE id = ? ORDER BY cycle", (old_id,))]
+    assert kinds[-1] == "keyframe"
+
+    # A second run finds nothing left to do
+    assert compactor.run()["downsampled"] == 0
+
+
+def test_abandoned_games_move_to_archives(tmp_path):
+    db_manager = DatabaseManager(str(tmp_path / "history.db"), keyframe_interval=4)
+    abandoned = play(db_manager, 9)
+    live = play(db_manager, 3)
+    live_id = live[1]["id"]
+
+    compactor = Compactor(db_manager, keep_all_for=DAY, downsample_every=10, archive_after=DAY,
+                          archive_dir=str(tmp_path / "archives"), active_ids=lambda: [live_id])
+    report = compactor.run(now=time.time() + 2 * DAY)
+
+    assert report["archived"] == 1 and report["archive_bytes"] > 0
+    abandoned_id = abandoned[1]["id"]
+    assert db_manager.load_states(abandoned_id) == []
+    assert {record["cycle"]: record["state"] for record in compactor.read_archive(abandoned_id)} == abandoned
+    assert len(db_manager.load_states(live_id)) == 3
+
+
+def test_older_databases_switch_to_incremental_vacuum_only_offline(tmp_path):
+    path = str(tmp_path / "legacy.db")
+    legacy = sqlite3.connect(path)
+    legacy.execute("CREATE TABLE simulations (id TEXT, cycle INTEGER, state TEXT, changes TEXT)")
+    legacy.execute("""INSERT INTO simulations VALUES ('game', 1, '{"cycle": 1}', '{}')""")
+    legacy.commit()
+    legacy.close()
+
+    db_manager = DatabaseManager(path)
+    with db_manager.pool.reading() as cursor:
+        assert cursor.execute("SELECT id, last_cycle FROM games").fetchall() == [("game", 1)]
+    # The background job never rebuilds the file under the writer
+    assert Compactor(db_manager, archive_after=0).run()["incremental_vacuum"] is False
+    with db_manager.pool.reading() as cursor:
+        assert cursor.execute("PRAGMA auto_vacuum").fetchone()[0] == 0
+
+    assert convert_to_incremental_vacuum(db_manager) is True
+    assert convert_to_incremental_vacuum(db_manager) is False
+    assert Compactor(db_manager, archive_after=0).run()["incremental_vacuum"] is True
+    assert db_manager.load_states("game") == [{1: {"state": {"cycle": 1}, "changes": {}}}]
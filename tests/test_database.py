@@ -0,0 +1,176 @@
+import sqlite3
+import threading
+
+import pytest
+
+from database import DatabaseManager, MIGRATIONS
+from simulation_logic import SimulationController
+
+
+def play(db_manager, cycles):
+    controller = SimulationController(db_manager=db_manager)
+    controller.set_assistant(1)
+    controller.set_country(1)
+    controller.set_narrative(1)
+    controller.start_simulation()
+    expected = {}
+    for cycle in range(cycles):
+        controller.make_decision(["Lower Taxes", "Invest in Education", "Promote Tourism"][cycle % 3])
+        controller.next_cycle()
+        expected[controller.state.cycle] = controller.state.to_dict()
+    return controller, expected
+
+
+def test_keyframes_and_deltas_rebuild_every_cycle():
+    db_manager = DatabaseManager(":memory:", keyframe_interval=4)
+    controller, expected = play(db_manager, 10)
+
+    db_manager.flush()
+    with db_manager.pool.reading() as cursor:
+        kinds = [kind for kind, in cursor.execute("SELECT kind FROM simulations ORDER BY cycle")]
+    assert kinds == ["keyframe", "delta", "delta", "delta"] * 2 + ["keyframe", "delta"]
+
+    history = db_manager.load_states(controller.state.id)
+    assert [list(record)[0] for record in history] == list(expected)
+    for record in history:
+        (cycle, stored), = record.items()
+        assert stored["state"] == expected[cycle]
+    assert db_manager.load_state(controller.state.id, 7)["state"] == expected[7]
+    assert db_manager.load_state(controller.state.id, 11) is None
+
+
+def test_legacy_history_is_migrated_to_a_keyed_wal_table(tmp_path):
+    path = str(tmp_path / "legacy.db")
+    legacy = sqlite3.connect(path)
+    legacy.execute("CREATE TABLE simulations (id TEXT, cycle INTEGER, state TEXT, changes TEXT)")
+    legacy.executemany("INSERT INTO simulations VALUES (?, ?, ?, ?)", [
+        ("game", 2, '{"cycle": 2}', "{}"),
+        ("game", 1, '{"cycle": 1, "old": true}', "{}"),
+        ("game", 1, '{"cycle": 1}', "{}"),
+    ])
+    legacy.commit()
+    legacy.close()
+
+    db_manager = DatabaseManager(path)
+    assert db_manager.schema_version == len(MIGRATIONS)
+    with db_manager.pool.reading() as cursor:
+        assert cursor.execute("PRAGMA user_version").fetchone()[0] == len(MIGRATIONS)
+        assert cursor.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        plan = " ".join(row[-1] for row in cursor.execute("EXPLAIN QUERY PLAN SELECT cycle FROM simulations WHERE id = ? ORDER BY cycle", ("game",)))
+    assert db_manager.load_states("game") == [{1: {"state": {"cycle": 1}, "changes": {}}}, {2: {"state": {"cycle": 2}, "changes": {}}}]
+    assert "USING" in plan and "TEMP B-TREE" not in plan
+
+    # Opening an up-to-date database runs no migration again
+    assert DatabaseManager(path).load_states("game") == db_manager.load_states("game")
+
+
+def test_series_follow_the_stored_cycles():
+    db_manager = DatabaseManager(":memory:", keyframe_interval=4)
+    controller, expected = play(db_manager, 6)
+
+    series = db_manager.load_series(controller.state.id, ["metrics.Quality of Life", "parameters.Economy"], from_cycle=2, to_cycle=5)
+    assert series["cycles"] == [2, 3, 4, 5]
+    assert series["series"]["metrics.Quality of Life"] == [expected[cycle]["metrics"]["Quality of Life"] for cycle in range(2, 6)]
+    assert series["series"]["parameters.Economy"] == [expected[cycle]["parameters"]["Economy"]["value"] for cycle in range(2, 6)]
+    assert len(db_manager.load_series(controller.state.id)["series"]) == len(expected[1]["parameters"]) + len(expected[1]["metrics"])
+
+
+def test_readers_make_progress_while_cycles_are_written(tmp_path):
+    db_manager = DatabaseManager(str(tmp_path / "stress.db"), keyframe_interval=5, write_behind=False, readers=3, busy_timeout_ms=10000)
+    controller = SimulationController(db_manager=db_manager)
+    controller.set_assistant(1)
+    controller.set_country(1)
+    controller.set_narrative(1)
+    controller.start_simulation()
+    simulation_id = controller.state.id
+
+    writing = threading.Event()
+    writing.set()
+    reads = []
+    errors = []
+
+    def read():
+        count = 0
+        try:
+            while writing.is_set():
+                cycles = [list(record)[0] for record in db_manager.load_states(simulation_id)]
+                # Readers see whole committed cycles, never a gap
+                assert cycles == list(range(1, len(cycles) + 1))
+                count += 1
+        except Exception as error:
+            errors.append(error)
+        reads.append(count)
+
+    readers = [threading.Thread(target=read) for _ in range(4)]
+    for reader in readers:
+        reader.start()
+    try:
+        for cycle in range(60):
+            controller.make_decision(["Lower Taxes", "Invest in Education", "Promote Tourism"][cycle % 3])
+            controller.next_cycle()
+    finally:
+        writing.clear()
+        for reader in readers:
+            reader.join()
+
+    assert not errors
+    assert len(reads) == 4 and all(count > 0 for count in reads)
+    assert 1 < db_manager.pool.opened <= 3
+    assert len(db_manager.load_states(simulation_id)) == 60
+
+    with db_manager.pool.reading() as cursor:
+        with pytest.raises(sqlite3.OperationalError):
+            cursor.execute("DELETE FROM simulations")
+    db_manager.close()
+
+
+def test_history_pages_and_fields_follow_the_stored_cycles():
+    db_manager = DatabaseManager(":memory:", keyframe_interval=4)
+    controller, expected = play(db_manager, 11)
+    simulation_id = controller.state.id
+
+    pages, after = [], None
+    while True:
+        page = db_manager.load_history_page(simulation_id, after_cycle=after, limit=3, from_cycle=2, to_cycle=10)
+        pages.append([record["cycle"] for record in page["items"]])
+        after = page["next_cursor"]
+        if after is None:
+            break
+    assert pages == [[2, 3, 4], [5, 6, 7], [8, 9, 10]]
+    assert db_manager.load_history_page(simulation_id, after_cycle=10, limit=3, to_cycle=10) == {"items": [], "next_cursor": None}
+
+    # Streaming starts mid-way between keyframes and reads in small batches
+    records = list(db_manager.iter_history(simulation_id, from_cycle=6, batch_size=2))
+    assert [record["state"] for record in records] == [expected[cycle] for cycle in range(6, 12)]
+    metrics = list(db_manager.iter_history(simulation_id, from_cycle=6, to_cycle=7, fields="metrics"))
+    assert metrics == [{"cycle": cycle, "metrics": expected[cycle]["metrics"], "changes": records[cycle - 6]["changes"]} for cycle in (6, 7)]
+    parameters = next(db_manager.iter_history(simulation_id, from_cycle=9, fields="parameters"))["parameters"]
+    assert parameters == {name: parameter["value"] for name, parameter in expected[9]["parameters"].items()}
+    with pytest.raises(ValueError):
+        db_manager.iter_history(simulation_id, fields="everything")
+
+
+def test_a_lost_keyframe_is_written_again(monkeypatch):
+    from write_behind import WriteFailed
+
+    db_manager = DatabaseManager(":memory:", keyframe_interval=4, write_behind=True, max_delay=0)
+    write_records = db_manager.write_records
+    failures = [OSError("disk full")]
+
+    def fail_once(records):
+        if failures:
+            raise failures.pop()
+        write_records(records)
+
+    monkeypatch.setattr(db_manager.writer, "write_batch", fail_once)
+    controller, expected = play(db_manager, 1)
+    with pytest.raises(WriteFailed):
+        db_manager.flush()
+
+    for _ in range(3):
+        controller.next_cycle()
+        expected[controller.state.cycle] = controller.state.to_dict()
+    history = db_manager.load_states(controller.state.id)
+    assert [list(record)[0] for record in history] == [2, 3, 4]
+    assert history[0][2]["state"] == expected[2]
+    db_manager.close()
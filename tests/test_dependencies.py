@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+from dependencies import DependencyGraph
+
+
+def test_cycles_are_rejected_on_load():
+    with pytest.raises(ValueError, match="cycle"):
+        DependencyGraph({"A": ["C"], "B": ["A"], "C": ["B"], "D": []})
+
+
+def test_unknown_dependencies_are_rejected_on_load():
+    with pytest.raises(ValueError, match="unknown parameter 'Missing'"):
+        DependencyGraph({"A": ["Missing"]})
+
+
+def test_changes_propagate_down_the_whole_chain():
+    graph = DependencyGraph({"Economy": [], "Education": [], "Employment Rate": ["Economy", "Education"],
+                             "Job Satisfaction": ["Employment Rate"], "Literacy Rate": ["Education"]})
+
+    induced = graph.propagate({"Economy": 10})
+
+    assert induced == {"Employment Rate": 5, "Job Satisfaction": 5}
+
+
+def test_propagation_matches_propagation_matrix():
+    graph = DependencyGraph({"A": [], "B": [], "C": ["A", "B"], "D": ["C", "A"], "E": ["D"]})
+    changes = {"A": 4.0, "C": 2.0}
+
+    induced = graph.propagate(changes)
+
+    direct = np.array([changes.get(name, 0.0) for name in graph.names])
+    total = graph.propagation_matrix() @ direct
+    expected = {name: total[i] - direct[i] for i, name in enumerate(graph.names) if name in induced}
+    assert induced == pytest.approx(expected)
+    assert "B" not in induced
@@ -0,0 +1,99 @@
+import json
+
+import pytest
+
+from database import DatabaseManager
+from export import export, export_series, iter_batches
+from simulation_logic import SimulationController
+
+
+def play(db_manager, cycles, controller=None):
+    if controller is None:
+        controller = SimulationController(db_manager=db_manager)
+        controller.set_assistant(1)
+        controller.set_country(1)
+        controller.set_narrative(1)
+        controller.start_simulation()
+    for cycle in range(cycles):
+        controller.make_decision(["Lower Taxes", "Invest in Education", "Promote Tourism"][cycle % 3])
+        controller.next_cycle()
+    return controller
+
+
+def test_batches_hold_one_column_per_series_in_bounded_chunks():
+    db_manager = DatabaseManager(":memory:")
+    controller = play(db_manager, 7)
+    series = export_series(db_manager)
+
+    batches = list(iter_batches(db_manager, {}, series, chunk_cycles=3))
+    assert [(simulation_id, last, columns["cycle"]) for _, simulation_id, _, last, columns in batches] == [
+        (controller.state.id, 2, [1, 2]),
+        (controller.state.id, 5, [3, 4, 5]),
+        (controller.state.id, 7, [6, 7]),
+    ]
+    columns = batches[-1][4]
+    assert set(columns) == {"simulation_id", "timeline", "cycle"} | {name for _, name in series}
+    assert columns["metrics.Quality of Life"][-1] == controller.state.metrics["Quality of Life"]
+    assert columns["parameters.Economy"][-1] == controller.state.parameters["Economy"].value
+
+    # Only the cycles after the watermark are read again
+    assert [columns["cycle"] for *_, columns in iter_batches(db_manager, {controller.state.id: 6}, series)] == [[7]]
+
+
+@pytest.mark.parametrize("file_format", ["parquet", "arrow"])
+def test_exports_are_incremental_and_partitioned(tmp_path, file_format):
+    pyarrow = pytest.importorskip("pyarrow")
+    import pyarrow.dataset
+
+    db_manager = DatabaseManager(":memory:")
+    controller = play(db_manager, 5)
+    out = tmp_path / "exports"
+
+    first = export(db_manager, str(out), file_format)
+    play(db_manager, 3, controller)
+    second = export(db_manager, str(out), file_format)
+    assert (first["rows"], second["rows"]) == (5, 3)
+    assert export(db_manager, str(out), file_format)["rows"] == 0
+
+    manifest = json.loads((out / "manifest.json").read_text())
+    assert manifest["games"] == {controller.state.id: 8}
+    assert all(name.startswith("created=") for run in manifest["runs"] for name in run["files"])
+
+    dataset = pyarrow.dataset.dataset(str(out), format="parquet" if file_format == "parquet" else "ipc",
+                                      partitioning="hive", exclude_invalid_files=True)
+    table = dataset.to_table().sort_by("cycle")
+    assert table.column("cycle").to_pylist() == list(range(1, 9))
+    assert table.column("metrics.Quality of Life").to_pylist()[-1] == controller.state.metrics["Quality of Life"]
+
+
+def test_a_restored_game_is_exported_again_as_a_new_timeline(tmp_path):
+    pyarrow = pytest.importorskip("pyarrow")
+    import pyarrow.compute
+    import pyarrow.dataset
+    from snapshots import SnapshotStore
+
+    db_manager = DatabaseManager(":memory:")
+    controller = SimulationController(db_manager=db_manager, snapshots=SnapshotStore(str(tmp_path / "snapshots")))
+    controller.set_assistant(1)
+    controller.set_country(1)
+    controller.set_narrative(1)
+    controller.start_simulation()
+    play(db_manager, 3, controller)
+    controller.save_game_state()
+    play(db_manager, 2, controller)
+    out = tmp_path / "exports"
+    assert export(db_manager, str(out))["rows"] == 5
+
+    controller.restore_game_state(controller.state.id)
+    play(db_manager, 4, controller)
+    second = export(db_manager, str(out))
+    assert (second["rows"], second["rewound"]) == (7, 1)
+    manifest = json.loads((out / "manifest.json").read_text())
+    assert manifest["games"] == {controller.state.id: 7} and manifest["timelines"] == {controller.state.id: 1}
+
+    # Readers keep the latest timeline of each game
+    table = pyarrow.dataset.dataset(str(out), format="parquet", partitioning="hive", exclude_invalid_files=True).to_table()
+    latest = table.filter(pyarrow.compute.equal(table.column("timeline"), 1)).sort_by("cycle")
+    assert latest.column("cycle").to_pylist() == list(range(1, 8))
+    assert latest.column("metrics.Quality of Life").to_pylist()[-1] == controller.state.metrics["Quality of Life"]
+    assert table.num_rows == 12
@@ -0,0 +1,58 @@
+import time
+
+import pytest
+from langchain.callbacks.base import BaseCallbackHandler
+
+import llm_backends
+from agent import Agent
+from llm_backends import FakeBackend, LlamaCppBackend, FakeLLM
+
+
+class Collect(BaseCallbackHandler):
+    def __init__(self):
+        self.tokens = []
+
+    def on_llm_new_token(self, token, **kwargs):
+        self.tokens.append(token)
+
+
+@pytest.fixture
+def fake_backend():
+    backend = FakeBackend(first_token_ms=20, token_ms=1)
+    llm_backends.set_backend(backend)
+    yield backend
+    llm_backends.set_backend(None)
+
+
+def test_fake_llm_is_deterministic_and_streams_its_answer():
+    llm = FakeLLM()
+    collect = Collect()
+    answer = llm("Cycle 3: how are we doing?", callbacks=[collect])
+    assert answer == llm("Cycle 3: how are we doing?") and answer in llm_backends.FAKE_ANSWERS
+    assert "".join(collect.tokens) == answer and len(collect.tokens) > 1
+
+
+def test_agents_share_the_configured_backend(fake_backend):
+    first = Agent({"name": "Ava", "age": 27, "style": "calm", "traits": "concise", "backstory": "Raised in a small town."})
+    second = Agent({"name": "Max", "age": 40, "style": "blunt", "traits": "bold", "backstory": "A former general."})
+    begin = time.perf_counter()
+    assert first.generate_response("Cycle 1 state", "What now?") in llm_backends.FAKE_ANSWERS
+    assert time.perf_counter() - begin >= 0.02
+    assert first.get_llm() is second.get_llm() is fake_backend.load()
+
+
+def test_backends_are_chosen_by_name(monkeypatch):
+    monkeypatch.setenv("SIMULATION_LLM_BACKEND", "fake")
+    llm_backends.set_backend(None)
+    try:
+        assert isinstance(llm_backends.get_backend(), FakeBackend)
+        monkeypatch.setenv("SIMULATION_LLM_BACKEND", "gpt-9")
+        llm_backends.set_backend(None)
+        with pytest.raises(ValueError):
+            llm_backends.get_backend()
+    finally:
+        llm_backends.set_backend(None)
+
+    monkeypatch.delenv("SIMULATION_LLAMA_MODEL_PATH", raising=False)
+    with pytest.raises(RuntimeError):
+        LlamaCppBackend().load()
@@ -0,0 +1,231 @@
+import asyncio
+import json
+import threading
+import time
+
+import httpx
+import pytest
+
+from assistant import Assistant
+
+
+@pytest.fixture(scope="module")
+def main_module(tmp_path_factory):
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setenv("SIMULATION_DB", str(tmp_path_factory.mktemp("db") / "simulation.db"))
+        monkeypatch.setenv("SIMULATION_EXPORT_DIR", str(tmp_path_factory.mktemp("exports")))
+        import snapshots
+        monkeypatch.setattr(snapshots.snapshot_store, "root", str(tmp_path_factory.mktemp("snapshots")))
+        import main
+        yield main
+
+
+def test_state_reads_are_served_while_llm_call_is_in_flight(main_module, monkeypatch):
+    # Stands in for an LLM reply that only arrives when released
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_generate_response(self, state_history, query, callbacks=None):
+        started.set()
+        release.wait(timeout=10)
+        return "Slow answer"
+
+    monkeypatch.setattr(Assistant, "generate_response", slow_generate_response)
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=main_module.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+            started_game = await client.get("/simulation/start", params={"assistant_choice": 1, "country_choice": 1, "narrative_choice": 1})
+            session_id = started_game.json()["session_id"]
+
+            slow = asyncio.create_task(client.post(f"/simulation/{session_id}/generate_response", json={"query": "What now?"}))
+            for _ in range(500):
+                if started.is_set():
+                    break
+                await asyncio.sleep(0.01)
+            assert started.is_set()
+
+            begin = time.perf_counter()
+            for _ in range(20):
+                response = await client.get(f"/simulation/{session_id}/state")
+                assert response.status_code == 200
+            response = await client.get(f"/simulation/{session_id}/next_cycle")
+            assert response.status_code == 200
+            elapsed = time.perf_counter() - begin
+
+            assert not slow.done()
+            release.set()
+            answer = await slow
+            return elapsed, answer.json()
+
+    elapsed, answer = asyncio.run(scenario())
+    assert elapsed < 2
+    assert answer == {"response": "Slow answer"}
+
+
+def test_generate_response_streams_tokens_before_the_answer(main_module, monkeypatch):
+    def streaming_generate_response(self, state_history, query, callbacks=None):
+        for token in ("Hold ", "the ", "course"):
+            for handler in callbacks or ():
+                handler.on_llm_new_token(token)
+        return "Hold the course"
+
+    monkeypatch.setattr(Assistant, "generate_response", streaming_generate_response)
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=main_module.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+            started_game = await client.get("/simulation/start", params={"assistant_choice": 1, "country_choice": 1, "narrative_choice": 1})
+            session_id = started_game.json()["session_id"]
+            streamed = await client.post(f"/simulation/{session_id}/generate_response/stream", json={"query": "Where do we stand?"})
+            # The second time the answer comes from the response cache, without tokens
+            cached = await client.post(f"/simulation/{session_id}/generate_response/stream", json={"query": "Where do we stand?"})
+            return streamed, cached
+
+    streamed, cached = asyncio.run(scenario())
+    assert streamed.headers["content-type"] == "application/x-ndjson"
+    assert [json.loads(line) for line in streamed.text.splitlines()] == [
+        {"token": "Hold "}, {"token": "the "}, {"token": "course"}, {"response": "Hold the course"}]
+    assert [json.loads(line) for line in cached.text.splitlines()] == [{"response": "Hold the course"}]
+
+
+def test_rollout_request_bounds_are_validated(main_module):
+    async def scenario():
+        transport = httpx.ASGITransport(app=main_module.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+            started_game = await client.get("/simulation/start", params={"assistant_choice": 1, "country_choice": 1, "narrative_choice": 1})
+            session_id = started_game.json()["session_id"]
+            return [
+                (await client.post(f"/simulation/{session_id}/rollouts", json=body)).status_code
+                for body in ({"trials": 0}, {"cycles": 10 ** 6}, {"percentiles": [50, 101]}, {"trials": 10, "cycles": 2})
+            ]
+
+    assert asyncio.run(scenario()) == [422, 422, 422, 200]
+
+
+def test_setup_routes_only_validate_choices(main_module):
+    async def scenario():
+        transport = httpx.ASGITransport(app=main_module.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+            assert (await client.get("/set_assistant/2")).status_code == 200
+            assert (await client.get("/set_narrative/99")).status_code == 400
+            assert (await client.get("/simulation/start", params={"narrative_choice": 99})).status_code == 400
+            # A choice made through set_* does not leak into games started by other players
+            started_game = await client.get("/simulation/start", params={"assistant_choice": 1, "country_choice": 1})
+            state = (await client.get(f"/simulation/{started_game.json()['session_id']}/state")).json()["state"]
+            return state["assistant"]["name"], state["narrative"]
+
+    assistant_name, narrative = asyncio.run(scenario())
+    assert assistant_name == main_module.catalog.read("data/assistants.json")[0]["name"]
+    assert narrative is None
+
+
+def test_series_endpoint_returns_compact_arrays(main_module):
+    async def scenario():
+        transport = httpx.ASGITransport(app=main_module.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+            started_game = await client.get("/simulation/start", params={"assistant_choice": 1, "country_choice": 1, "narrative_choice": 1})
+            session_id = started_game.json()["session_id"]
+            for _ in range(3):
+                await client.get(f"/simulation/{session_id}/next_cycle")
+            series = await client.get(f"/simulation/{session_id}/series", params={"names": "metrics.Quality of Life,parameters.Economy", "from": 2})
+            unknown = await client.get(f"/simulation/{session_id}/series", params={"names": "parameters.Nothing"})
+            return series, unknown
+
+    series, unknown = asyncio.run(scenario())
+    assert series.json()["cycles"] == [2, 3]
+    assert list(series.json()["series"]) == ["metrics.Quality of Life", "parameters.Economy"]
+    assert len(series.content) < 200
+    assert unknown.status_code == 400
+
+
+def test_history_endpoint_pages_and_streams(main_module):
+    async def scenario():
+        transport = httpx.ASGITransport(app=main_module.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+            started_game = await client.get("/simulation/start", params={"assistant_choice": 1, "country_choice": 1, "narrative_choice": 1})
+            session_id = started_game.json()["session_id"]
+            for _ in range(5):
+                await client.get(f"/simulation/{session_id}/next_cycle")
+            first = await client.get(f"/simulation/{session_id}/history", params={"limit": 2, "fields": "metrics"})
+            second = await client.get(f"/simulation/{session_id}/history", params={"limit": 2, "fields": "metrics", "cursor": first.json()["next_cursor"]})
+            streamed = await client.get(f"/simulation/{session_id}/history", params={"format": "ndjson", "from": 2, "fields": "parameters"})
+            unknown = await client.get(f"/simulation/{session_id}/history", params={"fields": "everything"})
+            return first, second, streamed, unknown
+
+    first, second, streamed, unknown = asyncio.run(scenario())
+    assert [record["cycle"] for record in first.json()["items"]] == [1, 2]
+    assert [record["cycle"] for record in second.json()["items"]] == [3, 4]
+    assert set(first.json()["items"][0]) == {"cycle", "metrics", "changes"}
+    assert streamed.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in streamed.text.splitlines()]
+    assert [line["cycle"] for line in lines] == [2, 3, 4, 5]
+    assert "Economy" in lines[0]["parameters"]
+    assert unknown.status_code == 400
+
+
+def test_saved_games_can_be_restored_as_sessions(main_module):
+    async def scenario():
+        transport = httpx.ASGITransport(app=main_module.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+            started_game = await client.get("/simulation/start", params={"assistant_choice": 1, "country_choice": 1, "narrative_choice": 1})
+            session_id = started_game.json()["session_id"]
+            await client.get(f"/simulation/{session_id}/next_cycle")
+            saved = await client.post(f"/simulation/{session_id}/save")
+            before = await client.get(f"/simulation/{session_id}/state")
+            await client.get(f"/simulation/{session_id}/next_cycle")
+            restored = await client.post(f"/simulation/{session_id}/restore")
+            state = await client.get(f"/simulation/{session_id}/state")
+            missing = await client.post(f"/simulation/{session_id}/restore", params={"ref": "nothing"})
+            return saved, before, restored, state, missing
+
+    saved, before, restored, state, missing = asyncio.run(scenario())
+    assert saved.json()["snapshot"]["cycle"] == 1
+    assert restored.json()["status"] == "Simulation restored"
+    assert state.json() == before.json()
+    assert missing.status_code == 404
+
+
+def test_restore_stops_the_session_it_replaces(main_module):
+    async def scenario():
+        transport = httpx.ASGITransport(app=main_module.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+            started_game = await client.get("/simulation/start", params={"assistant_choice": 1, "country_choice": 1, "narrative_choice": 1})
+            session_id = started_game.json()["session_id"]
+            await client.post(f"/simulation/{session_id}/save")
+            replaced = main_module.sessions.get(session_id)
+            missing = await client.post(f"/simulation/{session_id}/restore", params={"ref": "nothing"})
+            assert main_module.sessions.get(session_id) is replaced and replaced.state is not None
+            await client.post(f"/simulation/{session_id}/restore")
+            return replaced, main_module.sessions.get(session_id), missing
+
+    replaced, restored, missing = asyncio.run(scenario())
+    assert missing.status_code == 404
+    assert restored is not replaced
+    assert replaced.state is None and restored.state is not None
+    assert restored.conversation is replaced.conversation
+
+
+def test_assistant_routes_conflict_without_a_running_game(main_module):
+    async def scenario():
+        transport = httpx.ASGITransport(app=main_module.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+            started_game = await client.get("/simulation/start", params={"assistant_choice": 1, "country_choice": 1, "narrative_choice": 1})
+            session_id = started_game.json()["session_id"]
+            main_module.sessions.get(session_id).stop_simulation()
+            return [
+                (await client.get(f"/simulation/{session_id}/news")).status_code,
+                (await client.get(f"/simulation/{session_id}/generate_decision")).status_code,
+                (await client.post(f"/simulation/{session_id}/generate_response", json={"query": "What now?"})).status_code,
+            ]
+
+    assert asyncio.run(scenario()) == [409, 409, 409]
+
+
+def test_export_endpoint_validates_the_format(main_module):
+    async def scenario():
+        transport = httpx.ASGITransport(app=main_module.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+            return await client.post("/simulation/export", params={"format": "xlsx"})
+
+    assert asyncio.run(scenario()).status_code == 400
@@ -0,0 +1,59 @@
+from langchain.llms.fake import FakeListLLM
+
+from agent import Agent
+from memory import ConversationMemory, count_tokens
+from simulation_logic import SimulationController
+
+
+def talk(memory, turns):
+    for number in range(turns):
+        memory.save_context({"input": f"Question {number}? Tell me more."}, {"output": f"Answer {number}. It goes on for a while."})
+
+
+def test_old_turns_are_folded_into_a_summary_within_the_budget():
+    memory = ConversationMemory(ai_prefix="Ava", max_tokens=60, summary_tokens=20)
+    talk(memory, 20)
+    history = memory.load_memory_variables({})["chat_history"]
+
+    assert count_tokens(history) <= 60 + count_tokens("Earlier in the conversation:")
+    assert memory.folded + len(memory.turns) == 20
+    assert history.startswith("Earlier in the conversation:") and "Answer 18" in history
+    assert history.endswith("Leader: Question 19? Tell me more.\nAva: Answer 19. It goes on for a while.")
+
+
+def test_the_summarizer_is_pluggable():
+    calls = []
+
+    def summarizer(summary, turns):
+        calls.append([query for query, _ in turns])
+        return f"{len(calls)} folds"
+
+    memory = ConversationMemory(max_tokens=40, summary_tokens=5, summarizer=summarizer)
+    talk(memory, 6)
+    assert calls and calls[0][0] == "Question 0? Tell me more."
+    assert memory.summary == f"{len(calls)} folds"
+    memory.clear()
+    assert memory.load_memory_variables({}) == {"chat_history": ""}
+
+
+def test_a_session_keeps_its_conversation_and_trims_the_state_to_the_question():
+    prompts = []
+
+    class RecordingLLM(FakeListLLM):
+        def _call(self, prompt, stop=None, **kwargs):
+            prompts.append(prompt)
+            return super()._call(prompt, stop, **kwargs)
+
+    controller = SimulationController(db_name=":memory:")
+    controller.responses = None  # every question reaches the model
+    controller.set_assistant(1)
+    controller.set_country(1)
+    controller.set_narrative(1)
+    controller.start_simulation()
+    controller.assistant.agent.llm = RecordingLLM(responses=["Growing.", "Calm."])
+
+    assert controller.generate_response("How is the economy?") == "Growing."
+    assert controller.generate_response("And religion?") == "Calm."
+    assert "Economic Stability" in prompts[0] and "Religious Harmony" not in prompts[0]
+    assert "Religious Harmony" in prompts[1] and "How is the economy?" in prompts[1]
+    assert [turn[0] for turn in controller.conversation.turns] == ["How is the economy?", "And religion?"]
@@ -0,0 +1,98 @@
+import json
+
+import numpy as np
+
+from metrics import compile_metrics, metric_calculation_functions, update_changed_metrics, MetricDependencyIndex, _ProbeState
+
+
+def load_parameter_names():
+    with open("data/parameters.json", "r") as f:
+        return list(json.load(f).keys())
+
+
+def per_function_metrics(parameter_names, values, functions):
+    state = _ProbeState(parameter_names).set_values(values)
+    return [calculate_func(state) for calculate_func in functions.values()]
+
+
+def test_builtin_metrics_compile_to_linear_form():
+    compiled = compile_metrics(load_parameter_names())
+    assert compiled.fallback_functions == {}
+    assert compiled.coefficients.shape == (len(metric_calculation_functions), len(compiled.parameter_names))
+
+
+def test_batch_matches_per_function_path():
+    parameter_names = load_parameter_names()
+    compiled = compile_metrics(parameter_names)
+    values = np.random.default_rng(42).uniform(0, 100, (50, len(parameter_names)))
+
+    batch = compiled.evaluate_batch(values)
+
+    expected = [per_function_metrics(parameter_names, row, metric_calculation_functions) for row in values]
+    np.testing.assert_allclose(batch, np.array(expected))
+
+
+def test_non_linear_metrics_fall_back_to_per_function_path():
+    parameter_names = load_parameter_names()
+    functions = dict(metric_calculation_functions)
+    functions["Economy Squared"] = lambda state: state.parameters["Economy"].value ** 2
+    functions["Influence Weighted"] = lambda state: state.influence * state.parameters["Media"].value
+    compiled = compile_metrics(parameter_names, functions)
+    assert set(compiled.fallback_functions) == {"Economy Squared", "Influence Weighted"}
+
+    state = _ProbeState(parameter_names).set_values(np.full(len(parameter_names), 30.0))
+    state.influence = 2.0
+    metrics = compiled.evaluate(state)
+    assert metrics["Economy Squared"] == 900.0
+    assert metrics["Influence Weighted"] == 60.0
+    assert metrics["Economic Stability"] == 0.0
+
+    del functions["Influence Weighted"]
+    compiled = compile_metrics(parameter_names, functions)
+    values = np.random.default_rng(7).uniform(0, 100, (10, len(parameter_names)))
+    expected = [per_function_metrics(parameter_names, row, functions) for row in values]
+    np.testing.assert_allclose(compiled.evaluate_batch(values), np.array(expected))
+
+
+def test_incremental_update_skips_unaffected_metrics():
+    parameter_names = load_parameter_names()
+    state = _ProbeState(parameter_names).set_values(np.full(len(parameter_names), 50.0))
+    state.metrics = {name: calculate_func(state) for name, calculate_func in metric_calculation_functions.items()}
+
+    state.parameters["Religion"].value = 80.0
+    skipped = update_changed_metrics(state, ["Religion"])
+
+    assert skipped == len(metric_calculation_functions) - 2  # Religious Harmony and Social Cohesion
+    assert state.metrics == {name: calculate_func(state) for name, calculate_func in metric_calculation_functions.items()}
+
+
+def test_declared_reads_override_inference():
+    index = MetricDependencyIndex({"Unrest": lambda state: 0}, {"Unrest": ["Public Unrest"]})
+    assert index.affected(["Public Unrest"]) == {"Unrest"}
+    assert index.affected(["Economy"]) == set()
+
+
+def test_relevant_metrics_follow_the_parameters_a_question_names():
+    parameter_names = load_parameter_names()
+    index = MetricDependencyIndex(metric_calculation_functions)
+    metric_names = list(metric_calculation_functions)
+
+    relevant = index.relevant("How is the economy holding up?", metric_names, parameter_names)
+    assert "Economic Stability" in relevant and "Quality of Life" in relevant
+    assert "Religious Harmony" not in relevant
+    assert relevant == [name for name in metric_names if name in relevant]
+    assert index.relevant("What now?", metric_names, parameter_names) == metric_names
+
+
+def test_metrics_with_unknown_or_no_reads_are_always_updated():
+    parameter_names = load_parameter_names()
+    functions = {"Mood": lambda state: float(state.mood), "Constant": lambda state: 1.0,
+                 "Economic Stability": metric_calculation_functions["Economic Stability"]}
+    index = MetricDependencyIndex(functions)
+    assert index.always == {"Mood", "Constant"}
+
+    state = _ProbeState(parameter_names).set_values(np.full(len(parameter_names), 50.0))
+    state.mood = 3
+    state.metrics = {"Mood": 0.0, "Constant": 0.0, "Economic Stability": 0.0}
+    assert update_changed_metrics(state, ["Religion"], index) == 1
+    assert state.metrics == {"Mood": 3.0, "Constant": 1.0, "Economic Stability": 0.0}
@@ -0,0 +1,32 @@
+import pytest
+
+from simulation_logic import SimulationController
+
+DECISION_QUEUE = ["Lower Taxes", "Invest in Education", "Lower Taxes", "Enforce Strict Immigration Policies",
+                  "Promote Scientific Research", "Implement Green Energy Policies"]
+
+
+def play(use_parameter_engine):
+    controller = SimulationController(use_parameter_engine=use_parameter_engine, db_name=":memory:")
+    controller.set_assistant(1)
+    controller.set_country(1)
+    controller.set_narrative(1)
+    controller.start_simulation()
+    history = []
+    for cycle in range(3):
+        for decision_name in DECISION_QUEUE[cycle:]:
+            controller.make_decision(decision_name)
+        controller.next_cycle()
+        history.append(controller.get_state())
+    return history
+
+
+def test_vectorized_path_matches_object_path_on_a_decision_queue():
+    objects, engine = play(False), play(True)
+    for expected, actual in zip(objects, engine):
+        assert actual["influence"] == expected["influence"]
+        assert actual["citizen_groups"] == expected["citizen_groups"]
+        for name, value in expected["parameters"].items():
+            assert actual["parameters"][name] == pytest.approx(value)
+        for name, value in expected["metrics"].items():
+            assert actual["metrics"][name] == pytest.approx(value)
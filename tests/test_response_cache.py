@@ -0,0 +1,111 @@
+from assistant import Assistant
+from database import DatabaseManager
+from response_cache import ResponseCache
+from simulation_logic import SimulationController
+
+PERSONA = {"name": "Ava", "age": 27, "style": "calm", "traits": "concise", "backstory": "Raised in a small town."}
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_entries_expire_get_evicted_and_survive_restarts(tmp_path):
+    db_manager = DatabaseManager(str(tmp_path / "cache.db"))
+    clock = Clock()
+    cache = ResponseCache(db_manager, max_entries=2, ttl=60, clock=clock)
+
+    key = cache.key(PERSONA, "response", "Quality of Life: 52.0312", "What should I do?")
+    # Near-identical prompts share a key; other personas, kinds and questions do not
+    assert cache.key(PERSONA, "response", "Quality of Life:  52.0287", "  what should i do") == key
+    assert cache.key({**PERSONA, "name": "Max"}, "response", "Quality of Life: 52.0312", "What should I do?") != key
+    assert cache.key(PERSONA, "news", "Quality of Life: 52.0312", "What should I do?") != key
+    assert cache.key(PERSONA, "response", "Quality of Life: 57.0", "What should I do?") != key
+
+    assert cache.get(key) is None
+    cache.put(key, "Invest in education")
+    assert cache.get(key) == "Invest in education"
+    for other in ("a", "b"):
+        cache.put(cache.key(PERSONA, "response", "", other), other)
+    assert cache.evictions == 1
+
+    # Evicted from memory, still in the table; a new cache on the same database finds it too
+    assert cache.get(key) == "Invest in education" and cache.disk_hits == 1
+    restarted = ResponseCache(db_manager, ttl=60, clock=clock)
+    assert restarted.get(key) == "Invest in education"
+
+    clock.now += 61
+    assert cache.get(key) is None and restarted.get(key) is None
+    assert cache.stats()["hits"] == 2 and cache.stats()["misses"] == 2
+
+
+def test_controller_asks_the_assistant_once_per_question_and_state(monkeypatch):
+    calls = []
+
+    def answer(self, state_history, query, callbacks=None):
+        calls.append((state_history, query))
+        return "An error occurred while generating the response. timeout" if query == "Fail?" else f"Answer {len(calls)}"
+
+    monkeypatch.setattr(Assistant, "generate_response", answer)
+    monkeypatch.setattr(Assistant, "fetch_news", lambda self, state_history: answer(self, state_history, "Fetch news"))
+
+    db_manager = DatabaseManager(":memory:")
+    controller = SimulationController(db_manager=db_manager, responses=ResponseCache(db_manager))
+    controller.set_assistant(1)
+    controller.set_country(1)
+    controller.set_narrative(1)
+    controller.start_simulation()
+
+    assert controller.generate_response("What should I do?") == "Answer 1"
+    assert controller.generate_response("what should I do") == "Answer 1"
+    assert controller.fetch_news() == "Answer 2"
+    assert controller.fetch_news() == "Answer 2"
+    # Failed answers are not kept
+    controller.generate_response("Fail?")
+    controller.generate_response("Fail?")
+    assert len(calls) == 4
+    assert "Current state of the country" in calls[0][0]
+
+    controller.make_decision("Lower Taxes")
+    controller.next_cycle()
+    controller.generate_response("What should I do?")
+    assert len(calls) == 5
+    assert controller.responses.stats()["hits"] == 2
+
+
+def test_follow_ups_only_share_answers_after_the_same_conversation(monkeypatch):
+    calls = []
+
+    def answer(self, state_history, query, callbacks=None):
+        # Stands in for the chain, which keeps every turn it answers
+        calls.append(query)
+        response = f"Answer {len(calls)}"
+        self.remember(query, response)
+        return response
+
+    monkeypatch.setattr(Assistant, "generate_response", answer)
+
+    db_manager = DatabaseManager(":memory:")
+    cache = ResponseCache(db_manager)
+    controllers = []
+    for _ in range(3):
+        controller = SimulationController(db_manager=db_manager, responses=cache)
+        controller.set_assistant(1)
+        controller.set_country(1)
+        controller.set_narrative(1)
+        controller.start_simulation()
+        controllers.append(controller)
+    first, second, third = controllers
+
+    assert first.generate_response("What now?") == "Answer 1"
+    # Same state, same empty conversation: served from the cache, and still part of the conversation
+    assert second.generate_response("What now?") == "Answer 1"
+    assert [turn[:2] for turn in second.conversation.turns] == [("What now?", "Answer 1")]
+
+    assert first.generate_response("And then?") == "Answer 2"
+    assert third.generate_response("And then?") == "Answer 3"
+    assert calls == ["What now?", "And then?", "And then?"]
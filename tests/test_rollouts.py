@@ -0,0 +1,59 @@
+import pickle
+
+import numpy as np
+
+import rollouts
+from rollouts import run_rollouts
+from simulation_logic import SimulationController
+
+
+def start_controller():
+    controller = SimulationController(db_name=":memory:")
+    controller.set_assistant(1)
+    controller.set_country(1)
+    controller.set_narrative(1)
+    controller.start_simulation()
+    return controller
+
+
+def test_rollouts_are_reproducible_across_worker_counts():
+    controller = start_controller()
+    policy = {"type": "weighted", "weights": {"Lower Taxes": 3, "Invest in Education": 1}}
+
+    single = run_rollouts(controller.state, policy, cycles=5, trials=40, seed=11, workers=1, chunk_size=10)
+    pooled = run_rollouts(controller.state, policy, cycles=5, trials=40, seed=11, workers=2, chunk_size=10)
+
+    assert single == pooled
+    assert controller.state.cycle == 0
+
+
+def test_sequence_rollout_matches_next_cycle():
+    controller = start_controller()
+    sequence = ["Lower Taxes", "Invest in Education", "Introduce Universal Healthcare"]
+    result = controller.run_rollouts({"type": "sequence", "decisions": sequence}, cycles=6, trials=3,
+                                     metrics=["Economic Stability", "Quality of Life"])
+
+    vote_share, stability, quality_of_life = [], [], []
+    for cycle in range(6):
+        controller.make_decision(sequence[cycle % len(sequence)])
+        controller.next_cycle()
+        vote_share.append(controller.get_vote_share()["Vote share %"])
+        stability.append(controller.state.metrics["Economic Stability"])
+        quality_of_life.append(controller.state.metrics["Quality of Life"])
+
+    np.testing.assert_allclose(result["vote_share"]["p50"], vote_share)
+    np.testing.assert_allclose(result["metrics"]["Economic Stability"]["p5"], stability)
+    np.testing.assert_allclose(result["metrics"]["Quality of Life"]["p95"], quality_of_life)
+
+
+def test_workers_read_each_compact_state_once(tmp_path):
+    compact = rollouts.build_compact_state(start_controller().state)
+    path = tmp_path / "state.pickle"
+    path.write_bytes(pickle.dumps(compact))
+
+    loaded = rollouts.load_compact_state("digest", str(path))
+    path.unlink()
+    # Later chunks with the same digest never touch the file again
+    assert rollouts.load_compact_state("digest", str(path)) is loaded
+    assert loaded["parameter_names"] == compact["parameter_names"]
+    rollouts._worker_states.clear()
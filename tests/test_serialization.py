@@ -0,0 +1,56 @@
+import json
+
+import pytest
+
+import serialization
+from simulation import State
+from simulation_logic import SimulationController
+
+
+@pytest.fixture
+def state():
+    controller = SimulationController(db_name=":memory:")
+    controller.set_assistant(1)
+    controller.set_country(1)
+    controller.set_narrative(1)
+    controller.start_simulation()
+    controller.make_decision("Lower Taxes")
+    controller.next_cycle()
+    controller.make_decision("Promote Tourism")
+    return controller.state
+
+
+@pytest.mark.parametrize("compression", ["none", "zlib"])
+def test_binary_format_round_trips_state(state, compression):
+    data = serialization.dumps(state, compression)
+    assert serialization.is_serialized(data)
+    assert serialization.loads_dict(data) == state.to_dict()
+
+    restored = State.from_dict(serialization.loads_dict(data))
+    assert restored.to_dict() == state.to_dict()
+    assert restored.decisions_to_apply[0] is restored.decisions["Promote Tourism"]
+    assert restored.assistant.agent is not state.assistant.agent
+
+
+def test_binary_format_is_smaller_than_json(state):
+    assert len(serialization.dumps(state)) * 3 < len(json.dumps(state.to_dict()))
+
+
+def test_newer_format_versions_are_rejected(state):
+    data = bytearray(serialization.dumps(state))
+    data[4] = serialization.FORMAT_VERSION + 1
+    with pytest.raises(ValueError):
+        serialization.loads_dict(bytes(data))
+
+
+def test_save_files_use_the_binary_format(state, tmp_path):
+    path = tmp_path / "game.sav"
+    state.save_game(str(path))
+    assert serialization.is_serialized(path.read_bytes())
+
+    controller = SimulationController(use_parameter_engine=True, db_name=":memory:")
+    controller.load_game_from_file(str(path))
+    assert controller.state.to_dict() == state.to_dict()
+    assert controller.state.engine is not None
+    controller.next_cycle()
+    assert controller.state.cycle == state.cycle + 1
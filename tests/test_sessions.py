@@ -0,0 +1,39 @@
+from types import SimpleNamespace
+
+import pytest
+
+from sessions import SessionRegistry
+
+
+class FakeController:
+    def __init__(self, session_id):
+        self.state = SimpleNamespace(id=session_id)
+        self.stopped = False
+
+    def stop_simulation(self):
+        self.stopped = True
+
+
+def test_least_recently_used_session_is_evicted():
+    registry = SessionRegistry(max_sessions=2)
+    first, second, third = FakeController("a"), FakeController("b"), FakeController("c")
+    registry.add(first)
+    registry.add(second)
+
+    registry.get("a")  # "b" is now the least recently used
+    registry.add(third)
+
+    assert registry.session_ids() == ["a", "c"]
+    assert second.stopped and not first.stopped
+    assert registry.evictions == 1
+    with pytest.raises(KeyError):
+        registry.get("b")
+
+
+def test_evicted_sessions_go_to_on_evict():
+    written = []
+    registry = SessionRegistry(max_sessions=1, on_evict=written.append)
+    first = FakeController("a")
+    registry.add(first)
+    registry.add(FakeController("b"))
+    assert written == [first]
@@ -0,0 +1,57 @@
+import pytest
+
+from simulation_logic import SimulationController
+
+
+@pytest.fixture(params=[False, True], ids=["objects", "engine"])
+def controllers(request):
+    started = []
+    for _ in range(2):
+        controller = SimulationController(use_parameter_engine=request.param, db_name=":memory:")
+        controller.set_assistant(1)
+        controller.set_country(1)
+        controller.set_narrative(1)
+        controller.start_simulation()
+        started.append(controller)
+    return started
+
+
+def test_games_cloned_from_one_prototype_are_independent(controllers):
+    first, second = controllers
+    prototype = first.get_prototype()
+    before = second.get_state()
+
+    first.make_decision("Lower Taxes")
+    first.next_cycle()
+
+    assert first.state.id != second.state.id
+    assert first.state.decisions is second.state.decisions
+    assert first.get_state()["parameters"] != before["parameters"]
+    assert second.get_state() == before
+    assert prototype.parameters["Economy"].value == before["parameters"]["Economy"]
+    assert prototype.citizen_groups["Workers Union"].sentiment == 50
+
+
+def test_stopped_game_rejects_cycles_instead_of_crashing(controllers):
+    controller = controllers[0]
+    controller.make_decision("Lower Taxes")
+    controller.stop_simulation()
+
+    assert controller.get_state() is None
+    with pytest.raises(ValueError):
+        controller.next_cycle()
+    with pytest.raises(ValueError):
+        controller.make_decision("Lower Taxes")
+
+
+def test_prototypes_built_from_outdated_data_are_evicted(controllers, monkeypatch):
+    controller = controllers[0]
+    controller.get_prototype()
+    assert "data/narratives.json" in controller.prototype_files
+
+    signature = controller.catalog.signature
+    monkeypatch.setattr(controller.catalog, "signature", lambda path: (0, 0) if path == "data/narratives.json" else signature(path))
+    rebuilt = controller.get_prototype()
+
+    assert all((0, 0) in key[3] for key in controller.prototypes)
+    assert rebuilt is controller.get_prototype()
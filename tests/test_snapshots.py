@@ -0,0 +1,73 @@
+import os
+import time
+
+import pytest
+
+from database import DatabaseManager
+from simulation_logic import SimulationController
+from snapshots import SnapshotStore
+
+
+def started(tmp_path, **kwargs):
+    controller = SimulationController(db_manager=DatabaseManager(":memory:", keyframe_interval=4), snapshots=SnapshotStore(str(tmp_path)), **kwargs)
+    controller.set_assistant(1)
+    controller.set_country(1)
+    controller.set_narrative(1)
+    controller.start_simulation()
+    return controller
+
+
+def objects(tmp_path):
+    return [name for _, _, names in os.walk(tmp_path / "objects") for name in names]
+
+
+def test_restore_rewinds_the_game_to_its_snapshot(tmp_path):
+    controller = started(tmp_path)
+    for _ in range(3):
+        controller.next_cycle()
+    snapshot = controller.save_game_state()
+    expected = controller.state.to_dict()
+    for _ in range(2):
+        controller.next_cycle()
+
+    restored = SimulationController(db_manager=controller.db_manager, snapshots=controller.snapshots)
+    assert restored.restore_game_state(controller.state.id).to_dict() == expected
+    assert snapshot["cycle"] == 3 and restored.snapshots.latest(controller.state.id) == {"digest": snapshot["digest"], "cycle": 3}
+    assert restored.state.assistant.name == expected["assistant"]["name"]
+
+    # The cycles after the snapshot are dropped, and the game goes on from it
+    assert [list(record)[0] for record in restored.db_manager.load_states(controller.state.id)] == [1, 2, 3]
+    restored.next_cycle()
+    assert restored.db_manager.load_state(controller.state.id, 4)["state"] == restored.state.to_dict()
+
+    assert restored.restore_game_state(controller.state.id, ref="missing") is None
+    with pytest.raises(ValueError):
+        restored.restore_game_state("../escape")
+
+
+def test_saving_every_cycle_keeps_one_fast_snapshot(tmp_path):
+    controller = started(tmp_path, snapshot_every_cycle=True)
+    timings = []
+    for _ in range(20):
+        controller.next_cycle()
+        begin = time.perf_counter()
+        controller.save_game_state()
+        controller.snapshots.restore(controller.state.id)
+        timings.append(time.perf_counter() - begin)
+
+    assert controller.snapshots.latest(controller.state.id, "latest")["cycle"] == 20
+    assert sorted(controller.snapshots.refs(controller.state.id)) == ["latest", "saved"]
+    # Both refs point at the same bytes, which are stored once
+    assert len(objects(tmp_path)) == 1
+    assert sorted(timings)[len(timings) // 2] < 0.01
+
+
+def test_corrupted_snapshots_are_refused(tmp_path):
+    controller = started(tmp_path)
+    digest = controller.save_game_state()["digest"]
+    path = tmp_path / "objects" / digest[:2] / digest[2:]
+    data = bytearray(path.read_bytes())
+    data[-1] ^= 0xFF
+    path.write_bytes(bytes(data))
+    with pytest.raises(ValueError):
+        controller.snapshots.restore(controller.state.id)
@@ -0,0 +1,70 @@
+import threading
+import time
+
+import pytest
+
+from write_behind import WriteBehind, WriteFailed
+
+
+def test_records_are_batched_and_flushed():
+    batches = []
+    writer = WriteBehind(batches.append, max_pending=100, max_delay=0.5)
+    for record in range(10):
+        writer.submit(record)
+    writer.flush()
+
+    assert sum(batches, []) == list(range(10))
+    assert len(batches) == 1
+    writer.submit(10)
+    writer.close()
+    assert sum(batches, []) == list(range(11))
+
+
+def test_submit_blocks_at_the_loss_bound():
+    release = threading.Event()
+    written = []
+
+    def slow_write(batch):
+        release.wait(timeout=5)
+        written.extend(batch)
+
+    writer = WriteBehind(slow_write, max_pending=3, max_delay=0)
+    for record in range(3):
+        writer.submit(record)
+
+    blocked = threading.Thread(target=writer.submit, args=(3,))
+    blocked.start()
+    time.sleep(0.1)
+    assert blocked.is_alive()
+    assert writer.submitted - writer.written == 3
+
+    release.set()
+    blocked.join(timeout=5)
+    writer.close()
+    assert written == [0, 1, 2, 3]
+
+
+def test_records_are_written_within_max_delay_without_a_flush():
+    written = threading.Event()
+    writer = WriteBehind(lambda batch: written.set(), max_pending=100, max_delay=0.01)
+    writer.submit("cycle")
+    assert written.wait(timeout=2)
+    writer.close()
+
+
+def test_failed_batches_are_reported_to_the_hook_and_to_flush():
+    lost = []
+
+    def failing_write(batch):
+        if "bad" in batch:
+            raise OSError("disk full")
+
+    writer = WriteBehind(failing_write, max_pending=100, max_delay=0, on_failure=lost.extend)
+    writer.submit("bad")
+    with pytest.raises(WriteFailed):
+        writer.flush()
+    assert lost == ["bad"]
+    # Each failure is reported once
+    writer.submit("good")
+    writer.flush()
+    writer.close()